@@ -15,6 +15,8 @@ from app.database import Base
 from app.models.base import TimestampModel
 from app.models.user import User 
 from app.models.document import Document 
+from app.models.ingestion_job import IngestionJob
+from app.models.document_chunk import DocumentChunk
 
 config = context.config
 
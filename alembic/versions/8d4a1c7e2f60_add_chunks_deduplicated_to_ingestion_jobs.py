@@ -0,0 +1,31 @@
+"""add chunks_deduplicated to ingestion_jobs
+
+Revision ID: 8d4a1c7e2f60
+Revises: 5b2e8f41c9d3
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d4a1c7e2f60'
+down_revision: Union[str, Sequence[str], None] = '5b2e8f41c9d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        'ingestion_jobs',
+        sa.Column('chunks_deduplicated', sa.Integer(), nullable=False, server_default='0')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('ingestion_jobs', 'chunks_deduplicated')
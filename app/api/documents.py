@@ -1,51 +1,47 @@
 """
 ドキュメント管理エンドポイント
 """
+import asyncio
+import logging
 from typing import List
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-import PyPDF2
-import io
-import re
+from app.config import settings
 from app.core.deps import get_db, get_current_user
+from app.core.upload_limit import upload_limit_message
 from app.models.user import User
 from app.models.document import Document
-from app.schemas.document import DocumentCreate, DocumentResponse, DocumentListItem
-from app.services.embeddings import get_embedding_service
+from app.models.ingestion_job import IngestionJob
+from app.schemas.document import (
+    DocumentCreate, DocumentUpdate, DocumentResponse, DocumentUpdateResponse, DocumentListItem,
+    IngestionJobAccepted, IngestionJobResponse, ReindexSummary, BulkImportResponse
+)
+from app.services.bulk_import import (
+    STATUS_IMPORTED, BulkBudget, BulkLimitError, import_items, iter_bulk_items
+)
+from app.services.chunk_store import embeddings_by_hash, save_document_chunks, save_restored_embeddings
+from app.services.chunking import chunk_text
+from app.services.dedup import load_documents, restore_references, simhashes
+from app.services.embedding_batcher import get_batch_embedder
+from app.services.ingestion import UNFINISHED_STATUSES, UploadTooLargeError, get_ingestion_pipeline
+from app.services.reindexing import ReindexError, reindex_document
 from app.services.vector_store import get_vector_store
 
-def chunk_text_semantic(text: str, max_length: int = 500, overlap: int = 50):
+logger = logging.getLogger(__name__)
 
-    chunks = []
-
-    paragraphs = re.split(r'\n\n+', text)
-
-    for paragraph in paragraphs:
-
-        paragraph = paragraph.strip()
-        if not paragraph:
-            continue
-
-        sentences = re.split(r'(?<=[。！？])', paragraph)
-
-        current_chunk = ""
-
-        for sentence in sentences:
-
-            if len(current_chunk) + len(sentence) <= max_length:
-                current_chunk += sentence
-
-            else:
-                chunks.append(current_chunk.strip())
-
-                current_chunk = current_chunk[-overlap:] + sentence
+router = APIRouter(prefix="/documents", tags=["ドキュメント管理"])
 
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
+# ユーザーごとのドキュメント数の上限
+MAX_DOCUMENTS_PER_USER = 10
 
-    return chunks
 
-router = APIRouter(prefix="/documents", tags=["ドキュメント管理"])
+def _restored_embeddings_saver(db: Session):
+    """restore_references で埋め込み直したチャンクの埋め込みを、DBのチャンクの行に書いてコミットする関数"""
+    def save(metadatas, embeddings, model):
+        save_restored_embeddings(db, metadatas, embeddings, model)
+        db.commit()
+    return save
 
 
 @router.post("", response_model=DocumentResponse, status_code=status.HTTP_201_CREATED)
@@ -60,13 +56,15 @@ async def create_document(
     - 認証必須
     - ユーザーごとに最大10件まで
     - 1ドキュメント最大1MB
+    - チャンクと埋め込みはDBにも保存する。埋め込みに失敗したチャンクは埋め込みなしで保存し、
+      インデックスの再構築（python -m app.services.index_rebuild）で埋め込む
     """
     # ドキュメント数制限チェック（10件まで）
     doc_count = db.query(Document).filter(Document.user_id == current_user.id).count()
-    if doc_count >= 10:
+    if doc_count >= MAX_DOCUMENTS_PER_USER:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="ドキュメント数の上限（10件）に達しています"
+            detail=f"ドキュメント数の上限（{MAX_DOCUMENTS_PER_USER}件）に達しています"
         )
     
     # ドキュメント作成
@@ -77,35 +75,68 @@ async def create_document(
     )
     
     db.add(new_document)
-    db.commit()
-    db.refresh(new_document)
+    try:
+        db.flush()
+        vector_store = await run_in_threadpool(get_vector_store, current_user.id)
+    except Exception:
+        # インデックスを開けない時はドキュメントも作らない
+        db.rollback()
+        logger.exception(f"Failed to open vector store for user {current_user.id}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="検索インデックスを利用できません。しばらくしてから再度お試しください"
+        )
 
-    # ★ 埋め込み生成してFAISSに追加 ★
     try:
-        embedding_service = get_embedding_service()
-        vector_store = get_vector_store(current_user.id)
-        
-        # 埋め込み生成
-        embedding = embedding_service.embed_text(document_data.content)
+        # チャンクに分けて埋め込む（失敗したチャンクは errors に入り、例外にはならない）
+        chunks = await run_in_threadpool(
+            chunk_text, new_document.content,
+            settings.CHUNK_MAX_CHARS, settings.CHUNK_OVERLAP, settings.CHUNK_MAX_TOKENS or None
+        )
+        texts = [chunk.text for chunk in chunks]
+        result = await get_batch_embedder().embed(texts)
+        fingerprints = simhashes(texts)
+        metadatas = [
+            {
+                'document_id': new_document.id,
+                'title': new_document.title,
+                'content': chunk.text,
+                'start': chunk.start,
+                'end': chunk.end,
+                'simhash': int(fingerprint),
+            }
+            for chunk, fingerprint in zip(chunks, fingerprints)
+        ]
+        indices, embeddings = result.successful()
         
-        # FAISSに追加
-        vector_store.add_document(
-            document_id=new_document.id,
-            title=new_document.title,
-            content=new_document.content,
-            embedding=embedding
+        # ドキュメントとチャンク（埋め込み付き）は同じトランザクションで保存
+        save_document_chunks(
+            db, current_user.id, new_document.id, metadatas,
+            embeddings_by_hash([texts[i] for i in indices], embeddings), vector_store.embedding_model
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    db.refresh(new_document)
+    if result.errors:
+        logger.warning(
+            f"{len(result.errors)} of {len(chunks)} chunks of document {new_document.id} were not embedded; "
+            f"rebuild the index to embed them: {result.errors[result.failed_indices[0]]}"
         )
+
+    try:
+        # インデックスに追加（ログのfsyncでイベントループを止めないようスレッドで実行）
+        await run_in_threadpool(vector_store.add_documents, embeddings, [metadatas[i] for i in indices])
     except Exception as e:
-        # 埋め込み追加に失敗してもドキュメント作成は成功させる
-        # （後で再試行できるように）
-        import logging
-        logging.error(f"Failed to add embedding: {e}")
+        # 埋め込みはDBに残っているので、インデックスの再構築で埋め込み直さずに戻せる
+        logger.error(f"Failed to add document {new_document.id} to the vector index: {e}")
     
     return new_document
 
 
 
-@router.post("/upload", response_model=DocumentResponse, status_code=status.HTTP_201_CREATED)
+@router.post("/upload", response_model=IngestionJobAccepted, status_code=status.HTTP_202_ACCEPTED)
 async def upload_document(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
@@ -115,106 +146,134 @@ async def upload_document(
     ファイルアップロード
     
     - テキストファイルとPDF対応
-    - 最大1MB
+    - 最大1MB（MAX_UPLOAD_BYTES）。本文はメモリに溜めずに一時ファイルへ書き出す
+    - ドキュメントを登録して取り込みジョブをキューに入れ、すぐに202を返す
+    - 抽出・チャンク分割・埋め込み・インデックス追加の進捗は GET /documents/jobs/{job_id} で確認する
     """
-    # メモリ監視開始
-    try:
-        import psutil
-        print(f"📊 メモリ使用量開始: {psutil.virtual_memory().percent}%")
-    except ImportError:
-        print("⚠️ psutil未インストール - メモリ監視不可")
+    pipeline = get_ingestion_pipeline()
     
-    print("🔍 Step 1: ファイル読み込み開始")
-    
-    # ファイルサイズチェック
-    content = await file.read()
-    print(f"📊 ファイルサイズ: {len(content)} bytes")
-    
-    if len(content) > 1_000_000:
+    # ファイルサイズチェック（上限を超えた時点で書き出しを打ち切る）
+    try:
+        source_path = await pipeline.spool_upload(file, settings.MAX_UPLOAD_BYTES)
+    except UploadTooLargeError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="ファイルサイズは1MB以下にしてください"
+            detail=upload_limit_message(settings.MAX_UPLOAD_BYTES)
         )
     
-    print("🔍 Step 2: テキスト抽出開始")
+    # 本文は抽出の段階で書き込む
+    new_document = Document(
+        user_id=current_user.id,
+        title=file.filename,
+        content=""
+    )
     
-    # ファイルタイプに応じてテキスト抽出
-    if file.content_type == "application/pdf" or file.filename.lower().endswith('.pdf'):
-        # PDFからテキスト抽出
+    db.add(new_document)
+    db.commit()
+    db.refresh(new_document)
+    
+    job = await pipeline.submit(db, new_document, file.filename, file.content_type, source_path)
+    
+    return IngestionJobAccepted(
+        job_id=job.id,
+        document_id=new_document.id,
+        status=job.status,
+        status_url=f"/documents/jobs/{job.id}"
+    )
+
+
+@router.post("/bulk", response_model=BulkImportResponse)
+async def bulk_import_documents(
+    files: List[UploadFile] = File(...),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    ドキュメントの一括取り込み
+    
+    - テキストファイル・PDF・ZIP（中の各ファイルを1件）・NDJSON（1行に {"title", "content"} を1件）を複数まとめて送れる
+    - リクエスト全体で最大 BULK_IMPORT_MAX_BYTES（アップロードとZIPの展開後のそれぞれ）、最大 BULK_IMPORT_MAX_ITEMS 件。
+      1件は MAX_UPLOAD_BYTES まで。上限は読みながら数え、超えた時点で 400 を返す
+    - 全チャンクをまとめて埋め込み、ドキュメントは1回のINSERT、ベクトルストアへは1回で追加する
+    - 取り込めなかった項目があっても残りは取り込み、項目ごとの結果を返す
+    - ドキュメント数の上限（10件）は1件ずつの作成と共通。残りの件数を超えた項目は失敗として返す
+    """
+    pipeline = get_ingestion_pipeline()
+    
+    items = []
+    spooled_bytes = 0
+    budget = BulkBudget(settings.BULK_IMPORT_MAX_ITEMS, settings.BULK_IMPORT_MAX_BYTES)
+    for file in files:
         try:
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(content))
-            text_content = ""
-            for page in pdf_reader.pages:
-                text_content += page.extract_text() + "\n"
-        except Exception as e:
+            # 上限はリクエスト全体なので、前のファイルの分を差し引いた残りまで受け付ける
+            source_path = await pipeline.spool_upload(file, settings.BULK_IMPORT_MAX_BYTES - spooled_bytes)
+        except UploadTooLargeError:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"PDFの読み取りに失敗しました: {str(e)}"
+                detail=upload_limit_message(settings.BULK_IMPORT_MAX_BYTES)
             )
-    else:
-        # テキストファイルとして処理
+        spooled_bytes += source_path.stat().st_size
         try:
-            text_content = content.decode('utf-8')
-        except UnicodeDecodeError:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="UTF-8でデコードできません"
+            # 件数・展開後のバイト数はファイルをまたいで数え、超えたらそこで読むのをやめる
+            await asyncio.to_thread(
+                items.extend,
+                iter_bulk_items(
+                    source_path, file.filename or "", file.content_type,
+                    pipeline.pdf_extractor, settings.MAX_UPLOAD_BYTES, budget
+                )
             )
+        except BulkLimitError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        finally:
+            source_path.unlink(missing_ok=True)
     
-    print("🔍 Step 3: 埋め込み生成開始")
-    print(f"📊 テキスト長: {len(text_content)} 文字")
-    
-    # データベースに保存
-    new_document = Document(
-        user_id=current_user.id,
-        title=file.filename,
-        content=text_content.strip()
+    results = await import_items(
+        db,
+        current_user.id,
+        items,
+        get_batch_embedder(),
+        await run_in_threadpool(get_vector_store, current_user.id),
+        max_length=settings.CHUNK_MAX_CHARS,
+        overlap=settings.CHUNK_OVERLAP,
+        max_tokens=settings.CHUNK_MAX_TOKENS or None,
+        dedup_max_distance=settings.DEDUP_MAX_DISTANCE if settings.DEDUP_ENABLED else None,
+        max_documents=MAX_DOCUMENTS_PER_USER
     )
+    imported = sum(1 for result in results if result['status'] == STATUS_IMPORTED)
     
-    db.add(new_document)
-    db.commit()
-    db.refresh(new_document)
-    print("🔍 Step 4: DB保存完了")
+    return BulkImportResponse(
+        imported=imported,
+        failed=len(results) - imported,
+        chunks_deduplicated=sum(result['chunks_deduplicated'] for result in results),
+        items=results
+    )
 
-    # ★ 埋め込み生成してFAISSに追加 ★
-    try:
-        print("📊 埋め込み前メモリ: {psutil.virtual_memory().percent}%")
-        
-        embedding_service = get_embedding_service()
-        vector_store = get_vector_store(current_user.id)
-        
-        # 埋め込み生成
-        print("🔍 Step 5: Jina API呼び出し開始")
-        # ドキュメント分割（Chunking）
-        chunks = chunk_text_semantic(text_content.strip(), max_length=800, overlap=100)
-        print(f"📊 ドキュメントを {len(chunks)} つのチャンクに分割")
-        print(f"📊 埋め込み後メモリ: {psutil.virtual_memory().percent}%")
-        
-        # 各チャンクを埋め込み生成してFAISSに追加
-        for i, chunk in enumerate(chunks):
-            print(f"🔍 チャンク {i+1}/{len(chunks)} 処理中...")
-            
-            # 埋め込み生成
-            embedding = embedding_service.embed_text(chunk)
-            
-            # FAISSに追加
-            vector_store.add_document(
-                document_id=new_document.id,
-                title=new_document.title,
-                content=chunk,
-                embedding=embedding
-            )
-        print("🔍 Step 7: FAISS追加完了")
-        print(f"📊 最終メモリ: {psutil.virtual_memory().percent}%")
-    except Exception as e:
-        import traceback
-        import logging
-        logging.error(f"Failed to add embedding: {e}")
-        print(f"❌ 埋め込み処理エラー: {e}")
-        print(f"❌ トレースバック: {traceback.format_exc()}")
+
+@router.get("/jobs/{job_id}", response_model=IngestionJobResponse)
+async def get_ingestion_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    取り込みジョブの進捗取得
     
+    - 認証必須
+    - 自分のジョブのみ取得可能
+    - 再試行しても失敗したジョブは status が dead_letter になり、error と失敗した段階を返す
+    """
+    job = db.query(IngestionJob).filter(
+        IngestionJob.id == job_id,
+        IngestionJob.user_id == current_user.id
+    ).first()
     
-    return new_document
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="ジョブが見つかりません"
+        )
+    
+    return job
 
 
 @router.get("", response_model=List[DocumentListItem])
@@ -237,6 +296,92 @@ async def list_documents(
     return documents
 
 
+@router.patch("/{document_id}", response_model=DocumentUpdateResponse)
+async def update_document(
+    document_id: int,
+    document_data: DocumentUpdate,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    ドキュメント更新
+    
+    - 認証必須
+    - 自分のドキュメントのみ更新可能
+    - 本文をチャンクに分け直し、保存済みのチャンクと本文のハッシュで突き合わせて、
+      変わったチャンクだけを埋め込んで追加し、なくなったチャンクだけを削除する
+    - 取り込み中のドキュメントは更新できない
+    """
+    document = db.query(Document)\
+        .filter(Document.id == document_id)\
+        .filter(Document.user_id == current_user.id)\
+        .first()
+    
+    if not document:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="ドキュメントが見つかりません"
+        )
+    
+    ingesting = db.query(IngestionJob.id).filter(
+        IngestionJob.document_id == document_id,
+        IngestionJob.status.in_(UNFINISHED_STATUSES)
+    ).first()
+    if ingesting:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="取り込み中のドキュメントは更新できません"
+        )
+    
+    title = document_data.title if document_data.title is not None else document.title
+    content = document_data.content if document_data.content is not None else document.content
+    
+    # ベクトルストアを先に更新する（埋め込みに失敗したらドキュメントも変更しない）
+    try:
+        vector_store = await run_in_threadpool(get_vector_store, current_user.id)
+    except Exception:
+        logger.exception(f"Failed to open vector store for user {current_user.id}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="検索インデックスを利用できません。しばらくしてから再度お試しください"
+        )
+    try:
+        reindexed = await reindex_document(
+            vector_store,
+            get_batch_embedder(),
+            document.id,
+            title,
+            content,
+            max_length=settings.CHUNK_MAX_CHARS,
+            overlap=settings.CHUNK_OVERLAP,
+            max_tokens=settings.CHUNK_MAX_TOKENS or None
+        )
+    except ReindexError as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"埋め込みの生成に失敗しました: {str(e)}"
+        )
+    
+    document.title = title
+    document.content = content
+    save_document_chunks(
+        db, current_user.id, document.id, reindexed.metadatas, reindexed.embeddings, vector_store.embedding_model
+    )
+    db.commit()
+    db.refresh(document)
+    
+    # 削除したチャンクを重複として参照していたほかのドキュメントの箇所を埋め込み直す
+    await restore_references(
+        vector_store, get_batch_embedder(), lambda ids: load_documents(db, ids), reindexed.orphaned,
+        _restored_embeddings_saver(db)
+    )
+    
+    return DocumentUpdateResponse(
+        **DocumentResponse.model_validate(document).model_dump(),
+        reindex=ReindexSummary(**reindexed.summary)
+    )
+
+
 @router.delete("/{document_id}")
 async def delete_document(
     document_id: int,
@@ -261,16 +406,28 @@ async def delete_document(
         )
     
     # FAISSからも削除
+    vector_store = None
+    orphaned = []
     try:
-        vector_store = get_vector_store(current_user.id)
-        vector_store.remove_document(document_id)
-    except Exception as e:
-        print(f"Failed to remove from FAISS: {e}")
+        vector_store = await run_in_threadpool(get_vector_store, current_user.id)
+        orphaned = await run_in_threadpool(vector_store.remove_document, document_id)
+    except Exception:
+        logger.exception(f"Failed to remove document {document_id} from vector store")
     
     # DBから削除
     db.delete(document)
     db.commit()
     
+    # このドキュメントのチャンクを重複として参照していたほかのドキュメントの箇所を埋め込み直す
+    if vector_store is not None and orphaned:
+        try:
+            await restore_references(
+                vector_store, get_batch_embedder(), lambda ids: load_documents(db, ids), orphaned,
+                _restored_embeddings_saver(db)
+            )
+        except Exception:
+            logger.exception(f"Failed to restore deduplicated chunks after deleting document {document_id}")
+    
     return {"message": "ドキュメントを削除しました"}
 
 
@@ -3,18 +3,35 @@ RAG検索エンドポイント
 """
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from openai import OpenAI
+from fastapi.concurrency import run_in_threadpool
+import numpy as np
 
 from app.core.deps import get_db, get_current_user
 from app.models.user import User
-from app.schemas.search import SearchRequest, SearchResponse, SearchSource
+from app.schemas.search import (
+    SearchRequest, SearchResponse, SearchSource,
+    BatchSearchRequest, BatchSearchResponse, BatchSearchResult
+)
 from app.services.embeddings import get_embedding_service
+from app.services.llm import get_llm_client
+from app.services.vector_index import normalize_L2
 from app.services.vector_store import get_vector_store
-from app.config import settings
 
 router = APIRouter(prefix="/search", tags=["RAG検索"])
 
 
+def _to_source(metadata: dict, distance: float) -> SearchSource:
+    """検索結果のメタデータをレスポンス用のソース情報に変換（本文は先頭200文字）"""
+    return SearchSource(
+        document_id=metadata['document_id'],
+        title=metadata['title'],
+        content=metadata['content'][:200] + "..." if len(metadata['content']) > 200 else metadata['content'],
+        distance=distance,
+        start=metadata.get('start'),
+        end=metadata.get('end')
+    )
+
+
 @router.post("", response_model=SearchResponse)
 async def search_documents(
     search_request: SearchRequest,
@@ -26,7 +43,7 @@ async def search_documents(
     
     処理フロー:
     1. クエリの埋め込み生成
-    2. FAISSで類似ドキュメント検索
+    2. ベクトルストアで類似ドキュメント検索
     3. 関連ドキュメントをコンテキストとしてLLMに渡す
     4. Groq APIで回答生成
     
@@ -35,7 +52,7 @@ async def search_documents(
     """
     # 埋め込みサービスとベクトルストアを取得
     embedding_service = get_embedding_service()
-    vector_store = get_vector_store(current_user.id)
+    vector_store = await run_in_threadpool(get_vector_store, current_user.id)
     
     # ドキュメントがない場合
     from app.models.document import Document
@@ -47,17 +64,21 @@ async def search_documents(
         )
     
     # 1. クエリの埋め込み生成
-    query_embedding = embedding_service.embed_text(search_request.query)
+    # 同時に届いた他のクエリとまとめて1回のAPI呼び出しにする
+    query_embedding = await embedding_service.aembed_query(search_request.query)
     
     # L2正規化を適用
-    import faiss
-    import numpy as np
     query_embedding_array = np.array([query_embedding]).astype('float32')
-    faiss.normalize_L2(query_embedding_array)
+    normalize_L2(query_embedding_array)
     query_embedding = query_embedding_array[0]
     
-    # 2. 類似ドキュメント検索
-    search_results = vector_store.search(query_embedding, top_k=search_request.top_k)
+    # 2. 類似ドキュメント検索（ロック待ちでイベントループを止めないようスレッドで実行）
+    search_results = await run_in_threadpool(
+        vector_store.search,
+        query_embedding,
+        top_k=search_request.top_k,
+        params={'nprobe': search_request.nprobe, 'ef_search': search_request.ef_search}
+    )
     
     if not search_results:
         raise HTTPException(
@@ -74,26 +95,16 @@ async def search_documents(
         context_parts.append(f"【資料{i}: {metadata['title']}】\n{metadata['content']}")
         
         # ソース情報を保存
-        sources.append(SearchSource(
-            document_id=metadata['document_id'],
-            title=metadata['title'],
-            content=metadata['content'][:200] + "..." if len(metadata['content']) > 200 else metadata['content'],
-            distance=distance
-        ))
+        sources.append(_to_source(metadata, distance))
     
     context = "\n\n".join(context_parts)
     
     # 4. Groq APIで回答生成
     try:
-        # デバッグ用
-        print(f"[DEBUG] GROQ_API_KEY in search.py: {settings.GROQ_API_KEY[:20]}...")
-        
-        client = OpenAI(
-            api_key=settings.GROQ_API_KEY,
-            base_url="https://api.groq.com/openai/v1"
-        )
+        # 共有の非同期クライアントで待つ間も他のリクエストを処理できる
+        client = get_llm_client()
         
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="llama-3.1-8b-instant",
             messages=[
                 {
@@ -135,4 +146,52 @@ async def search_documents(
         query=search_request.query,
         answer=answer,
         sources=sources
-    )
\ No newline at end of file
+    )
+
+
+@router.post("/batch", response_model=BatchSearchResponse)
+async def search_documents_batch(
+    search_request: BatchSearchRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    複数クエリの一括検索（関連ドキュメントのみ返し、LLMによる回答生成は行わない）
+    
+    処理フロー:
+    1. 全クエリの埋め込みを1回のAPI呼び出しで生成
+    2. ベクトルストアで全クエリをまとめて検索
+    
+    - 認証必須
+    - 結果はクエリと同じ順序で返す（該当なしのクエリは空のリスト）
+    """
+    embedding_service = get_embedding_service()
+    
+    from app.models.document import Document
+    doc_count = db.query(Document).filter(Document.user_id == current_user.id).count()
+    if doc_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="検索対象のドキュメントがありません。先にドキュメントをアップロードしてください。"
+        )
+    
+    # 1. 全クエリの埋め込みを一括生成してL2正規化
+    query_embeddings = np.array(await embedding_service.aembed_texts(search_request.queries), dtype='float32')
+    normalize_L2(query_embeddings)
+    
+    # 2. 行列1回で全クエリを検索
+    vector_store = await run_in_threadpool(get_vector_store, current_user.id)
+    batch_results = await run_in_threadpool(
+        vector_store.search_batch,
+        query_embeddings,
+        top_k=search_request.top_k,
+        params={'nprobe': search_request.nprobe, 'ef_search': search_request.ef_search}
+    )
+    
+    return BatchSearchResponse(results=[
+        BatchSearchResult(
+            query=query,
+            sources=[_to_source(metadata, distance) for metadata, distance in results]
+        )
+        for query, results in zip(search_request.queries, batch_results)
+    ])
@@ -21,9 +21,97 @@ class Settings(BaseSettings):
     
     # LLM API
     GROQ_API_KEY: str
+    # 共有の非同期クライアントの接続プールとタイムアウト（秒）
+    LLM_HTTP_POOL_SIZE: int = 10
+    LLM_TIMEOUT: float = 60.0
     
-    # Embeddings API
-    JINA_API_KEY: str
+    # Embeddings
+    # 埋め込みの生成元（jina / onnx / hashing）。onnx はローカルのONNXモデル、
+    # hashing は特徴量ハッシュによる決定的な埋め込み（テスト・ベンチマーク・オフライン用）
+    EMBEDDING_PROVIDER: str = "jina"
+    # jina 以外のプロバイダーでは不要
+    JINA_API_KEY: str = ""
+    EMBEDDING_MODEL: str = "jina-embeddings-v3"
+    # 埋め込みの次元数（jina-embeddings-v3は1024以下に切り詰めて返せる。小さいほどメモリと検索コストが減る）。
+    # 既存ストアの次元数と異なる場合は読み込み時に変換する
+    EMBEDDING_DIMENSION: int = 1024
+    # Jina APIへのkeep-alive接続プール（プロセス全体で共有）
+    EMBEDDING_HTTP_POOL_SIZE: int = 10
+    EMBEDDING_HTTP_CONNECT_TIMEOUT: float = 5.0
+    EMBEDDING_HTTP_READ_TIMEOUT: float = 30.0
+    # チャンクの一括埋め込み: 1リクエストの件数・文字数の上限、同時リクエスト数、429/5xxの再試行回数
+    EMBEDDING_BATCH_SIZE: int = 64
+    EMBEDDING_BATCH_MAX_CHARS: int = 32000
+    EMBEDDING_CONCURRENCY: int = 4
+    EMBEDDING_MAX_RETRIES: int = 4
+    # 埋め込みキャッシュ（同じテキストを再度APIに送らない）。メモリ上のLRUの件数（0で無効）と
+    # ディスク層の置き場所（空なら使わない）・上限
+    EMBEDDING_CACHE_ENTRIES: int = 4096
+    EMBEDDING_CACHE_DIR: str = "./embedding_cache"
+    EMBEDDING_CACHE_DISK_MB: int = 512
+    # 同時に届いた検索クエリの埋め込みをまとめて送る（待ち時間の上限と1回の最大件数）
+    QUERY_EMBEDDING_BATCH_WINDOW_MS: float = 5.0
+    QUERY_EMBEDDING_BATCH_SIZE: int = 32
+    # ローカルのONNXモデル（model.onnx と tokenizer.json を置くディレクトリ）。
+    # 量子化ありなら model_quantized.onnx を使い、なければ初回読み込み時にINT8へ変換して保存する
+    ONNX_MODEL_DIR: str = "./onnx_model"
+    ONNX_QUANTIZED: bool = True
+    # 推論ワーカーが1回にまとめるテキスト数の上限と、他の呼び出しを待つ最大時間（ミリ秒）
+    ONNX_MAX_BATCH_SIZE: int = 32
+    ONNX_BATCH_WAIT_MS: float = 2.0
+    ONNX_MAX_LENGTH: int = 512
+    # プーリング（mean / cls）と推論スレッド数（0ならonnxruntimeの既定値）
+    ONNX_POOLING: str = "mean"
+    ONNX_NUM_THREADS: int = 0
+    
+    # アップロードできるファイルの上限（バイト）。本文はディスクに少しずつ書き出すので、上げてもメモリは増えない
+    MAX_UPLOAD_BYTES: int = 1_000_000
+    # 一括取り込み（POST /documents/bulk）のリクエスト全体の上限（バイト。アップロードとZIPの展開後のそれぞれ）と
+    # 1リクエストの最大件数。ZIP内の各ファイル・NDJSONの各行は MAX_UPLOAD_BYTES までにする
+    BULK_IMPORT_MAX_BYTES: int = 20_000_000
+    BULK_IMPORT_MAX_ITEMS: int = 1000
+    
+    # Ingestion（アップロード後の抽出→チャンク分割→埋め込み→インデックス追加をバックグラウンドで実行）
+    # 抽出・埋め込みの段階それぞれのワーカー数と、段階の間のキューの上限
+    INGESTION_WORKERS: int = 2
+    INGESTION_QUEUE_SIZE: int = 8
+    # 1ジョブの最大試行回数と、1回目の再試行までの待ち時間（秒、以降は倍々）。
+    # 上限に達したジョブは dead_letter になり、アップロードファイルは INGESTION_SPOOL_DIR/dead_letter に残る
+    INGESTION_MAX_ATTEMPTS: int = 3
+    INGESTION_RETRY_BACKOFF: float = 2.0
+    INGESTION_SPOOL_DIR: str = "./ingestion_spool"
+    # 1ジョブで一度に埋め込み・インデックス追加まで進めるチャンク数。1ジョブが持つチャンクと埋め込みはこの件数分まで
+    # （本文は一時ファイルから少しずつ読むので、大きなファイルでもメモリ使用量はこの件数で決まる）
+    INGESTION_CHUNK_GROUP_SIZE: int = 256
+    # PDFのテキスト抽出を行うプロセス数（0なら別プロセスを使わない）、1回にワーカーへ渡すページ数、
+    # 1文書の抽出の制限時間（秒）。抽出のスループット（pages/s）は /metrics の ingestion.pdf_extraction に出る
+    PDF_EXTRACT_WORKERS: int = 2
+    PDF_PAGES_PER_TASK: int = 8
+    PDF_EXTRACT_TIMEOUT: float = 120.0
+    # チャンク分割: 1チャンクの最大文字数、前のチャンクと重ねる最大文字数（文単位）、
+    # 1チャンクの最大トークン数（見積もり。0なら数えない）
+    CHUNK_MAX_CHARS: int = 800
+    CHUNK_OVERLAP: int = 100
+    CHUNK_MAX_TOKENS: int = 0
+    # 取り込み時の重複除去: ユーザーのインデックスにある既存チャンクとSimHash（64ビット）の
+    # ハミング距離が DEDUP_MAX_DISTANCE 以下のチャンクは埋め込まずに既存チャンクを参照する
+    DEDUP_ENABLED: bool = True
+    DEDUP_MAX_DISTANCE: int = 3
+    
+    # Vector Store
+    VECTOR_STORE_DIR: str = "./vector_stores"
+    # 追記ログがこのサイズを超えたらバックグラウンドでスナップショットを作成
+    VECTOR_STORE_CHECKPOINT_MB: int = 16
+    # メモリ上に保持するVectorStore全体の予算（超えたらLRUで追い出す）
+    VECTOR_STORE_CACHE_MB: int = 192
+    # チャンク数が閾値を超えたストアを近似・量子化インデックス（ivf / hnsw / sq8 / pq / binary）に昇格。
+    # flatなら昇格しない
+    VECTOR_ANN_INDEX_TYPE: str = "hnsw"
+    VECTOR_ANN_THRESHOLD: int = 20000
+    # 検索エンジン（auto / faiss / numpy）。auto はFAISSがなければNumPyを使う。
+    # numpy エンジンはフラット検索のみで、ベクトル行列の型を float32 / float16 から選べる
+    VECTOR_ENGINE: str = "auto"
+    VECTOR_NUMPY_DTYPE: str = "float32"
 
     model_config = SettingsConfigDict(
         env_file=str(ENV_FILE),
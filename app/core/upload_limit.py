@@ -0,0 +1,87 @@
+"""
+アップロードのサイズ制限（ASGIミドルウェア）
+
+FastAPIはハンドラーを呼ぶ前にmultipartの本文を全部読んでしまうので、
+上限を超える本文はここで読み込む前（Content-Length）か読み込み中に打ち切る
+"""
+import json
+from typing import Iterable
+
+# multipartの境界やヘッダーの分として、ファイルの上限に上乗せする本文の余裕
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+def upload_limit_message(max_bytes: int) -> str:
+    return f"ファイルサイズは{max_bytes / 1_000_000:g}MB以下にしてください"
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        """
+        Args:
+            max_bytes: アップロードファイルの上限（本文はこれに MULTIPART_OVERHEAD を足した分まで許す）
+            paths: 制限をかけるパス
+        """
+        self.app = app
+        self.max_body = max_bytes + MULTIPART_OVERHEAD
+        self.message = upload_limit_message(max_bytes)
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body:
+            # 本文を1バイトも読まずに断る
+            await self._reject(send)
+            return
+
+        # Content-Lengthのない（chunked）本文は読みながら数える
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    exceeded = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if exceeded:
+                # 本文の解析エラーとして返されるレスポンスの代わりに413を返す
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except _BodyTooLarge:
+            pass
+        if exceeded and not response_started:
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": self.message}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
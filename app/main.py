@@ -9,6 +9,7 @@ from app.api import auth  # 追加：認証用のルーターを読み込む
 from app.api import documents  
 from app.api import search
 from app.models.base import Base # 追加：全モデルのベース
+from app.core.upload_limit import UploadSizeLimitMiddleware
 
 app = FastAPI(
     title="RAG Knowledge API",
@@ -26,6 +27,21 @@ async def startup_event():
         print("✅ Database tables created/verified")
     except Exception as e:
         print(f"❌ Failed to create tables: {e}")
+    
+    # 取り込みワーカーを起動（前回処理中だったジョブも再開）
+    from app.services.ingestion import get_ingestion_pipeline
+    await get_ingestion_pipeline().start()
+
+# 共有のHTTPクライアントを閉じる
+@app.on_event("shutdown")
+async def shutdown_event():
+    """アプリ終了時に取り込みワーカーを止め、埋め込み・LLMクライアントの接続プールを閉じる"""
+    from app.services.embeddings import close_embedding_service
+    from app.services.ingestion import get_ingestion_pipeline
+    from app.services.llm import close_llm_client
+    await get_ingestion_pipeline().stop()
+    await close_embedding_service()
+    await close_llm_client()
 
 # ポートバインディング確認用エンドポイント
 @app.get("/port-test")
@@ -44,10 +60,22 @@ app.add_middleware(
         "https://rag-knowledge-frontend-q9bo.vercel.app"
     ],
     allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
 )
 
+# 上限を超えるアップロードは本文を読み込む前に断る
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=settings.MAX_UPLOAD_BYTES,
+    paths=["/documents/upload"]
+)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=settings.BULK_IMPORT_MAX_BYTES,
+    paths=["/documents/bulk"]
+)
+
 # ルーターの登録
 # ✅ これを呼ぶことで /auth/register や /auth/login が使えるようになるよ
 app.include_router(auth.router)
@@ -70,6 +98,20 @@ def health_check(db: Session = Depends(get_db)):
     except Exception as e:
         return {"status": "unhealthy", "error": str(e)}, 500
 
+@app.get("/metrics", tags=["Health"])
+def metrics():
+    """キャッシュなどの内部カウンターを返す"""
+    from app.services.embeddings import get_embedding_service
+    from app.services.ingestion import get_ingestion_pipeline
+    from app.services.vector_store import get_vector_store_cache
+    return {
+        "vector_store_cache": get_vector_store_cache().stats(),
+        "embedding_provider": get_embedding_service().stats(),
+        "embedding_cache": get_embedding_service().cache_stats(),
+        "query_embedding_batches": get_embedding_service().query_batch_stats(),
+        "ingestion": get_ingestion_pipeline().stats()
+    }
+
 @app.get("/", tags=["Root"])
 def root():
     """Renderヘルスチェック用の軽量エンドポイント"""
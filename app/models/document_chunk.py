@@ -0,0 +1,38 @@
+"""
+ドキュメントのチャンクモデル
+
+ベクトルストアのファイルとは別に、チャンクの本文・位置・埋め込みをDBに残す。
+ベクトルストアのファイルを失った場合やインデックスの種類を変える場合に、
+埋め込みAPIを呼び直さずにDBからインデックスを作り直せる
+"""
+from sqlalchemy import BigInteger, Column, Integer, LargeBinary, String, Text, ForeignKey
+from app.models.base import TimestampModel
+
+
+class DocumentChunk(TimestampModel):
+    """
+    チャンクモデル
+
+    1ドキュメントのチャンクを position の順に持つ。埋め込みは float16 のバイト列
+    （ほぼ同じ既存チャンクを参照して埋め込みを省いたチャンクや、埋め込みに失敗したチャンクは NULL）
+    """
+    __tablename__ = "document_chunks"
+    
+    # id, created_at, updated_at は TimestampModel から継承
+    
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False, index=True)
+    # ドキュメント内の順番（0から）
+    position = Column(Integer, nullable=False)
+    
+    # 本文と、ドキュメントの本文上の位置 [start_offset, end_offset)
+    content = Column(Text, nullable=False)
+    start_offset = Column(Integer, nullable=False)
+    end_offset = Column(Integer, nullable=False)
+    # 本文のSHA-256（同じ本文のチャンクの埋め込みを使い回す）と、SimHash（0 = 不明）
+    content_hash = Column(String(64), nullable=False, index=True)
+    simhash = Column(BigInteger, nullable=False, default=0)
+    
+    # 埋め込み（float16）と、それを作ったモデル（モデルが変わったら埋め込み直す）
+    embedding = Column(LargeBinary, nullable=True)
+    embedding_model = Column(String(255), nullable=True)
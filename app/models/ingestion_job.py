@@ -0,0 +1,63 @@
+"""
+取り込みジョブモデル
+
+アップロードされたファイルの抽出→チャンク分割→埋め込み→インデックス追加の進捗を管理
+再試行しても成功しなかったジョブは dead_letter として原因と一緒に残す
+"""
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from app.models.base import TimestampModel
+
+# 処理の段階（この順に進む）
+STAGES = ("extract", "chunk", "embed", "index")
+
+
+class IngestionJob(TimestampModel):
+    """
+    取り込みジョブモデル
+
+    1アップロードにつき1件。ワーカーが段階ごとに進捗を書き込む
+    """
+    __tablename__ = "ingestion_jobs"
+    
+    # id, created_at, updated_at は TimestampModel から継承
+    
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False, index=True)
+    # queued / running / retrying / succeeded / dead_letter
+    status = Column(String(20), nullable=False, default="queued", index=True)
+    # 処理中（失敗した場合は失敗した）段階
+    stage = Column(String(20), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    
+    # 一時保存したアップロードファイル（成功したら削除、dead_letterなら再処理用に残す）
+    filename = Column(String(255), nullable=False)
+    content_type = Column(String(255), nullable=True)
+    source_path = Column(String(1024), nullable=True)
+    
+    chunks_total = Column(Integer, nullable=False, default=0)
+    chunks_indexed = Column(Integer, nullable=False, default=0)
+    # ほぼ同じ既存チャンクを参照して埋め込みを省いたチャンク数
+    chunks_deduplicated = Column(Integer, nullable=False, default=0)
+    # 埋め込みに失敗したチャンク（JSON: [{"index": 0, "error": "..."}]）
+    failed_chunks = Column(Text, nullable=True)
+    # 最後のエラーと、試行ごとのエラーの履歴（JSON: [{"attempt": 1, "stage": "embed", "error": "..."}]）
+    error = Column(Text, nullable=True)
+    error_log = Column(Text, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    
+    @property
+    def progress(self) -> float:
+        """進捗（0〜1）。完了した段階の割合"""
+        if self.status == "succeeded":
+            return 1.0
+        if self.stage not in STAGES:
+            return 0.0
+        return STAGES.index(self.stage) / len(STAGES)
+
+    @property
+    def dedup_ratio(self) -> float:
+        """重複として埋め込みを省いたチャンクの割合（0〜1）"""
+        if not self.chunks_total:
+            return 0.0
+        return (self.chunks_deduplicated or 0) / self.chunks_total
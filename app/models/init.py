@@ -1,5 +1,7 @@
 from app.models.base import Base, TimestampModel
 from app.models.user import User
 from app.models.document import Document  # ← 追加
+from app.models.ingestion_job import IngestionJob
+from app.models.document_chunk import DocumentChunk
 
-__all__ = ["Base", "TimestampModel", "User", "Document"]
\ No newline at end of file
+__all__ = ["Base", "TimestampModel", "User", "Document", "IngestionJob", "DocumentChunk"]
@@ -1,9 +1,10 @@
 """
 ドキュメント関連のPydanticスキーマ
 """
-from pydantic import BaseModel, Field
+import json
+from pydantic import BaseModel, Field, field_validator
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 
 class DocumentCreate(BaseModel):
@@ -31,6 +32,85 @@ class DocumentResponse(BaseModel):
         from_attributes = True
 
 
+class ReindexSummary(BaseModel):
+    """ドキュメント更新時の差分インデックスの内訳"""
+    chunks_total: int = Field(description="新しい本文のチャンク数")
+    chunks_embedded: int = Field(description="本文が変わって埋め込み直したチャンク数")
+    chunks_reused: int = Field(description="本文が同じで埋め込みを再利用したチャンク数")
+    chunks_removed: int = Field(description="新しい本文からなくなって削除したチャンク数")
+
+
+class DocumentUpdateResponse(DocumentResponse):
+    """ドキュメント更新のレスポンス"""
+    reindex: ReindexSummary
+
+
+class BulkImportItemResult(BaseModel):
+    """一括取り込みの項目ごとの結果"""
+    name: str = Field(description="ファイル名、ZIP内のパス、またはNDJSONの「ファイル名:行番号」")
+    status: str = Field(description="imported / failed")
+    document_id: Optional[int] = None
+    chunks_indexed: int = 0
+    chunks_deduplicated: int = Field(0, description="ほぼ同じチャンクを参照して埋め込みを省いたチャンク数")
+    chunks_failed: int = 0
+    error: Optional[str] = None
+
+
+class BulkImportResponse(BaseModel):
+    """一括取り込みのレスポンス"""
+    imported: int
+    failed: int
+    chunks_deduplicated: int = Field(0, description="全項目の chunks_deduplicated の合計")
+    items: List[BulkImportItemResult]
+
+
+class ChunkFailure(BaseModel):
+    """埋め込みに失敗したチャンク"""
+    index: int = Field(description="ドキュメント内のチャンク番号（0始まり）")
+    error: str
+
+
+class IngestionJobAccepted(BaseModel):
+    """ファイルアップロードのレスポンス（取り込みはバックグラウンドで行う）"""
+    job_id: int
+    document_id: int
+    status: str
+    status_url: str = Field(description="進捗を確認するURL")
+
+
+class IngestionJobResponse(BaseModel):
+    """取り込みジョブの進捗"""
+    id: int
+    document_id: int
+    status: str = Field(description="queued / running / retrying / succeeded / dead_letter")
+    stage: Optional[str] = Field(None, description="処理中（失敗時は失敗した）段階: extract / chunk / embed / index")
+    progress: float = Field(description="完了した段階の割合（0〜1）")
+    attempts: int
+    max_attempts: int
+    chunks_total: int
+    chunks_indexed: int
+    chunks_deduplicated: int = Field(0, description="ほぼ同じチャンク（既存・同じドキュメントの先のチャンク）を参照して埋め込みを省いたチャンク数")
+    dedup_ratio: float = Field(0.0, description="chunks_deduplicated / chunks_total")
+    failed_chunks: List[ChunkFailure] = []
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+    
+    @field_validator('failed_chunks', mode='before')
+    @classmethod
+    def parse_failed_chunks(cls, v):
+        # DBにはJSON文字列で保存している
+        if v is None:
+            return []
+        if isinstance(v, str):
+            return json.loads(v)
+        return v
+    
+    class Config:
+        from_attributes = True
+
+
 class DocumentListItem(BaseModel):
     """ドキュメント一覧用スキーマ（contentは含めない）"""
     id: int
@@ -1,14 +1,16 @@
 """
 検索関連のPydanticスキーマ
 """
-from pydantic import BaseModel, Field
-from typing import List
+from pydantic import BaseModel, Field, field_validator
+from typing import List, Optional
 
 
 class SearchRequest(BaseModel):
     """検索リクエスト"""
     query: str = Field(..., min_length=1, max_length=1000, description="検索クエリ")
     top_k: int = Field(default=3, ge=1, le=10, description="返す関連ドキュメント数（1-10）")
+    nprobe: Optional[int] = Field(default=None, ge=1, le=1024, description="IVFインデックスで探索するクラスタ数")
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1024, description="HNSWインデックスの探索幅")
 
 
 class SearchSource(BaseModel):
@@ -17,10 +19,39 @@ class SearchSource(BaseModel):
     title: str
     content: str
     distance: float = Field(description="類似度距離（小さいほど類似）")
+    start: Optional[int] = Field(default=None, description="ドキュメント本文上のチャンクの開始位置（文字）")
+    end: Optional[int] = Field(default=None, description="ドキュメント本文上のチャンクの終了位置（文字）")
 
 
 class SearchResponse(BaseModel):
     """検索レスポンス"""
     query: str
     answer: str
-    sources: List[SearchSource]
\ No newline at end of file
+    sources: List[SearchSource]
+
+
+class BatchSearchRequest(BaseModel):
+    """複数クエリの検索リクエスト（LLMによる回答生成なし）"""
+    queries: List[str] = Field(..., min_length=1, max_length=64, description="検索クエリ（1-64件）")
+    top_k: int = Field(default=3, ge=1, le=10, description="クエリごとに返す関連ドキュメント数（1-10）")
+    nprobe: Optional[int] = Field(default=None, ge=1, le=1024, description="IVFインデックスで探索するクラスタ数")
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1024, description="HNSWインデックスの探索幅")
+
+    @field_validator("queries")
+    @classmethod
+    def validate_queries(cls, queries: List[str]) -> List[str]:
+        for query in queries:
+            if not 1 <= len(query) <= 1000:
+                raise ValueError("各クエリは1〜1000文字で指定してください")
+        return queries
+
+
+class BatchSearchResult(BaseModel):
+    """1クエリ分の検索結果"""
+    query: str
+    sources: List[SearchSource]
+
+
+class BatchSearchResponse(BaseModel):
+    """複数クエリの検索レスポンス（入力と同じ順序）"""
+    results: List[BatchSearchResult]
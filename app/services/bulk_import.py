@@ -0,0 +1,369 @@
+"""
+ドキュメントの一括取り込み
+複数ファイル・ZIPアーカイブ・NDJSON（1行1ドキュメント）をまとめて取り込む
+
+1件ずつのアップロードと違い、全ドキュメントのチャンクを一括埋め込み（BatchEmbedder）にまとめて渡し、
+ドキュメントの行は1回のINSERTで、チャンクはベクトルストアへ1回の追加（ログ追記1回）で書き込む。
+取り込めなかったものは全体を止めずに、項目ごとの結果に理由を返す
+"""
+import asyncio
+import json
+import logging
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import Iterator, List, Optional
+
+import numpy as np
+from pydantic import ValidationError
+from sqlalchemy import insert
+
+from app.models.document import Document
+from app.models.document_chunk import DocumentChunk
+from app.schemas.document import DocumentCreate
+from app.services.chunk_store import chunk_rows, embeddings_by_hash
+from app.services.chunking import chunk_text
+from app.services.dedup import add_deduplicated, find_duplicates, simhashes
+from app.services.ingestion import BLOCK_SIZE, IngestionError, iter_text
+from app.services.pdf_extraction import PdfExtractor
+
+logger = logging.getLogger(__name__)
+
+STATUS_IMPORTED = "imported"
+STATUS_FAILED = "failed"
+
+ARCHIVE_SUFFIXES = ('.zip',)
+NDJSON_SUFFIXES = ('.ndjson', '.jsonl')
+ARCHIVE_CONTENT_TYPES = ('application/zip', 'application/x-zip-compressed')
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+class BulkItem:
+    """取り込む1件（読み取りに失敗したものは error を持つ）"""
+
+    def __init__(self, name: str, title: Optional[str] = None, content: Optional[str] = None,
+                 error: Optional[str] = None):
+        # 結果で項目を示す名前（ファイル名、アーカイブ内のパス、NDJSONの行番号）
+        self.name = name
+        self.title = title
+        self.content = content
+        self.error = error
+
+
+class BulkLimitError(Exception):
+    """リクエスト全体の件数・展開後のバイト数の上限を超えた"""
+
+
+class BulkBudget:
+    """
+    リクエスト全体の件数と展開後のバイト数を、項目を読みながら数える
+
+    ZIPは展開しながら数えるので、圧縮率の高いアーカイブでも上限を超えた時点で打ち切れる
+    """
+
+    def __init__(self, max_items: int, max_bytes: int):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = 0
+        self.bytes = 0
+
+    def add_item(self):
+        self.items += 1
+        if self.items > self.max_items:
+            raise BulkLimitError(f"一度に取り込めるのは{self.max_items}件までです")
+
+    def add_bytes(self, size: int):
+        self.bytes += size
+        if self.bytes > self.max_bytes:
+            raise BulkLimitError(f"展開後の合計は{self.max_bytes / 1_000_000:g}MB以下にしてください")
+
+
+def _kind(filename: str, content_type: Optional[str]) -> str:
+    suffix = PurePosixPath(filename.lower()).suffix
+    if suffix in ARCHIVE_SUFFIXES or content_type in ARCHIVE_CONTENT_TYPES:
+        return "archive"
+    if suffix in NDJSON_SUFFIXES or content_type in NDJSON_CONTENT_TYPES:
+        return "ndjson"
+    return "file"
+
+
+def _read_text(path: Path, filename: str, content_type: Optional[str], pdf_extractor: PdfExtractor,
+               max_item_bytes: int) -> BulkItem:
+    """1ファイルを1ドキュメントとして読む（PDFかUTF-8のテキスト）"""
+    try:
+        content = "".join(iter_text(path, filename, content_type, pdf_extractor)).strip()
+    except IngestionError as e:
+        return BulkItem(filename, error=str(e))
+    if not content:
+        return BulkItem(filename, error="本文が空です")
+    if len(content.encode('utf-8')) > max_item_bytes:
+        return BulkItem(filename, error=f"本文が{max_item_bytes}バイトを超えています")
+    return BulkItem(filename, title=PurePosixPath(filename).name[:255], content=content)
+
+
+def _iter_ndjson(path: Path, filename: str) -> Iterator[BulkItem]:
+    """NDJSONの各行（{"title": ..., "content": ...}）を1ドキュメントとして読む"""
+    with open(path, encoding='utf-8') as f:
+        try:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                name = f"{filename}:{line_no}"
+                try:
+                    record = DocumentCreate.model_validate(json.loads(line))
+                except json.JSONDecodeError as e:
+                    yield BulkItem(name, error=f"JSONとして読めません: {e.msg}")
+                    continue
+                except ValidationError as e:
+                    yield BulkItem(name, error="; ".join(
+                        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                    ))
+                    continue
+                content = record.content.strip()
+                if not content:
+                    yield BulkItem(name, error="本文が空です")
+                    continue
+                yield BulkItem(name, title=record.title, content=content)
+        except UnicodeDecodeError:
+            yield BulkItem(filename, error="UTF-8でデコードできません")
+
+
+def _iter_archive(path: Path, filename: str, pdf_extractor: PdfExtractor, max_item_bytes: int,
+                  spool_dir: Path, budget: Optional[BulkBudget] = None) -> Iterator[BulkItem]:
+    """ZIPの各ファイルを1ドキュメントとして読む（展開は1ファイルずつ、上限を超えたら打ち切る）"""
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        yield BulkItem(filename, error="ZIPファイルとして読めません")
+        return
+
+    with archive:
+        for info in archive.infolist():
+            parts = PurePosixPath(info.filename).parts
+            if info.is_dir() or parts[0] == '__MACOSX' or parts[-1].startswith('.'):
+                continue
+            name = f"{filename}/{info.filename}"
+            if info.file_size > max_item_bytes:
+                yield BulkItem(name, error=f"ファイルが{max_item_bytes}バイトを超えています")
+                continue
+
+            entry_path = spool_dir / f"{path.stem}.entry{PurePosixPath(info.filename).suffix.lower()}"
+            try:
+                # ヘッダーのサイズは偽れるので、展開しながら数える
+                size = 0
+                with archive.open(info) as src, open(entry_path, 'wb') as dst:
+                    while True:
+                        block = src.read(BLOCK_SIZE)
+                        if not block:
+                            break
+                        size += len(block)
+                        if budget is not None:
+                            budget.add_bytes(len(block))
+                        if size > max_item_bytes:
+                            break
+                        dst.write(block)
+                if size > max_item_bytes:
+                    yield BulkItem(name, error=f"ファイルが{max_item_bytes}バイトを超えています")
+                    continue
+                item = _read_text(entry_path, info.filename, None, pdf_extractor, max_item_bytes)
+                item.name = name
+                yield item
+            except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+                # 壊れたエントリ・暗号化・未対応の圧縮方式
+                yield BulkItem(name, error=f"展開に失敗しました: {str(e)}")
+            finally:
+                entry_path.unlink(missing_ok=True)
+
+
+def iter_bulk_items(path: Path, filename: str, content_type: Optional[str], pdf_extractor: PdfExtractor,
+                    max_item_bytes: int, budget: Optional[BulkBudget] = None) -> Iterator[BulkItem]:
+    """
+    一時保存したファイルから取り込む項目を読む
+
+    ZIP（.zip）は中の各ファイル、NDJSON（.ndjson / .jsonl）は各行、それ以外はファイル全体を1件とする。
+    budget を渡すと、項目を読むごとに件数と展開後のバイト数を数え、上限を超えたら BulkLimitError を送出する
+    """
+    kind = _kind(filename, content_type)
+    if kind == "archive":
+        items = _iter_archive(path, filename, pdf_extractor, max_item_bytes, path.parent, budget)
+    else:
+        if budget is not None:
+            budget.add_bytes(path.stat().st_size)
+        if kind == "ndjson":
+            items = _iter_ndjson(path, filename)
+        else:
+            items = iter([_read_text(path, filename, content_type, pdf_extractor, max_item_bytes)])
+    for item in items:
+        if budget is not None:
+            budget.add_item()
+        yield item
+
+
+def _result(item: BulkItem, status: str, document_id: Optional[int] = None, chunks_indexed: int = 0,
+            chunks_deduplicated: int = 0, chunks_failed: int = 0, error: Optional[str] = None) -> dict:
+    return {
+        'name': item.name,
+        'status': status,
+        'document_id': document_id,
+        'chunks_indexed': chunks_indexed,
+        'chunks_deduplicated': chunks_deduplicated,
+        'chunks_failed': chunks_failed,
+        'error': error,
+    }
+
+
+async def import_items(
+    db,
+    user_id: int,
+    items: List[BulkItem],
+    embedder,
+    vector_store,
+    max_length: int = 800,
+    overlap: int = 100,
+    max_tokens: Optional[int] = None,
+    dedup_max_distance: Optional[int] = None,
+    max_documents: Optional[int] = None,
+) -> List[dict]:
+    """
+    項目をまとめて取り込み、入力順の結果を返す
+
+    全チャンクを1回の一括埋め込みで埋め込み、1件もチャンクを埋め込めなかった項目はドキュメントを作らない。
+    ほぼ同じチャンクが既存のインデックスか、同じ回の先の項目にあれば、取り込みパイプラインと同じく埋め込まずに参照にする。
+    ドキュメントの行はまとめてINSERTし、チャンクはベクトルストアへ1回で追加してからコミットする
+
+    Args:
+        db: リクエストのDBセッション
+        embedder: BatchEmbedder
+        vector_store: ユーザーの VectorStore
+        dedup_max_distance: ほぼ同じとみなすSimHashのハミング距離（Noneなら参照にしない）
+        max_documents: ユーザーごとのドキュメント数の上限（Noneなら制限しない）。
+            読み取れた項目に入力順に残りの枠を割り当て、枠を超えた項目は失敗にする
+            （埋め込みに失敗してドキュメントを作らなかった項目の枠はほかの項目に回さない）
+    """
+    remaining = None
+    if max_documents is not None:
+        remaining = max_documents - db.query(Document).filter(Document.user_id == user_id).count()
+    results: List[Optional[dict]] = [None] * len(items)
+    pending = []
+    for position, item in enumerate(items):
+        if item.error is not None:
+            results[position] = _result(item, STATUS_FAILED, error=item.error)
+        elif remaining is not None and len(pending) >= remaining:
+            results[position] = _result(
+                item, STATUS_FAILED, error=f"ドキュメント数の上限（{max_documents}件）に達しています"
+            )
+        else:
+            pending.append(position)
+
+    chunk_lists = await asyncio.to_thread(
+        lambda: [chunk_text(items[position].content, max_length, overlap, max_tokens) for position in pending]
+    )
+    texts = [chunk.text for chunks in chunk_lists for chunk in chunks]
+    fingerprints = await asyncio.to_thread(simhashes, texts)
+    matches = await asyncio.to_thread(find_duplicates, vector_store, fingerprints, dedup_max_distance)
+    # 埋め込むのはほぼ同じチャンクがないものだけ（embedded は texts 上の位置で引けるように並べ直す）
+    unique = matches.unique
+    result = await embedder.embed([texts[i] for i in unique.tolist()])
+    succeeded = np.zeros(len(texts), dtype=bool)
+    succeeded[unique] = result.succeeded
+    embeddings = np.zeros((len(texts), vector_store.dimension), dtype=np.float32)
+    indices, unique_embeddings = result.successful()
+    embeddings[unique[indices]] = unique_embeddings
+    errors = {int(unique[i]): error for i, error in result.errors.items()}
+
+    # 項目ごとのチャンクの範囲（texts 上の位置）
+    imported = []
+    start = 0
+    for position, chunks in zip(pending, chunk_lists):
+        end = start + len(chunks)
+        to_embed = unique[(unique >= start) & (unique < end)]
+        if len(to_embed) > 0 and not succeeded[to_embed].any():
+            error = errors.get(int(to_embed[0]), "埋め込みに失敗しました")
+            results[position] = _result(items[position], STATUS_FAILED, error=f"全チャンクの埋め込みに失敗しました: {error}")
+        else:
+            imported.append((position, chunks, start))
+        start = end
+
+    if not imported:
+        return results
+
+    document_ids = []
+    try:
+        # 1回のINSERTでまとめて登録し、採番されたIDを入力順に受け取る
+        document_ids = list(db.scalars(
+            insert(Document).returning(Document.id, sort_by_parameter_order=True),
+            [
+                {'user_id': user_id, 'title': items[position].title, 'content': items[position].content}
+                for position, _, _ in imported
+            ]
+        ))
+        # texts 上の位置ごとのメタデータ（取り込まない項目のチャンクは None）
+        metadatas: List[Optional[dict]] = [None] * len(texts)
+        for document_id, (position, chunks, start) in zip(document_ids, imported):
+            for offset, chunk in enumerate(chunks):
+                metadatas[start + offset] = {
+                    'document_id': document_id,
+                    'title': items[position].title,
+                    'content': chunk.text,
+                    'start': chunk.start,
+                    'end': chunk.end,
+                    'simhash': int(fingerprints[start + offset]),
+                }
+        included = np.array([metadata is not None for metadata in metadatas], dtype=bool)
+        # 取り込まない項目のチャンクは参照にしない（それを参照先にしていたチャンクは参照先なしとして埋め込む）
+        matches.existing[~included] = -1
+        matches.within[~included] = -1
+        positions = np.flatnonzero(succeeded & included)
+        missing = await asyncio.to_thread(
+            add_deduplicated, vector_store, matches, positions, embeddings[positions], metadatas
+        )
+
+        # 参照先がなかったチャンクは、ここで埋め込んで追加する
+        if len(missing) > 0:
+            missing_result = await embedder.embed([texts[i] for i in missing.tolist()])
+            missing_indices, missing_embeddings = missing_result.successful()
+            await asyncio.to_thread(
+                vector_store.add_documents, missing_embeddings, [metadatas[i] for i in missing[missing_indices].tolist()]
+            )
+            succeeded[missing[missing_indices]] = True
+            embeddings[missing[missing_indices]] = missing_embeddings
+        deduplicated = np.zeros(len(texts), dtype=bool)
+        deduplicated[matches.duplicates] = True
+        deduplicated[missing] = False
+
+        # 埋め込みに失敗したチャンクも行は作る（インデックスの再構築で埋め込む）。参照にしたチャンクは埋め込みなし
+        chunk_table_rows = []
+        for document_id, (position, chunks, start) in zip(document_ids, imported):
+            stored = np.flatnonzero(succeeded[start:start + len(chunks)])
+            chunk_table_rows.extend(chunk_rows(
+                user_id, document_id, metadatas[start:start + len(chunks)],
+                embeddings_by_hash([chunks[offset].text for offset in stored.tolist()], embeddings[start + stored]),
+                vector_store.embedding_model
+            ))
+        if chunk_table_rows:
+            db.execute(insert(DocumentChunk), chunk_table_rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        # ドキュメントのないチャンクを残さない
+        for document_id in document_ids:
+            await asyncio.to_thread(vector_store.remove_document, document_id)
+        raise
+
+    chunks_indexed = 0
+    chunks_deduplicated = 0
+    for document_id, (position, chunks, start) in zip(document_ids, imported):
+        indexed = int(np.count_nonzero(succeeded[start:start + len(chunks)]))
+        referenced = int(np.count_nonzero(deduplicated[start:start + len(chunks)]))
+        failed = len(chunks) - indexed - referenced
+        chunks_indexed += indexed
+        chunks_deduplicated += referenced
+        results[position] = _result(
+            items[position], STATUS_IMPORTED, document_id=document_id, chunks_indexed=indexed,
+            chunks_deduplicated=referenced, chunks_failed=failed,
+            error=f"{failed}件のチャンクの埋め込みに失敗しました" if failed else None
+        )
+    logger.info(
+        f"Bulk imported {len(imported)} of {len(items)} items for user {user_id} "
+        f"({chunks_indexed} chunks indexed, {chunks_deduplicated} deduplicated)"
+    )
+    return results
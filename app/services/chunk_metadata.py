@@ -0,0 +1,525 @@
+"""
+チャンクメタデータの列形式ストア
+ドキュメントIDはint配列、タイトルは重複排除した表、本文は連結したUTF-8バッファ + オフセットで持つ
+
+スナップショットの分はmmapで開き、以降の追加分はメモリ上の追記可能な列に持つ。
+どちらも必要な行だけをデコードして辞書として返す
+
+ファイル構成（スナップショットディレクトリ内）:
+    chunk_ids.npy      チャンクID（昇順, int64）
+    document_ids.npy   ドキュメントID（int64）
+    title_ids.npy      タイトル表の番号（int32）
+    titles.json        タイトル表（ドキュメント単位で重複排除）
+    text_offsets.npy   text.bin内の本文の開始位置（行数 + 1, int64）
+    text.bin           本文のUTF-8バイト列を連結したもの
+    spans.npy          ドキュメント本文上のチャンクの位置 (start, end)（行数 x 2, int64。不明なら -1）
+    simhashes.npy      本文のSimHash（64ビットをint64として保存。不明なら 0）
+    references.json    重複として埋め込みを省いた箇所 [[チャンクID, ドキュメントID, start, end], ...]
+"""
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+CHUNK_IDS_FILE = "chunk_ids.npy"
+DOCUMENT_IDS_FILE = "document_ids.npy"
+TITLE_IDS_FILE = "title_ids.npy"
+TITLES_FILE = "titles.json"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+TEXT_FILE = "text.bin"
+SPANS_FILE = "spans.npy"
+SIMHASHES_FILE = "simhashes.npy"
+REFERENCES_FILE = "references.json"
+
+_INITIAL_CAPACITY = 64
+
+
+class _ChunkSegment:
+    """列形式のチャンクテーブルの共通部分（行番号でアクセス）"""
+
+    chunk_ids: np.ndarray
+    document_ids: np.ndarray
+    title_ids: np.ndarray
+    text_offsets: np.ndarray
+    spans: np.ndarray
+    simhashes: np.ndarray
+    titles: List[str]
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def _text_slice(self, start: int, end: int) -> bytes:
+        raise NotImplementedError
+
+    def row_of(self, chunk_id: int) -> Optional[int]:
+        """チャンクIDの行番号（チャンクIDは昇順なので二分探索）"""
+        row = int(np.searchsorted(self.chunk_ids, chunk_id))
+        if row < len(self.chunk_ids) and self.chunk_ids[row] == chunk_id:
+            return row
+        return None
+
+    def rows_of(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """複数のチャンクIDの行番号（このセグメントにないIDは除外）"""
+        if len(self.chunk_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.searchsorted(self.chunk_ids, chunk_ids)
+        rows = np.minimum(rows, len(self.chunk_ids) - 1)
+        return rows[self.chunk_ids[rows] == chunk_ids]
+
+    def content_bytes(self, row: int) -> bytes:
+        return self._text_slice(int(self.text_offsets[row]), int(self.text_offsets[row + 1]))
+
+    def get_row(self, row: int) -> dict:
+        """1行分だけデコードしてメタデータ辞書を返す"""
+        start, end = (int(value) for value in self.spans[row])
+        return {
+            'document_id': int(self.document_ids[row]),
+            'title': self.titles[self.title_ids[row]],
+            'content': self.content_bytes(row).decode('utf-8'),
+            'start': start if start >= 0 else None,
+            'end': end if end >= 0 else None,
+        }
+
+
+class MappedChunkTable(_ChunkSegment):
+    """スナップショットのチャンクメタデータを読み取り専用でmmapしたテーブル"""
+
+    def __init__(self, directory: Path):
+        directory = Path(directory)
+        self.chunk_ids = np.load(directory / CHUNK_IDS_FILE, mmap_mode='r')
+        self.document_ids = np.load(directory / DOCUMENT_IDS_FILE, mmap_mode='r')
+        self.title_ids = np.load(directory / TITLE_IDS_FILE, mmap_mode='r')
+        self.text_offsets = np.load(directory / TEXT_OFFSETS_FILE, mmap_mode='r')
+        spans_path = directory / SPANS_FILE
+        if spans_path.exists():
+            self.spans = np.load(spans_path, mmap_mode='r')
+        else:
+            # 位置を持つ前のスナップショット
+            self.spans = np.full((len(self.chunk_ids), 2), -1, dtype=np.int64)
+        simhashes_path = directory / SIMHASHES_FILE
+        if simhashes_path.exists():
+            self.simhashes = np.load(simhashes_path, mmap_mode='r')
+        else:
+            self.simhashes = np.zeros(len(self.chunk_ids), dtype=np.int64)
+        references_path = directory / REFERENCES_FILE
+        self.references: List[list] = []
+        if references_path.exists():
+            with open(references_path, encoding='utf-8') as f:
+                self.references = json.load(f)
+        with open(directory / TITLES_FILE, encoding='utf-8') as f:
+            self.titles = json.load(f)
+
+        text_path = directory / TEXT_FILE
+        if text_path.stat().st_size > 0:
+            self.text = np.memmap(text_path, dtype=np.uint8, mode='r')
+        else:
+            # 空ファイルはmmapできない
+            self.text = np.zeros(0, dtype=np.uint8)
+
+    def _text_slice(self, start: int, end: int) -> bytes:
+        return self.text[start:end].tobytes()
+
+    def nbytes(self) -> int:
+        # mmap部分はページキャッシュでプロセス間共有されるのでタイトル表だけ数える
+        return sum(len(title) for title in self.titles) * 2
+
+
+class ChunkColumns(_ChunkSegment):
+    """メモリ上の追記可能な列形式チャンクテーブル"""
+
+    def __init__(self):
+        self._size = 0
+        self._chunk_ids = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self._document_ids = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self._title_ids = np.zeros(_INITIAL_CAPACITY, dtype=np.int32)
+        self._text_offsets = np.zeros(_INITIAL_CAPACITY + 1, dtype=np.int64)
+        self._spans = np.zeros((_INITIAL_CAPACITY, 2), dtype=np.int64)
+        self._simhashes = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+        self.text = bytearray()
+        self.titles: List[str] = []
+        self._title_lookup: Dict[str, int] = {}
+
+    # 有効な行だけのビュー（追記で配列が作り直されても既存行は書き換えない）
+    @property
+    def chunk_ids(self) -> np.ndarray:
+        return self._chunk_ids[:self._size]
+
+    @property
+    def document_ids(self) -> np.ndarray:
+        return self._document_ids[:self._size]
+
+    @property
+    def title_ids(self) -> np.ndarray:
+        return self._title_ids[:self._size]
+
+    @property
+    def text_offsets(self) -> np.ndarray:
+        return self._text_offsets[:self._size + 1]
+
+    @property
+    def spans(self) -> np.ndarray:
+        return self._spans[:self._size]
+
+    @property
+    def simhashes(self) -> np.ndarray:
+        return self._simhashes[:self._size]
+
+    def _text_slice(self, start: int, end: int) -> bytes:
+        return bytes(self.text[start:end])
+
+    def _reserve(self, count: int):
+        needed = self._size + count
+        capacity = len(self._chunk_ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ('_chunk_ids', '_document_ids', '_title_ids', '_spans', '_simhashes'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+        offsets = np.zeros(capacity + 1, dtype=np.int64)
+        offsets[:self._size + 1] = self._text_offsets[:self._size + 1]
+        self._text_offsets = offsets
+
+    def _intern_title(self, title: str) -> int:
+        title_id = self._title_lookup.get(title)
+        if title_id is None:
+            title_id = len(self.titles)
+            self.titles.append(title)
+            self._title_lookup[title] = title_id
+        return title_id
+
+    def extend(self, chunk_ids: np.ndarray, document_ids: np.ndarray, titles: List[str], contents: List[bytes],
+               spans: Optional[np.ndarray] = None, simhashes: Optional[np.ndarray] = None):
+        """
+        行をまとめて追記
+
+        chunk_ids は既存の行より大きい昇順であること。spans はドキュメント本文上の (start, end)（不明なら -1）、
+        simhashes は本文のSimHash（不明なら 0）
+        """
+        count = len(chunk_ids)
+        if count == 0:
+            return
+        self._reserve(count)
+        start, end = self._size, self._size + count
+
+        self._chunk_ids[start:end] = chunk_ids
+        self._document_ids[start:end] = document_ids
+        self._title_ids[start:end] = [self._intern_title(title) for title in titles]
+        self._spans[start:end] = -1 if spans is None else spans
+        self._simhashes[start:end] = 0 if simhashes is None else simhashes
+        lengths = np.fromiter((len(content) for content in contents), dtype=np.int64, count=count)
+        self._text_offsets[start + 1:end + 1] = self._text_offsets[start] + np.cumsum(lengths)
+        for content in contents:
+            self.text += content
+        self._size = end
+
+    def nbytes(self) -> int:
+        arrays = (self._chunk_ids.nbytes + self._document_ids.nbytes + self._title_ids.nbytes
+                  + self._text_offsets.nbytes + self._spans.nbytes + self._simhashes.nbytes)
+        titles = sum(len(title) for title in self.titles) * 2
+        return arrays + len(self.text) + titles
+
+
+def _position(value: Optional[int]) -> int:
+    return -1 if value is None else value
+
+
+class ChunkMetadata:
+    """
+    チャンクID → メタデータの対応
+
+    セグメント（スナップショットのmmap + メモリ上の追記分）ごとに生存フラグを持ち、
+    ドキュメントID → 行範囲の索引でドキュメント単位の操作を走査なしで行う。
+    列は書き換えないので、既存チャンクのタイトル・位置の変更は上書き分として別に持ち、
+    スナップショットを書く時に反映する
+    """
+
+    def __init__(self, base: Optional[MappedChunkTable] = None):
+        self.segments: List[_ChunkSegment] = []
+        if base is not None:
+            self.segments.append(base)
+        self.tail = ChunkColumns()
+        self.segments.append(self.tail)
+
+        # セグメントごとの生存フラグ（削除が起きるまでは作らない）
+        self._alive: List[Optional[np.ndarray]] = [None] * len(self.segments)
+        self._dead = 0
+        # チャンクID → 上書きするフィールド（title / start / end）
+        self._updates: Dict[int, dict] = {}
+        # チャンクID → 重複として埋め込みを省いた箇所 [(ドキュメントID, start, end), ...]
+        self._references: Dict[int, List[Tuple[int, int, int]]] = {}
+        if base is not None:
+            for chunk_id, *reference in base.references:
+                self._references.setdefault(chunk_id, []).append(tuple(reference))
+        # ドキュメントID → [(セグメント番号, 開始行, 終了行), ...]
+        self._doc_ranges: Dict[int, List[Tuple[int, int, int]]] = {}
+        for segment_no, segment in enumerate(self.segments):
+            self._index_rows(segment_no, 0, len(segment))
+
+    def _index_rows(self, segment_no: int, start: int, end: int):
+        """行範囲 [start, end) をドキュメントIDの連続区間ごとに索引へ登録"""
+        if start >= end:
+            return
+        document_ids = np.asarray(self.segments[segment_no].document_ids[start:end])
+        # ドキュメントIDが切り替わる位置で区切る
+        boundaries = np.flatnonzero(np.diff(document_ids)) + 1
+        run_starts = np.concatenate(([0], boundaries))
+        run_ends = np.concatenate((boundaries, [len(document_ids)]))
+        for run_start, run_end in zip(run_starts.tolist(), run_ends.tolist()):
+            document_id = int(document_ids[run_start])
+            ranges = self._doc_ranges.setdefault(document_id, [])
+            if ranges and ranges[-1][0] == segment_no and ranges[-1][2] == start + run_start:
+                # 直前の区間と連続していれば結合
+                ranges[-1] = (segment_no, ranges[-1][1], start + run_end)
+            else:
+                ranges.append((segment_no, start + run_start, start + run_end))
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments) - self._dead
+
+    def _is_alive(self, segment_no: int, row: int) -> bool:
+        alive = self._alive[segment_no]
+        return alive is None or bool(alive[row])
+
+    def _alive_mask(self, segment_no: int) -> np.ndarray:
+        segment = self.segments[segment_no]
+        alive = self._alive[segment_no]
+        if alive is None:
+            alive = np.ones(len(segment), dtype=bool)
+        elif len(alive) < len(segment):
+            alive = np.concatenate((alive, np.ones(len(segment) - len(alive), dtype=bool)))
+        self._alive[segment_no] = alive
+        return alive
+
+    def get(self, chunk_id: int) -> Optional[dict]:
+        for segment_no, segment in enumerate(self.segments):
+            row = segment.row_of(chunk_id)
+            if row is not None:
+                if not self._is_alive(segment_no, row):
+                    return None
+                metadata = segment.get_row(row)
+                if chunk_id in self._updates:
+                    metadata.update(self._updates[chunk_id])
+                return metadata
+        return None
+
+    def add_batch(self, chunk_ids: np.ndarray, metadatas: List[dict]):
+        """チャンクをまとめて追記（chunk_ids は既存より大きい昇順）"""
+        start = len(self.tail)
+        self.tail.extend(
+            chunk_ids,
+            np.fromiter((meta['document_id'] for meta in metadatas), dtype=np.int64, count=len(metadatas)),
+            [meta['title'] for meta in metadatas],
+            [meta['content'].encode('utf-8') for meta in metadatas],
+            np.array(
+                [[_position(meta.get('start')), _position(meta.get('end'))] for meta in metadatas],
+                dtype=np.int64
+            ).reshape(-1, 2),
+            np.fromiter((meta.get('simhash', 0) for meta in metadatas), dtype=np.int64, count=len(metadatas)),
+        )
+        tail_no = len(self.segments) - 1
+        if self._alive[tail_no] is not None:
+            self._alive_mask(tail_no)
+        self._index_rows(tail_no, start, len(self.tail))
+
+    def update(self, chunk_ids: np.ndarray, changes: List[dict]):
+        """既存チャンクのタイトル・位置を変更（本文と埋め込みは変わらないもの）"""
+        for chunk_id, fields in zip(np.asarray(chunk_ids).tolist(), changes):
+            self._updates.setdefault(chunk_id, {}).update(fields)
+
+    def add_references(self, chunk_ids: np.ndarray, references: List[Tuple[int, int, int]]):
+        """チャンクと同じ内容のため埋め込みを省いた箇所 (ドキュメントID, start, end) を記録"""
+        for chunk_id, reference in zip(np.asarray(chunk_ids).tolist(), references):
+            self._references.setdefault(chunk_id, []).append(tuple(reference))
+
+    def references_of(self, chunk_ids: np.ndarray) -> List[Tuple[int, int, int]]:
+        """チャンクを参照している箇所の一覧"""
+        found = []
+        for chunk_id in np.asarray(chunk_ids).tolist():
+            found.extend(self._references.get(chunk_id, ()))
+        return found
+
+    def has_references_from(self, document_id: int) -> bool:
+        return any(reference[0] == document_id for refs in self._references.values() for reference in refs)
+
+    def drop_references(self, document_id: int):
+        """ドキュメントからの参照を外す（ドキュメントの削除・更新時）"""
+        for chunk_id in list(self._references):
+            kept = [reference for reference in self._references[chunk_id] if reference[0] != document_id]
+            if kept:
+                self._references[chunk_id] = kept
+            else:
+                del self._references[chunk_id]
+
+    def simhash_rows(self) -> Tuple[np.ndarray, np.ndarray]:
+        """SimHashを持つ（削除されていない）チャンクの (チャンクID, SimHash)"""
+        ids, simhashes = [], []
+        for segment_no, segment in enumerate(self.segments):
+            if len(segment) == 0:
+                continue
+            known = np.asarray(segment.simhashes) != 0
+            alive = self._alive[segment_no]
+            if alive is not None:
+                known &= alive[:len(segment)]
+            ids.append(np.asarray(segment.chunk_ids)[known])
+            simhashes.append(np.asarray(segment.simhashes)[known])
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(ids), np.concatenate(simhashes)
+
+    def remove_ids(self, chunk_ids: np.ndarray) -> int:
+        """チャンクIDの一覧を削除済みにする。削除した件数を返す"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        removed = 0
+        for segment_no, segment in enumerate(self.segments):
+            rows = segment.rows_of(chunk_ids)
+            if len(rows) == 0:
+                continue
+            alive = self._alive_mask(segment_no)
+            removed += int(np.count_nonzero(alive[rows]))
+            alive[rows] = False
+        self._dead += removed
+        if self._updates or self._references:
+            for chunk_id in chunk_ids.tolist():
+                self._updates.pop(chunk_id, None)
+                self._references.pop(chunk_id, None)
+        return removed
+
+    def contains(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """各チャンクIDが（削除されずに）存在するかのフラグ"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        result = np.zeros(len(chunk_ids), dtype=bool)
+        for segment_no, segment in enumerate(self.segments):
+            if len(segment) == 0 or len(chunk_ids) == 0:
+                continue
+            rows = np.minimum(np.searchsorted(segment.chunk_ids, chunk_ids), len(segment) - 1)
+            found = segment.chunk_ids[rows] == chunk_ids
+            alive = self._alive[segment_no]
+            if alive is not None:
+                found &= alive[rows]
+            result |= found
+        return result
+
+    def chunk_ids_for_document(self, document_id: int) -> np.ndarray:
+        """ドキュメントに属する（削除されていない）チャンクIDの一覧"""
+        parts = []
+        for segment_no, start, end in self._doc_ranges.get(document_id, []):
+            chunk_ids = self.segments[segment_no].chunk_ids[start:end]
+            alive = self._alive[segment_no]
+            if alive is not None:
+                chunk_ids = chunk_ids[alive[start:end]]
+            parts.append(np.asarray(chunk_ids))
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(parts)
+
+    def forget_document(self, document_id: int):
+        """削除済みドキュメントの索引エントリを外す"""
+        self._doc_ranges.pop(document_id, None)
+
+    def memory_usage(self) -> int:
+        """ヒープ上の概算メモリ使用量（バイト）"""
+        alive = sum(mask.nbytes for mask in self._alive if mask is not None)
+        ranges = sum(len(ranges) for ranges in self._doc_ranges.values()) * 100
+        updates = len(self._updates) * 200 + sum(len(refs) for refs in self._references.values()) * 100
+        return sum(segment.nbytes() for segment in self.segments) + alive + ranges + updates
+
+    def frozen(self) -> "ChunkMetadata":
+        """
+        スナップショット書き込み用に現在の状態を固定したコピー
+
+        追記分の列はビューを共有し（既存行は書き換えないため）、本文バッファと生存フラグだけコピーする
+        """
+        copy = ChunkMetadata.__new__(ChunkMetadata)
+        tail = ChunkColumns()
+        tail._size = len(self.tail)
+        tail._chunk_ids = self.tail.chunk_ids
+        tail._document_ids = self.tail.document_ids
+        tail._title_ids = self.tail.title_ids
+        tail._text_offsets = self.tail.text_offsets
+        tail._spans = self.tail.spans
+        tail._simhashes = self.tail.simhashes
+        tail.text = bytearray(self.tail.text)
+        tail.titles = list(self.tail.titles)
+        copy.segments = self.segments[:-1] + [tail]
+        copy.tail = tail
+        copy._alive = [None if mask is None else mask.copy() for mask in self._alive]
+        copy._dead = self._dead
+        copy._updates = {chunk_id: dict(fields) for chunk_id, fields in self._updates.items()}
+        copy._references = {chunk_id: list(refs) for chunk_id, refs in self._references.items()}
+        copy._doc_ranges = {}
+        return copy
+
+    def write(self, directory: Path):
+        """生存している行をmmap可能な形式でディレクトリに書き出す"""
+        directory = Path(directory)
+        chunk_ids, document_ids, title_ids, spans, simhashes, lengths = [], [], [], [], [], []
+        titles: Dict[str, int] = {}
+
+        with open(directory / TEXT_FILE, 'wb') as text_file:
+            for segment_no, segment in enumerate(self.segments):
+                if len(segment) == 0:
+                    continue
+                alive = self._alive[segment_no]
+                rows = np.arange(len(segment)) if alive is None else np.flatnonzero(alive[:len(segment)])
+                if len(rows) == 0:
+                    continue
+
+                chunk_ids.append(np.asarray(segment.chunk_ids)[rows])
+                document_ids.append(np.asarray(segment.document_ids)[rows])
+                # セグメントごとのタイトル表を統合後の番号に振り直す
+                remap = np.array(
+                    [titles.setdefault(title, len(titles)) for title in segment.titles],
+                    dtype=np.int32
+                )
+                title_ids.append(remap[np.asarray(segment.title_ids)[rows]])
+                spans.append(np.asarray(segment.spans)[rows])
+                simhashes.append(np.asarray(segment.simhashes)[rows])
+
+                offsets = np.asarray(segment.text_offsets)
+                lengths.append(offsets[rows + 1] - offsets[rows])
+                if alive is None:
+                    # 削除がなければ本文バッファをそのまま書き出す
+                    text_file.write(memoryview(segment.text)[int(offsets[0]):int(offsets[len(segment)])])
+                else:
+                    for row in rows.tolist():
+                        text_file.write(segment.content_bytes(row))
+
+        def concat(parts, dtype):
+            return np.concatenate(parts).astype(dtype) if parts else np.zeros(0, dtype=dtype)
+
+        chunk_ids = concat(chunk_ids, np.int64)
+        title_ids = concat(title_ids, np.int32)
+        spans = concat(spans, np.int64).reshape(-1, 2)
+        # タイトル・位置の上書き分を列に反映する
+        for chunk_id, fields in self._updates.items():
+            row = int(np.searchsorted(chunk_ids, chunk_id))
+            if row == len(chunk_ids) or chunk_ids[row] != chunk_id:
+                continue
+            if 'title' in fields:
+                title_ids[row] = titles.setdefault(fields['title'], len(titles))
+            if 'start' in fields:
+                spans[row, 0] = _position(fields['start'])
+            if 'end' in fields:
+                spans[row, 1] = _position(fields['end'])
+
+        np.save(directory / CHUNK_IDS_FILE, chunk_ids)
+        np.save(directory / DOCUMENT_IDS_FILE, concat(document_ids, np.int64))
+        np.save(directory / TITLE_IDS_FILE, title_ids)
+        np.save(directory / SPANS_FILE, spans)
+        np.save(directory / SIMHASHES_FILE, concat(simhashes, np.int64))
+        with open(directory / REFERENCES_FILE, 'w', encoding='utf-8') as f:
+            json.dump([
+                [chunk_id, *reference]
+                for chunk_id, refs in sorted(self._references.items()) for reference in refs
+            ], f)
+        np.save(
+            directory / TEXT_OFFSETS_FILE,
+            np.concatenate(([0], np.cumsum(concat(lengths, np.int64)))).astype(np.int64)
+        )
+        with open(directory / TITLES_FILE, 'w', encoding='utf-8') as f:
+            json.dump(list(titles), f, ensure_ascii=False)
@@ -0,0 +1,120 @@
+"""
+チャンクのDB保存（document_chunks）
+ベクトルストアに追加したチャンクの本文・位置・埋め込みをDBにも書き込み、
+ベクトルストアのファイルがなくてもDBからインデックスを作り直せるようにする
+
+埋め込みは float16 のバイト列で保存する（float32の半分の大きさ。検索の順位にはほぼ影響しない）
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import bindparam, insert, update
+
+from app.models.document_chunk import DocumentChunk
+from app.services.chunking import chunk_hash
+
+EMBEDDING_DTYPE = np.float16
+
+
+def encode_embedding(vector: np.ndarray) -> bytes:
+    """埋め込みを保存用のバイト列にする"""
+    return np.asarray(vector, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embeddings(blobs: List[bytes], dimension: int) -> np.ndarray:
+    """保存したバイト列をまとめて float32 の行列に戻す"""
+    if not blobs:
+        return np.zeros((0, dimension), dtype=np.float32)
+    return np.frombuffer(b"".join(blobs), dtype=EMBEDDING_DTYPE).reshape(len(blobs), dimension).astype(np.float32)
+
+
+def embeddings_by_hash(texts: List[str], embeddings: np.ndarray) -> Dict[str, np.ndarray]:
+    """本文のハッシュ → 埋め込み"""
+    return {chunk_hash(text): embedding for text, embedding in zip(texts, embeddings)}
+
+
+def chunk_rows(user_id: int, document_id: int, metadatas: List[dict], embeddings: Dict[str, np.ndarray],
+               model: Optional[str], stored: Optional[Dict[str, bytes]] = None,
+               first_position: int = 0) -> List[dict]:
+    """
+    ドキュメントのチャンクを document_chunks に挿入する行にする
+
+    Args:
+        metadatas: ベクトルストアに渡すものと同じ形のメタデータ（content / start / end / simhash）をチャンクの順に
+        embeddings: 本文のハッシュ → 埋め込み（ない本文は stored から引き継ぎ、それもなければ NULL）
+        model: 埋め込みを作ったモデル
+        stored: 本文のハッシュ → 保存済みの埋め込みのバイト列
+        first_position: 最初のチャンクの位置（途中のチャンクから書き足す時）
+    """
+    stored = stored or {}
+    rows = []
+    for position, metadata in enumerate(metadatas, first_position):
+        content_hash = chunk_hash(metadata['content'])
+        embedding = embeddings.get(content_hash)
+        blob = encode_embedding(embedding) if embedding is not None else stored.get(content_hash)
+        rows.append({
+            'user_id': user_id,
+            'document_id': document_id,
+            'position': position,
+            'content': metadata['content'],
+            'start_offset': metadata['start'],
+            'end_offset': metadata['end'],
+            'content_hash': content_hash,
+            'simhash': metadata.get('simhash', 0),
+            'embedding': blob,
+            'embedding_model': model if blob is not None else None,
+        })
+    return rows
+
+
+def save_document_chunks(db, user_id: int, document_id: int, metadatas: List[dict],
+                         embeddings: Dict[str, np.ndarray], model: Optional[str],
+                         first_position: int = 0, last: bool = True):
+    """
+    ドキュメントのチャンクの行を書き直す（コミットは呼び出し元）
+
+    今回埋め込まなかった本文は、同じドキュメントの既存の行に同じモデルの埋め込みがあれば引き継ぐ。
+    first_position からのチャンクだけを書き直す時は、その範囲（last なら以降すべて）の行だけを置き換える
+    """
+    rows_in_range = db.query(DocumentChunk).filter(
+        DocumentChunk.document_id == document_id, DocumentChunk.position >= first_position
+    )
+    if not last:
+        rows_in_range = rows_in_range.filter(DocumentChunk.position < first_position + len(metadatas))
+    stored = dict(
+        rows_in_range.filter(DocumentChunk.embedding.isnot(None), DocumentChunk.embedding_model == model)
+        .with_entities(DocumentChunk.content_hash, DocumentChunk.embedding)
+    )
+    rows_in_range.delete(synchronize_session=False)
+    rows = chunk_rows(user_id, document_id, metadatas, embeddings, model, stored, first_position)
+    if rows:
+        db.execute(insert(DocumentChunk), rows)
+
+
+def save_restored_embeddings(db, metadatas: List[dict], embeddings: np.ndarray, model: Optional[str]):
+    """
+    参照先が削除されて埋め込み直したチャンクの埋め込みを、参照していたドキュメントの行に書く（コミットは呼び出し元）
+
+    参照にしていたチャンクの行は埋め込みなしで保存してあるので、ドキュメントIDと位置（start / end）で引いて更新する
+    """
+    if not metadatas:
+        return
+    # 主キーでなく位置で引くので、ORMの一括UPDATEではなくCoreの executemany で実行する
+    db.connection().execute(
+        update(DocumentChunk)
+        .where(
+            DocumentChunk.document_id == bindparam('b_document_id'),
+            DocumentChunk.start_offset == bindparam('b_start'),
+            DocumentChunk.end_offset == bindparam('b_end'),
+        )
+        .values(embedding=bindparam('b_embedding'), embedding_model=model),
+        [
+            {
+                'b_document_id': metadata['document_id'],
+                'b_start': metadata['start'],
+                'b_end': metadata['end'],
+                'b_embedding': encode_embedding(embedding),
+            }
+            for metadata, embedding in zip(metadatas, embeddings)
+        ]
+    )
@@ -0,0 +1,248 @@
+"""
+テキストのチャンク分割
+段落で区切り、文末で切れるように max_length 文字以内（指定があれば max_tokens トークン以内）のチャンクにまとめる
+
+テキストを断片（PDFのページ、ファイルのブロックなど）ごとに受け取り、確定したチャンクから順に返す。
+文やチャンクは元のテキスト上の文字オフセットで扱い、チャンクを返す時に1回だけ切り出す。
+各チャンクは元のテキスト上の位置 (start, end) を持つので、検索結果から本文の該当箇所を指せる
+
+文末として扱うもの:
+    - 日本語・中国語の句点など（。！？ と閉じ括弧）
+    - 英語などの . ! ? （後ろに空白が続く場合）
+    - ヒンディー語のダンダ（। ॥）、アラビア語・ウルドゥー語の疑問符・終止符（؟ ۔）
+    - 改行
+"""
+import hashlib
+import re
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, Optional
+
+# 空行は段落の区切り、それ以外は文の区切り
+_BOUNDARY = re.compile(
+    r'(?P<paragraph>\n[^\S\n]*\n\s*)'
+    r'|[。！？｡]+[」』）〕】〉》"\'”’)]*'
+    r'|[.!?]+["\'”’)\]]*(?=\s)'
+    r'|[।॥؟۔]'
+    r'|\n'
+)
+# トークン数の見積もり用: CJKの文字は1文字1トークン、それ以外は単語と記号
+_CJK_CHARS = r'぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+_CJK = re.compile(f'[{_CJK_CHARS}]')
+_WORD = re.compile(f'[^\\W{_CJK_CHARS}]+|[^\\w\\s]')
+
+# 使い終わった部分がこれを超えたら手元のテキストを詰める
+_COMPACT_CHARS = 64 * 1024
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の見積もり（CJKは1文字1トークン、それ以外は4文字あたり約1トークン）"""
+    cjk = len(_CJK.findall(text))
+    other = sum((len(word) + 3) // 4 for word in _WORD.findall(text))
+    return cjk + other
+
+
+def chunk_hash(text: str) -> str:
+    """チャンク本文のハッシュ（本文が同じなら埋め込みも同じなので、再利用の判定に使う）"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class TextChunk:
+    """チャンク（text は元のテキストの [start, end) の範囲）"""
+
+    __slots__ = ('text', 'start', 'end', 'tokens')
+
+    def __init__(self, text: str, start: int, end: int, tokens: Optional[int] = None):
+        self.text = text
+        self.start = start
+        self.end = end
+        # max_tokens を指定した場合のみ数える
+        self.tokens = tokens
+
+    def __repr__(self) -> str:
+        return f"TextChunk(start={self.start}, end={self.end}, text={self.text[:20]!r})"
+
+
+class _Chunker:
+    """文の区間（元のテキスト上のオフセット）を受け取ってチャンクにまとめる"""
+
+    def __init__(self, max_length: int, overlap: int, max_tokens: Optional[int],
+                 count_tokens: Callable[[str], int]):
+        if max_length <= 0:
+            raise ValueError("max_length must be positive")
+        self.max_length = max_length
+        self.overlap = overlap
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+
+        # 受け取ったテキストのうち、まだ必要な部分とその開始オフセット
+        self.buffer = ""
+        self.buffer_start = 0
+        # まだ文として切り出していない部分の開始位置
+        self.pending_start = 0
+        # 現在のチャンクに入っている文の (start, end, tokens)
+        self.sentences = deque()
+        self.tokens = 0
+
+    def feed(self, piece: str):
+        """テキストの断片を追加（不要になった先頭部分はまとめて捨てる）"""
+        keep_from = self.sentences[0][0] if self.sentences else self.pending_start
+        consumed = keep_from - self.buffer_start
+        if consumed > _COMPACT_CHARS and consumed * 2 > len(self.buffer):
+            self.buffer = self.buffer[consumed:]
+            self.buffer_start = keep_from
+        self.buffer += piece
+
+    def _slice(self, start: int, end: int) -> str:
+        return self.buffer[start - self.buffer_start:end - self.buffer_start]
+
+    def _strip(self, start: int, end: int):
+        """区間の前後の空白を除いた区間（空白だけなら start == end）"""
+        buffer, offset = self.buffer, self.buffer_start
+        while start < end and buffer[start - offset].isspace():
+            start += 1
+        while end > start and buffer[end - 1 - offset].isspace():
+            end -= 1
+        return start, end
+
+    def _split_point(self, start: int, end: int, limit: int) -> int:
+        """長すぎる区間を limit 文字以内で区切る位置（できれば空白の直後）"""
+        cut = start + limit
+        if cut >= end:
+            return end
+        offset = self.buffer_start
+        space = max(self.buffer.rfind(' ', start - offset, cut - offset),
+                    self.buffer.rfind('\t', start - offset, cut - offset))
+        if space > start - offset:
+            return space + offset + 1
+        return cut
+
+    def sentence(self, start: int, end: int, partial: bool = False):
+        """
+        文を1つ追加（上限を超える文は区切ってから追加する）
+
+        partial=True は文末がまだ来ていない部分で、max_length 文字を超える間だけ区切って追加し、
+        残りの開始位置を返す（区切る位置は続きのテキストによらない）
+        """
+        if partial:
+            # 区切らない部分は先頭の空白も残す（続きの断片で段落の区切りになりうる）
+            if end - self._strip(start, end)[0] <= self.max_length:
+                return start
+            start = self._strip(start, end)[0]
+        else:
+            start, end = self._strip(start, end)
+        while start < end and (not partial or end - start > self.max_length):
+            stop = self._split_point(start, end, self.max_length)
+            tokens = None
+            if self.max_tokens:
+                tokens = self.count_tokens(self._slice(start, stop))
+                while tokens > self.max_tokens and stop - start > 1:
+                    # トークン数の割合で縮めてから空白の位置に合わせる
+                    limit = max(1, (stop - start) * self.max_tokens // tokens)
+                    stop = self._split_point(start, stop, min(limit, stop - start - 1))
+                    tokens = self.count_tokens(self._slice(start, stop))
+            yield from self._add(start, self._strip(start, stop)[1], tokens or 0)
+            if partial and end - self._strip(stop, end)[0] <= self.max_length:
+                return stop
+            start = self._strip(stop, end)[0]
+        return start
+
+    def _add(self, start: int, end: int, tokens: int) -> Iterator[TextChunk]:
+        if self.sentences and not self._fits(self.sentences[0][0], end, self.tokens + tokens):
+            yield self._emit()
+            self._keep_overlap()
+            # 重ねた文と合わせて上限を超えるなら、超えなくなるまで前から外す
+            while self.sentences and not self._fits(self.sentences[0][0], end, self.tokens + tokens):
+                self.tokens -= self.sentences.popleft()[2]
+        self.sentences.append((start, end, tokens))
+        self.tokens += tokens
+
+    def _fits(self, start: int, end: int, tokens: int) -> bool:
+        if end - start > self.max_length:
+            return False
+        return not self.max_tokens or tokens <= self.max_tokens
+
+    def _keep_overlap(self):
+        """末尾から overlap 文字に収まる文だけを次のチャンクの先頭に残す"""
+        end = self.sentences[-1][1]
+        kept = deque()
+        tokens = 0
+        while self.sentences and end - self.sentences[-1][0] <= self.overlap:
+            sentence = self.sentences.pop()
+            kept.appendleft(sentence)
+            tokens += sentence[2]
+        self.sentences = kept
+        self.tokens = tokens
+
+    def _emit(self) -> TextChunk:
+        start, end = self.sentences[0][0], self.sentences[-1][1]
+        return TextChunk(self._slice(start, end), start, end, self.tokens if self.max_tokens else None)
+
+    def end_paragraph(self) -> Iterator[TextChunk]:
+        """段落の終わり（チャンクは段落をまたがない）"""
+        if self.sentences:
+            yield self._emit()
+        self.sentences = deque()
+        self.tokens = 0
+
+    def scan(self, final: bool) -> Iterator[TextChunk]:
+        """手元のテキストから確定した文を切り出してチャンクにまとめる"""
+        buffer, offset = self.buffer, self.buffer_start
+        position = self.pending_start - offset
+        # 末尾の空白は続きの断片と合わせて空行（段落の区切り）になりうる
+        tail = len(buffer)
+        while not final and tail > position and buffer[tail - 1].isspace():
+            tail -= 1
+        for match in _BOUNDARY.finditer(buffer, position):
+            if match.end() >= tail and not final:
+                # 続きの断片で区切りが伸びる（閉じ括弧、空行など）かもしれない
+                break
+            if match.group('paragraph'):
+                yield from self.sentence(offset + position, offset + match.start())
+                yield from self.end_paragraph()
+            else:
+                yield from self.sentence(offset + position, offset + match.end())
+            position = match.end()
+
+        if final:
+            yield from self.sentence(offset + position, offset + len(buffer))
+            yield from self.end_paragraph()
+            position = len(buffer)
+        else:
+            # 文末の来ないまま長くなった部分は先に区切っておく（手元に残す量を抑える）
+            position = (yield from self.sentence(offset + position, offset + tail, partial=True)) - offset
+        self.pending_start = offset + position
+
+
+def iter_text_chunks(
+    pieces: Iterable[str],
+    max_length: int = 800,
+    overlap: int = 100,
+    max_tokens: Optional[int] = None,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+) -> Iterator[TextChunk]:
+    """
+    テキストの断片を順に受け取り、チャンクを (start, end) のオフセット付きで返す
+
+    オフセットは断片をつなげたテキスト上の位置。チャンクは段落をまたがず、
+    前のチャンクの末尾 overlap 文字に収まる文を次のチャンクの先頭に重ねる。
+    文末のないまま max_length 文字を超える文は空白の位置（なければ max_length 文字）で区切る
+
+    Args:
+        max_length: 1チャンクの最大文字数
+        overlap: 前のチャンクと重ねる最大文字数（文単位）
+        max_tokens: 1チャンクの最大トークン数（Noneなら数えない）
+        count_tokens: トークン数を数える関数（埋め込みモデルのトークナイザーなど）
+    """
+    chunker = _Chunker(max_length, overlap, max_tokens, count_tokens)
+    for piece in pieces:
+        if not piece:
+            continue
+        chunker.feed(piece)
+        yield from chunker.scan(final=False)
+    yield from chunker.scan(final=True)
+
+
+def chunk_text(text: str, max_length: int = 800, overlap: int = 100,
+               max_tokens: Optional[int] = None) -> List[TextChunk]:
+    """テキスト全体をチャンクに分割"""
+    return list(iter_text_chunks([text], max_length, overlap, max_tokens))
@@ -0,0 +1,240 @@
+"""
+ほぼ同じ内容のチャンクの検出（SimHash + LSH）
+同じマニュアルの版違いを何度もアップロードすると、ほぼ同じチャンクが増えて埋め込みの呼び出しと
+インデックスのメモリを無駄にし、検索の上位k件も同じ内容で埋まる。そこで埋め込みの前に
+ユーザーのインデックスにある既存チャンクと突き合わせ、ほぼ同じものは埋め込まずに既存チャンクを参照する
+
+- SimHash: 文字3-gramのハッシュの各ビットの多数決で作る64ビットの指紋（言語によらない）
+- LSH: 指紋を (max_distance + 1) 個の帯に分け、どれかの帯が一致するものだけをハミング距離で確かめる
+  （距離が max_distance 以下なら鳩の巣原理でどれかの帯は必ず一致する）
+
+同じ回に取り込むチャンク同士も突き合わせ、先に出てくるチャンクの参照にする
+（取り込みパイプラインと一括取り込みは find_duplicates / add_deduplicated を共有する）
+"""
+import asyncio
+import logging
+import unicodedata
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.models.document import Document
+
+logger = logging.getLogger(__name__)
+
+# これより短い本文はSimHashを作らない（0 = 不明）。短いと指紋がぶれやすく、見出しなどの誤検出も多い
+MIN_CHARS = 50
+
+_BITS = np.arange(64, dtype=np.uint64)
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+# 3-gramのハッシュの係数（奇数の定数）
+_P1, _P2, _P3 = np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(0x165667B19E3779F9)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64の仕上げ（ビットを全体に散らす）"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def simhash(text: str) -> int:
+    """
+    本文の64ビットSimHash（int64として返す。0は「不明」に使うので返さない）
+
+    NFKC正規化・小文字化・空白の連続を1つにしてから、文字3-gramごとのハッシュで多数決を取る
+    """
+    normalized = " ".join(unicodedata.normalize('NFKC', text).lower().split())
+    codes = np.frombuffer(normalized.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) >= 3:
+        grams = codes[:-2] * _P1 + codes[1:-1] * _P2 + codes[2:] * _P3
+    else:
+        grams = np.array([int(codes.sum()) if len(codes) else 0], dtype=np.uint64) * _P1
+    hashes = _mix(grams)
+    votes = ((hashes[:, None] >> _BITS) & np.uint64(1)).sum(axis=0) * 2
+    bits = votes > len(hashes)
+    value = int((bits.astype(np.uint64) << _BITS).sum() & _MASK64)
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value or 1
+
+
+def simhashes(texts: List[str], min_chars: int = MIN_CHARS) -> np.ndarray:
+    """本文ごとのSimHash（min_chars 文字未満の本文は 0）"""
+    return np.fromiter(
+        (simhash(text) if len(text) >= min_chars else 0 for text in texts), dtype=np.int64, count=len(texts)
+    )
+
+
+class NearDuplicateIndex:
+    """SimHashのLSH索引（チャンクID → 指紋）。削除は反映せず、照会時に生存しているかを確かめる"""
+
+    def __init__(self, max_distance: int = 3):
+        if not 0 <= max_distance < 64:
+            raise ValueError("max_distance must be between 0 and 63")
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        # 64ビットを bands 個の帯に分ける（端数は最後の帯に入れる）
+        width = 64 // bands
+        self._bands = [(i * width, 64 if i == bands - 1 else (i + 1) * width) for i in range(bands)]
+        self._buckets: List[Dict[int, List[Tuple[int, int]]]] = [defaultdict(list) for _ in self._bands]
+
+    def _keys(self, value: int):
+        unsigned = value & 0xFFFFFFFFFFFFFFFF
+        for low, high in self._bands:
+            yield (unsigned >> low) & ((1 << (high - low)) - 1)
+
+    def add(self, chunk_ids: np.ndarray, values: np.ndarray):
+        for chunk_id, value in zip(np.asarray(chunk_ids).tolist(), np.asarray(values).tolist()):
+            if value == 0:
+                continue
+            for buckets, key in zip(self._buckets, self._keys(value)):
+                buckets[key].append((chunk_id, value))
+
+    def find(self, values: np.ndarray, is_alive: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        指紋ごとに、ハミング距離が max_distance 以下の既存チャンクIDを返す（なければ -1）
+
+        候補が複数あれば最も近いもの（同じ距離なら古いもの）を選ぶ
+        """
+        found = np.full(len(values), -1, dtype=np.int64)
+        for position, value in enumerate(np.asarray(values).tolist()):
+            if value == 0:
+                continue
+            candidates = {}
+            for buckets, key in zip(self._buckets, self._keys(value)):
+                for chunk_id, other in buckets.get(key, ()):
+                    candidates[chunk_id] = other
+            if not candidates:
+                continue
+            ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            others = np.fromiter(candidates.values(), dtype=np.int64, count=len(candidates))
+            distances = np.bitwise_count(others ^ np.int64(value))
+            close = (distances <= self.max_distance) & is_alive(ids)
+            if close.any():
+                order = np.lexsort((ids[close], distances[close]))
+                found[position] = ids[close][order[0]]
+        return found
+
+
+def all_alive(ids: np.ndarray) -> np.ndarray:
+    """削除のない索引（同じ回に取り込むチャンク同士）で NearDuplicateIndex.find に渡す生存判定"""
+    return np.ones(len(ids), dtype=bool)
+
+
+class DuplicateMatches:
+    """同じ回に取り込むチャンクそれぞれの、ほぼ同じチャンクの突き合わせ結果"""
+
+    def __init__(self, existing: np.ndarray, within: np.ndarray):
+        # ほぼ同じ既存チャンクのID（なければ -1）
+        self.existing = existing
+        # 同じ回で先に出てくる、ほぼ同じチャンクの位置（既存チャンクにないものだけ。なければ -1）
+        self.within = within
+
+    @property
+    def unique(self) -> np.ndarray:
+        """埋め込むチャンクの位置"""
+        return np.flatnonzero((self.existing < 0) & (self.within < 0))
+
+    @property
+    def duplicates(self) -> np.ndarray:
+        """埋め込まずに参照にするチャンクの位置"""
+        return np.flatnonzero((self.existing >= 0) | (self.within >= 0))
+
+
+def find_duplicates(vector_store, fingerprints: np.ndarray, max_distance: Optional[int]) -> DuplicateMatches:
+    """
+    チャンクのSimHashを、ユーザーのインデックスにある既存チャンクと、同じ回で先に出てくるチャンクの両方と突き合わせる
+
+    Args:
+        vector_store: ユーザーの VectorStore
+        max_distance: ほぼ同じとみなすハミング距離（Noneなら突き合わせない）
+    """
+    existing = np.full(len(fingerprints), -1, dtype=np.int64)
+    within = np.full(len(fingerprints), -1, dtype=np.int64)
+    if max_distance is None:
+        return DuplicateMatches(existing, within)
+    existing = vector_store.find_near_duplicates(fingerprints, max_distance)
+    batch = NearDuplicateIndex(max_distance)
+    for position in np.flatnonzero(existing < 0).tolist():
+        value = fingerprints[position:position + 1]
+        within[position] = batch.find(value, all_alive)[0]
+        if within[position] < 0:
+            batch.add(np.array([position]), value)
+    return DuplicateMatches(existing, within)
+
+
+def add_deduplicated(vector_store, matches: DuplicateMatches, positions: np.ndarray, embeddings: np.ndarray,
+                     metadatas: List[dict]) -> np.ndarray:
+    """
+    埋め込んだチャンクを追加し、ほぼ同じチャンクがあるものは参照として記録する
+
+    同じ回のチャンクへの参照は、追加して採番されたチャンクIDに置き換える。
+    参照先がなかったもの（既存チャンクが削除されていた、同じ回の参照先の埋め込みに失敗した）の位置を返す
+    （呼び出し元で埋め込んで追加する）
+
+    Args:
+        positions: embeddings の各行のチャンクの位置
+        metadatas: 全チャンクのメタデータ（位置の順。参照には document_id / start / end を使う）
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    chunk_ids = np.full(len(metadatas), -1, dtype=np.int64)
+    chunk_ids[positions] = vector_store.add_documents(embeddings, [metadatas[i] for i in positions.tolist()])
+    duplicates = matches.duplicates
+    targets = np.where(
+        matches.existing[duplicates] >= 0, matches.existing[duplicates], chunk_ids[matches.within[duplicates]]
+    )
+    found = targets >= 0
+    missing = vector_store.add_references(targets[found], [
+        (metadatas[i]['document_id'], metadatas[i]['start'], metadatas[i]['end']) for i in duplicates[found].tolist()
+    ])
+    return np.sort(np.concatenate((duplicates[~found], duplicates[found][missing])))
+
+
+def load_documents(db, document_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+    """ドキュメントIDの一覧から {ID: (タイトル, 本文)} を読む（削除済みのものは含めない）"""
+    rows = db.query(Document.id, Document.title, Document.content).filter(Document.id.in_(document_ids))
+    return {document_id: (title, content or "") for document_id, title, content in rows}
+
+
+async def restore_references(vector_store, embedder, load_documents: Callable, references: List[Tuple[int, int, int]],
+                             save_embeddings: Optional[Callable] = None):
+    """
+    参照先のチャンクが削除された箇所を埋め込み直して、それぞれのドキュメントのチャンクとして追加する
+
+    Args:
+        load_documents: ドキュメントIDの一覧から {ID: (タイトル, 本文)} を返す関数（削除済みのものは含めない）
+        references: (ドキュメントID, start, end) の一覧
+        save_embeddings: 追加したチャンクの (メタデータ, 埋め込み, モデル) をDBのチャンクの行に書く関数
+    """
+    if not references:
+        return
+    documents = await asyncio.to_thread(load_documents, sorted({reference[0] for reference in references}))
+    targets = [
+        (document_id, start, end) for document_id, start, end in references
+        if document_id in documents and 0 <= start < end <= len(documents[document_id][1])
+    ]
+    texts = [documents[document_id][1][start:end] for document_id, start, end in targets]
+    result = await embedder.embed(texts)
+    indices, embeddings = result.successful()
+    fingerprints = simhashes(texts)
+    metadatas = [
+        {
+            'document_id': targets[i][0],
+            'title': documents[targets[i][0]][0],
+            'content': texts[i],
+            'start': targets[i][1],
+            'end': targets[i][2],
+            'simhash': int(fingerprints[i]),
+        }
+        for i in indices.tolist()
+    ]
+    await asyncio.to_thread(vector_store.add_documents, embeddings, metadatas)
+    if save_embeddings is not None:
+        await asyncio.to_thread(save_embeddings, metadatas, embeddings, vector_store.embedding_model)
+    if result.errors:
+        logger.error(f"Failed to restore {len(result.errors)} deduplicated chunks: {result.errors}")
+    logger.info(f"Restored {len(metadatas)} deduplicated chunks whose original was removed")
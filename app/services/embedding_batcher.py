@@ -0,0 +1,167 @@
+"""
+チャンクの一括埋め込み
+件数と文字数の上限でチャンクをリクエスト単位にまとめ、同時実行数を制限して並行に送る
+
+- 429 / 5xx / 通信エラーは指数バックオフ（ジッター付き）で再試行する
+- 400などの再試行しても成功しないエラーはバッチを半分に分けて送り直し、原因のチャンクだけを失敗にする
+- 結果は入力順に並び、失敗したチャンクはインデックスごとにエラー内容を返す
+"""
+import asyncio
+import logging
+import random
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from app.services.embeddings import EmbeddingAPIError, EmbeddingService
+
+logger = logging.getLogger(__name__)
+
+
+class BatchEmbeddingResult:
+    """一括埋め込みの結果（入力と同じ順序）"""
+
+    def __init__(self, count: int, dimension: int):
+        self.embeddings = np.zeros((count, dimension), dtype=np.float32)
+        self.succeeded = np.zeros(count, dtype=bool)
+        # 入力のインデックス → エラー内容
+        self.errors: Dict[int, str] = {}
+
+    @property
+    def failed_indices(self) -> List[int]:
+        return sorted(self.errors)
+
+    def successful(self):
+        """成功したチャンクの (インデックス, 埋め込み)"""
+        indices = np.flatnonzero(self.succeeded)
+        return indices, self.embeddings[indices]
+
+
+class BatchEmbedder:
+    def __init__(
+        self,
+        service: EmbeddingService,
+        max_batch_size: int = 64,
+        max_batch_chars: int = 32000,
+        concurrency: int = 4,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+    ):
+        """
+        Args:
+            max_batch_size: 1リクエストに含めるチャンク数の上限
+            max_batch_chars: 1リクエストに含める文字数の合計の上限（トークン数の目安）
+            concurrency: 同時に送るリクエスト数の上限
+            max_retries: 再試行できるエラーでの最大再試行回数
+            backoff_base: 1回目の再試行までの待ち時間（秒）。以降は倍々に伸ばす
+            backoff_max: 待ち時間の上限（秒）
+        """
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.max_batch_chars = max_batch_chars
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def plan_batches(self, texts: List[str]) -> List[List[int]]:
+        """入力順を保ったまま、件数と文字数の上限に収まるようにインデックスをまとめる"""
+        batches = []
+        current: List[int] = []
+        current_chars = 0
+        for i, text in enumerate(texts):
+            if current and (len(current) >= self.max_batch_size
+                            or current_chars + len(text) > self.max_batch_chars):
+                batches.append(current)
+                current, current_chars = [], 0
+            # 上限を超える長さのチャンクは単独のリクエストにする
+            current.append(i)
+            current_chars += len(text)
+        if current:
+            batches.append(current)
+        return batches
+
+    async def embed(self, texts: List[str]) -> BatchEmbeddingResult:
+        """全チャンクを埋め込む（失敗したチャンクは結果の errors に入る）"""
+        result = BatchEmbeddingResult(len(texts), self.service.dimension)
+        if not texts:
+            return result
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[
+            self._embed_batch(batch, texts, result, semaphore)
+            for batch in self.plan_batches(texts)
+        ])
+        if result.errors:
+            logger.warning(f"Embedding failed for {len(result.errors)} of {len(texts)} chunks")
+        return result
+
+    async def _embed_batch(self, indices: List[int], texts: List[str], result: BatchEmbeddingResult,
+                           semaphore: asyncio.Semaphore):
+        try:
+            async with semaphore:
+                embeddings = await self._request_with_retry([texts[i] for i in indices])
+        except EmbeddingAPIError as e:
+            if not e.retryable and len(indices) > 1:
+                # 特定のチャンクが原因の可能性があるので、分けて送り直して絞り込む
+                middle = len(indices) // 2
+                await asyncio.gather(
+                    self._embed_batch(indices[:middle], texts, result, semaphore),
+                    self._embed_batch(indices[middle:], texts, result, semaphore),
+                )
+                return
+            self._fail(indices, result, str(e))
+            return
+        except Exception as e:
+            self._fail(indices, result, str(e))
+            return
+
+        if len(embeddings) != len(indices):
+            self._fail(indices, result, f"Expected {len(indices)} embeddings, got {len(embeddings)}")
+            return
+        result.embeddings[indices] = embeddings
+        result.succeeded[indices] = True
+
+    def _fail(self, indices: List[int], result: BatchEmbeddingResult, error: str):
+        for i in indices:
+            result.errors[i] = error
+
+    def _backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # フルジッター: 同時に失敗したリクエストが一斉に再送しないようにする
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _request_with_retry(self, batch_texts: List[str]) -> np.ndarray:
+        attempt = 0
+        while True:
+            try:
+                return await self.service.aembed_texts(batch_texts)
+            except EmbeddingAPIError as e:
+                if not e.retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e.retry_after)
+            except httpx.TransportError:
+                # 接続エラーやタイムアウト
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            attempt += 1
+            logger.info(f"Retrying embedding batch of {len(batch_texts)} in {delay:.2f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
+
+
+def get_batch_embedder() -> BatchEmbedder:
+    """設定に従った一括埋め込みを取得（埋め込みサービスはプロセス全体で共有）"""
+    from app.config import settings
+    from app.services.embeddings import get_embedding_service
+
+    return BatchEmbedder(
+        get_embedding_service(),
+        max_batch_size=settings.EMBEDDING_BATCH_SIZE,
+        max_batch_chars=settings.EMBEDDING_BATCH_MAX_CHARS,
+        concurrency=settings.EMBEDDING_CONCURRENCY,
+        max_retries=settings.EMBEDDING_MAX_RETRIES
+    )
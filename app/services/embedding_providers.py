@@ -0,0 +1,550 @@
+"""
+埋め込みの生成元（プロバイダー）
+EmbeddingServiceはキャッシュやクエリのまとめ送信を受け持ち、実際の埋め込み計算はここに委ねる
+
+- jina:    Jina AI API（keep-aliveの接続プールを共有）
+- onnx:    ローカルのONNXモデル（遅延ロード、専用ワーカースレッドで動的バッチ処理、INT8量子化モデル対応）
+- hashing: 特徴量ハッシュによる決定的で軽量な埋め込み（テスト・ベンチマーク・オフライン用）
+"""
+import asyncio
+import functools
+import hashlib
+import logging
+import queue
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+from pathlib import Path
+from typing import List, Optional
+
+import httpx
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_JINA = "jina"
+PROVIDER_ONNX = "onnx"
+PROVIDER_HASHING = "hashing"
+PROVIDERS = (PROVIDER_JINA, PROVIDER_ONNX, PROVIDER_HASHING)
+
+JINA_EMBEDDINGS_URL = "https://api.jina.ai/v1/embeddings"
+
+
+class EmbeddingAPIError(Exception):
+    """埋め込みAPIがエラーを返した場合の例外"""
+
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(f"Jina API error: {status_code} - {message}")
+        self.status_code = status_code
+        # Retry-Afterヘッダーで指定された待ち時間（秒）
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """レート制限（429）とサーバーエラー（5xx）は時間をおけば成功しうる"""
+        return self.status_code == 429 or self.status_code >= 500
+
+
+class ConnectionStats:
+    """送信したリクエスト数と新規に張った接続数（差が再利用した回数）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.connections_opened = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests_sent += 1
+
+    def record_connection(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            requests_sent = self.requests_sent
+            connections_opened = self.connections_opened
+        reused = max(0, requests_sent - connections_opened)
+        return {
+            'requests': requests_sent,
+            'connections_opened': connections_opened,
+            'connections_reused': reused,
+            'reuse_ratio': reused / requests_sent if requests_sent else 0.0,
+        }
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    """新しく張った接続の数を数える接続プール"""
+
+    def __init__(self, *args, on_new_connection=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_new_connection = on_new_connection
+
+    def _new_conn(self):
+        if self._on_new_connection is not None:
+            self._on_new_connection()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def __init__(self, *args, on_new_connection=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_new_connection = on_new_connection
+
+    def _new_conn(self):
+        if self._on_new_connection is not None:
+            self._on_new_connection()
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    keep-aliveの接続プールを持つアダプター
+
+    送信したリクエスト数と新規に張った接続数を数え、接続の再利用率を出せるようにする
+    """
+
+    def __init__(self, *args, connection_stats: Optional[ConnectionStats] = None, **kwargs):
+        self.connection_stats = connection_stats or ConnectionStats()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        on_new_connection = self.connection_stats.record_connection
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(_CountingHTTPConnectionPool, on_new_connection=on_new_connection),
+            'https': functools.partial(_CountingHTTPSConnectionPool, on_new_connection=on_new_connection),
+        }
+
+    def send(self, request, **kwargs):
+        self.connection_stats.record_request()
+        return super().send(request, **kwargs)
+
+
+class EmbeddingProvider:
+    """埋め込みの生成元の共通インターフェース（返すベクトルはL2正規化済み）"""
+
+    name = ""
+
+    def __init__(self, model_name: str, dimension: int):
+        # キャッシュのキーやストアのマニフェストに使う（モデルが変われば別の埋め込み）
+        self.model_name = model_name
+        self.dimension = dimension
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    async def aembed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        self.close()
+
+
+class JinaProvider(EmbeddingProvider):
+    """Jina AI API（同期版はrequests、非同期版はhttpxで、どちらも接続プールを使い回す）"""
+
+    name = PROVIDER_JINA
+
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str = "jina-embeddings-v3",
+        dimension: int = 1024,
+        pool_size: int = 10,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+    ):
+        """
+        Args:
+            dimension: 埋め込みの次元数（Jina v3は1024以下に切り詰めた埋め込みを返せる）
+            pool_size: 接続プールに保持するkeep-alive接続の最大数（同時リクエスト数の上限の目安）
+            connect_timeout: 接続確立のタイムアウト（秒）
+            read_timeout: レスポンス待ちのタイムアウト（秒）
+        """
+        super().__init__(model_name, dimension)
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self._stats = ConnectionStats()
+
+        # 接続プールを持つセッション（スレッド間で共有してよい）
+        self._adapter = PooledHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, connection_stats=self._stats)
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.headers.update(self._headers())
+        # 非同期クライアントはイベントループ上で最初に使う時に作る
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                headers=self._headers(),
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+        return self._async_client
+
+    async def _trace_connection(self, event_name: str, info: dict):
+        """httpxの接続イベントから新規接続の数を数える"""
+        if event_name == "connection.connect_tcp.complete":
+            self._stats.record_connection()
+
+    def _request_body(self, texts: List[str]) -> dict:
+        return {
+            "model": self.model_name,
+            "input": texts,
+            "dimensions": self.dimension
+        }
+
+    def _parse_response(self, response) -> np.ndarray:
+        print(f"🔍 Jina APIレスポンス: {response.status_code}")
+        if response.status_code == 200:
+            embeddings = [item["embedding"] for item in response.json()["data"]]
+            return np.array(embeddings, dtype=np.float32)
+        retry_after = response.headers.get("Retry-After")
+        raise EmbeddingAPIError(
+            response.status_code,
+            response.text,
+            float(retry_after) if retry_after and retry_after.isdigit() else None
+        )
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Jina APIで埋め込み生成（プールの接続を再利用）"""
+        try:
+            response = self._session.post(
+                JINA_EMBEDDINGS_URL,
+                json=self._request_body(texts),
+                timeout=self.timeout
+            )
+            return self._parse_response(response)
+
+        except Exception as e:
+            print(f"❌ Jina API error: {e}")
+            raise
+
+    async def aembed(self, texts: List[str]) -> np.ndarray:
+        """Jina APIで埋め込み生成（非同期、プールの接続を再利用）"""
+        try:
+            self._stats.record_request()
+            response = await self._get_async_client().post(
+                JINA_EMBEDDINGS_URL,
+                json=self._request_body(texts),
+                extensions={"trace": self._trace_connection}
+            )
+            return self._parse_response(response)
+
+        except Exception as e:
+            print(f"❌ Jina API error: {e}")
+            raise
+
+    def stats(self) -> dict:
+        """Jina APIへのHTTP接続の再利用状況（同期・非同期の合計）"""
+        return self._stats.snapshot()
+
+    def close(self):
+        self._session.close()
+
+    async def aclose(self):
+        self.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+
+class HashingProvider(EmbeddingProvider):
+    """
+    特徴量ハッシュによる決定的な埋め込み
+
+    単語と文字バイグラム（日本語など空白で区切らない言語向け）をハッシュして符号付きで加算する。
+    意味の近さは捉えないが、同じ語を含むテキスト同士は近くなる。外部への通信もモデルも不要
+    """
+
+    name = PROVIDER_HASHING
+
+    _WORD = re.compile(r"\w+")
+
+    def __init__(self, dimension: int = 1024):
+        super().__init__("hashing-v1", dimension)
+
+    def _features(self, text: str) -> List[str]:
+        words = self._WORD.findall(unicodedata.normalize("NFKC", text).lower())
+        features = list(words)
+        for word in words:
+            features.extend(word[i:i + 2] for i in range(len(word) - 1))
+        return features
+
+    def _embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        features = self._features(text)
+        if not features:
+            return vector
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little") for f in features],
+            dtype=np.uint64
+        )
+        # 下位ビットで次元、最上位ビットで符号を決める
+        indices = (hashes % np.uint64(self.dimension)).astype(np.int64)
+        signs = np.where(hashes >> np.uint64(63), 1.0, -1.0).astype(np.float32)
+        np.add.at(vector, indices, signs)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.stack([self._embed_one(text) for text in texts])
+
+    async def aembed(self, texts: List[str]) -> np.ndarray:
+        return self.embed(texts)
+
+
+class LocalONNXProvider(EmbeddingProvider):
+    """
+    ローカルのONNXモデルで埋め込みを計算する
+
+    モデルは最初の呼び出し時にワーカースレッドで読み込む。呼び出しはキューに積まれ、
+    ワーカーは batch_wait_ms の間に届いた他の呼び出しとまとめて max_batch_size 件ずつ推論する。
+    quantized=True ではINT8量子化モデルを使い、なければ元のモデルから動的量子化して作る
+
+    model_dir には model.onnx（または model_quantized.onnx）と tokenizer.json を置く
+    """
+
+    name = PROVIDER_ONNX
+
+    MODEL_FILE = "model.onnx"
+    QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+    TOKENIZER_FILE = "tokenizer.json"
+
+    def __init__(
+        self,
+        model_dir: str,
+        dimension: int,
+        quantized: bool = True,
+        max_batch_size: int = 32,
+        batch_wait_ms: float = 2.0,
+        max_length: int = 512,
+        pooling: str = "mean",
+        num_threads: int = 0,
+    ):
+        """
+        Args:
+            dimension: 返す次元数（モデルの出力より小さければ先頭の次元に切り詰める）
+            max_batch_size: 1回の推論に含めるテキスト数の上限
+            batch_wait_ms: 他の呼び出しを待ってまとめる最大時間（ミリ秒）
+            max_length: トークン数の上限（超えた分は切り捨て）
+            pooling: "mean"（attention maskで平均）または "cls"
+            num_threads: 推論のスレッド数（0ならonnxruntimeの既定値）
+        """
+        model_dir = Path(model_dir)
+        super().__init__(f"onnx:{model_dir.name}{'-int8' if quantized else ''}", dimension)
+        if pooling not in ("mean", "cls"):
+            raise ValueError(f"Unknown pooling: {pooling}")
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_length = max_length
+        self.pooling = pooling
+        self.num_threads = num_threads
+
+        self._session = None
+        self._tokenizer = None
+        self._input_names = set()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+
+    def _load(self):
+        """モデルとトークナイザーを読み込む（ワーカースレッドで最初の推論前に1回だけ）"""
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = self.model_dir / self.MODEL_FILE
+        if self.quantized:
+            quantized_path = self.model_dir / self.QUANTIZED_MODEL_FILE
+            if not quantized_path.exists():
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                logger.info(f"Quantizing {model_path} to INT8")
+                quantize_dynamic(str(model_path), str(quantized_path), weight_type=QuantType.QInt8)
+            model_path = quantized_path
+
+        options = ort.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        self._session = ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+        self._input_names = {model_input.name for model_input in self._session.get_inputs()}
+
+        tokenizer = Tokenizer.from_file(str(self.model_dir / self.TOKENIZER_FILE))
+        tokenizer.enable_truncation(self.max_length)
+        tokenizer.enable_padding()
+        self._tokenizer = tokenizer
+        logger.info(f"Loaded ONNX embedding model {model_path}")
+
+    def _submit(self, texts: List[str]) -> Future:
+        future: Future = Future()
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="onnx-embedding", daemon=True)
+                self._worker.start()
+            self.requests += 1
+        self._queue.put((list(texts), future))
+        return future
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return self._submit(texts).result()
+
+    async def aembed(self, texts: List[str]) -> np.ndarray:
+        # 推論はワーカースレッドで行い、イベントループは待つだけ
+        return await asyncio.wrap_future(self._submit(texts))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            count = len(item[0])
+            # 少しだけ待って、後から届いた呼び出しも同じ推論にまとめる
+            deadline = time.monotonic() + self.batch_wait
+            while count < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                count += len(item[0])
+            # 待っている間に呼び出し元がキャンセルした分は推論しない（実行中にしたものはもうキャンセルされない）
+            batch = [(texts, future) for texts, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception:
+                # 1回の推論の失敗でワーカーを止めない（止まると以降の呼び出しが誰にも処理されない）
+                logger.exception("ONNX embedding worker failed to process a batch")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Embedding worker failed"))
+
+    def _process(self, batch: List[tuple]):
+        texts = [text for batch_texts, _ in batch for text in batch_texts]
+        try:
+            if self._session is None:
+                self._load()
+            vectors = self._infer(texts)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for batch_texts, future in batch:
+            future.set_result(vectors[offset:offset + len(batch_texts)])
+            offset += len(batch_texts)
+
+    def _infer(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # 長さの近いテキストを同じ推論に入れてパディングを減らし、最後に元の順序に戻す
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        pooled = []
+        for start in range(0, len(texts), self.max_batch_size):
+            encodings = self._tokenizer.encode_batch([texts[i] for i in order[start:start + self.max_batch_size]])
+            input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+            attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self._input_names:
+                feeds['token_type_ids'] = np.zeros_like(input_ids)
+            hidden = self._session.run(None, feeds)[0]
+
+            if hidden.ndim == 2:
+                # 文の埋め込みを直接出力するモデル
+                pooled.append(hidden)
+            elif self.pooling == "cls":
+                pooled.append(hidden[:, 0])
+            else:
+                mask = attention_mask[..., None].astype(np.float32)
+                pooled.append((hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1.0))
+            self.batches += 1
+        self.texts += len(texts)
+
+        vectors = np.empty((len(texts), pooled[0].shape[1]), dtype=np.float32)
+        vectors[order] = np.vstack(pooled)
+        if vectors.shape[1] < self.dimension:
+            raise ValueError(f"ONNX model outputs {vectors.shape[1]} dimensions, {self.dimension} requested")
+        vectors = np.ascontiguousarray(vectors[:, :self.dimension])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def stats(self) -> dict:
+        return {
+            'loaded': self._session is not None,
+            'requests': self.requests,
+            'texts': self.texts,
+            'inference_batches': self.batches,
+            'average_batch_size': self.texts / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        with self._worker_lock:
+            if self._worker is not None:
+                self._queue.put(None)
+                self._worker = None
+
+
+def create_provider(settings) -> EmbeddingProvider:
+    """設定の EMBEDDING_PROVIDER に従ってプロバイダーを作る"""
+    provider = settings.EMBEDDING_PROVIDER
+    if provider == PROVIDER_JINA:
+        return JinaProvider(
+            settings.JINA_API_KEY,
+            model_name=settings.EMBEDDING_MODEL,
+            dimension=settings.EMBEDDING_DIMENSION,
+            pool_size=settings.EMBEDDING_HTTP_POOL_SIZE,
+            connect_timeout=settings.EMBEDDING_HTTP_CONNECT_TIMEOUT,
+            read_timeout=settings.EMBEDDING_HTTP_READ_TIMEOUT
+        )
+    if provider == PROVIDER_ONNX:
+        return LocalONNXProvider(
+            settings.ONNX_MODEL_DIR,
+            dimension=settings.EMBEDDING_DIMENSION,
+            quantized=settings.ONNX_QUANTIZED,
+            max_batch_size=settings.ONNX_MAX_BATCH_SIZE,
+            batch_wait_ms=settings.ONNX_BATCH_WAIT_MS,
+            max_length=settings.ONNX_MAX_LENGTH,
+            pooling=settings.ONNX_POOLING,
+            num_threads=settings.ONNX_NUM_THREADS
+        )
+    if provider == PROVIDER_HASHING:
+        return HashingProvider(settings.EMBEDDING_DIMENSION)
+    raise ValueError(f"Unknown embedding provider: {provider}")
@@ -1,67 +1,378 @@
 """
 埋め込み生成サービス
-Jina AI API対応で高速・低メモリ化
+埋め込みキャッシュと検索クエリのまとめ送信を受け持ち、埋め込みの計算はプロバイダーに委ねる
+
+プロセス全体で1つのインスタンスを共有する。プロバイダーは設定の EMBEDDING_PROVIDER で
+Jina AI API・ローカルのONNXモデル・特徴量ハッシュから選ぶ（embedding_providers.py）
 """
-from typing import List
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Set
 import numpy as np
-import os
-import requests
 from app.config import settings
+from app.services.embedding_providers import EmbeddingAPIError, EmbeddingProvider, create_provider
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用の正規化（NFKC + 空白の連続を1つにまとめる）"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class _DiskVectorTier:
+    """
+    埋め込みキャッシュのディスク層
+
+    ベクトルは追記専用のfloat32ファイル（mmapで読む）、キーは同じ順序で並べた16バイトのハッシュ。
+    起動時にキーファイルからハッシュ → 行番号の索引を作る。書き込むのは1プロセスだけを想定
+    """
+
+    KEYS_FILE = "keys.bin"
+    VECTORS_FILE = "vectors.f32"
+    KEY_SIZE = 16
+
+    def __init__(self, directory: Path, dimension: int, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dimension = dimension
+        self.row_bytes = dimension * 4
+        self.max_rows = max_bytes // (self.row_bytes + self.KEY_SIZE)
+        self._keys_path = self.directory / self.KEYS_FILE
+        self._vectors_path = self.directory / self.VECTORS_FILE
+        self._index: Dict[bytes, int] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._load()
+
+    def _load(self):
+        keys = self._keys_path.read_bytes() if self._keys_path.exists() else b""
+        vector_bytes = self._vectors_path.stat().st_size if self._vectors_path.exists() else 0
+        # ベクトルを書いてからキーを書くので、途中で落ちた場合は短い方に揃える
+        rows = min(len(keys) // self.KEY_SIZE, vector_bytes // self.row_bytes)
+        for path, size in ((self._keys_path, rows * self.KEY_SIZE), (self._vectors_path, rows * self.row_bytes)):
+            if path.exists() and path.stat().st_size != size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+        self._index = {keys[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE]: i for i in range(rows)}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        row = self._index.get(key)
+        if row is None:
+            return None
+        if self._vectors is None or row >= len(self._vectors):
+            # 追記でファイルが伸びたので開き直す
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r").reshape(-1, self.dimension)
+        return np.array(self._vectors[row])
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray) -> int:
+        """未登録のキーだけを追記し、追記した件数を返す（上限に達したら追記しない）"""
+        rows = [i for i, key in enumerate(keys) if key not in self._index]
+        rows = rows[:max(0, self.max_rows - len(self._index))]
+        if not rows:
+            return 0
+        with open(self._vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors[rows], dtype=np.float32).tobytes())
+        with open(self._keys_path, "ab") as f:
+            f.write(b"".join(keys[i] for i in rows))
+        for i in rows:
+            self._index[keys[i]] = len(self._index)
+        return len(rows)
+
+
+class EmbeddingCache:
+    """
+    内容アドレスの埋め込みキャッシュ
+
+    キーは (モデル名, 次元数, 正規化したテキスト) のハッシュ。
+    メモリ上のLRU（件数上限）で引き、なければディスク層を引いてLRUに載せる
+    """
+
+    def __init__(self, model_name: str, dimension: int, max_entries: int = 4096,
+                 directory: Optional[str] = None, max_disk_bytes: int = 512 * 1024 * 1024):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._disk = None
+        if directory:
+            # モデルと次元数ごとにファイルを分ける
+            self._disk = _DiskVectorTier(Path(directory) / f"{model_name}-{dimension}", dimension, max_disk_bytes)
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # キャッシュだけで応答でき、APIを呼ばずに済んだ回数
+        self.api_calls_saved = 0
+
+    def key(self, text: str) -> bytes:
+        payload = f"{self.model_name}\0{self.dimension}\0{normalize_text(text)}".encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=_DiskVectorTier.KEY_SIZE).digest()
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        results: List[Optional[np.ndarray]] = []
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                elif self._disk is not None and (vector := self._disk.get(key)) is not None:
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+                results.append(vector)
+        return results
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self._disk is not None:
+                self._disk.put_many(keys, vectors)
+
+    def record_saved_call(self):
+        with self._lock:
+            self.api_calls_saved += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'disk_entries': len(self._disk) if self._disk is not None else 0,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'api_calls_saved': self.api_calls_saved,
+            }
+
+
+class QueryEmbeddingBatcher:
+    """
+    同時に届いた検索クエリの埋め込みを1回のAPI呼び出しにまとめる
+
+    最初のクエリから window_ms だけ待つか、max_batch_size 件たまったら送信し、
+    結果をそれぞれの呼び出し元に返す（イベントループ上で使う）
+    """
+
+    def __init__(self, service: "EmbeddingService", window_ms: float = 5.0, max_batch_size: int = 32):
+        self.service = service
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._pending: List[tuple] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 送信中のタスク（イベントループは弱参照しか持たないので、終わるまでここで参照を持つ）
+        self._send_tasks: Set[asyncio.Task] = set()
+
+        self.queries = 0
+        self.batches = 0
+
+    async def embed(self, text: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.queries += 1
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self.batches += 1
+            task = asyncio.ensure_future(self._send(batch))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, batch: List[tuple]):
+        try:
+            embeddings = await self.service.aembed_texts([text for text, _ in batch])
+        except EmbeddingAPIError as e:
+            if not e.retryable and len(batch) > 1:
+                # 1件の不正なクエリで他の呼び出し元まで失敗させないよう、1件ずつ送り直す
+                await asyncio.gather(*[self._send([item]) for item in batch])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            # 待っている間にキャンセルされた呼び出し元には返さない
+            if not future.done():
+                future.set_result(embedding)
+
+    def stats(self) -> dict:
+        return {
+            'queries': self.queries,
+            'batches': self.batches,
+            'average_batch_size': self.queries / self.batches if self.batches else 0.0,
+        }
+
 
 class EmbeddingService:
-    def __init__(self, model_name: str = "jina-embeddings-v3"):
+    def __init__(
+        self,
+        provider: EmbeddingProvider,
+        cache: Optional[EmbeddingCache] = None,
+        query_batch_window_ms: float = 5.0,
+        query_batch_size: int = 32,
+    ):
         """
-        Jina AI APIで初期化
+        埋め込みプロバイダー（Jina / ローカルONNX / ハッシュ）で初期化
+
+        Args:
+            cache: 埋め込みキャッシュ（Noneなら毎回プロバイダーを呼ぶ）
+            query_batch_window_ms: 検索クエリをまとめて送るまでの最大待ち時間（ミリ秒）
+            query_batch_size: まとめて送る検索クエリの最大件数
         """
-        self.model_name = model_name
-        self.api_key = settings.JINA_API_KEY
-        self.dimension = 1024  # Jina v3の次元数
+        self.provider = provider
+        self.cache = cache
+        self._query_batcher = QueryEmbeddingBatcher(self, query_batch_window_ms, query_batch_size)
 
-    def _load_model(self):
-        """Jina APIはロード不要"""
-        return True
+    @property
+    def model_name(self) -> str:
+        return self.provider.model_name
+
+    @property
+    def dimension(self) -> int:
+        return self.provider.dimension
 
     def embed_text(self, text: str) -> np.ndarray:
         """単一テキストの埋め込み生成"""
-        return self._embed_with_jina([text])[0]
+        return self.embed_texts([text])[0]
 
     def embed_texts(self, texts: List[str]) -> np.ndarray:
-        """複数テキストの埋め込み生成"""
-        return self._embed_with_jina(texts)
-
-    def _embed_with_jina(self, texts: List[str]) -> np.ndarray:
-        """Jina APIで埋め込み生成"""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": self.model_name,
-            "input": texts
-        }
-        
-        try:
-            print(f"🔍 Jina API呼び出し: key={self.api_key[:10]}...") 
-            response = requests.post(
-                "https://api.jina.ai/v1/embeddings",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            print(f"🔍 Jina APIレスポンス: {response.status_code}")
-            print(f"🔍 Jina APIレスポンス body: {response.text[:200]}")
-            
-            if response.status_code == 200:
-                embeddings = [item["embedding"] for item in response.json()["data"]]
-                return np.array(embeddings, dtype=np.float32)
-            else:
-                raise Exception(f"Jina API error: {response.status_code} - {response.text}")
-                
-        except Exception as e:
-            print(f"❌ Jina API error: {e}")
-            raise
+        """複数テキストの埋め込み生成（キャッシュにないテキストだけプロバイダーに送る）"""
+        keys, cached, missing = self._lookup(texts)
+        embeddings = self.provider.embed([texts[i] for i in missing]) if missing else None
+        return self._merge(keys, cached, missing, embeddings)
+
+    async def aembed_text(self, text: str) -> np.ndarray:
+        """単一テキストの埋め込み生成（非同期）"""
+        return (await self.aembed_texts([text]))[0]
+
+    async def aembed_texts(self, texts: List[str]) -> np.ndarray:
+        """複数テキストの埋め込み生成（非同期、キャッシュにないテキストだけプロバイダーに送る）"""
+        keys, cached, missing = self._lookup(texts)
+        embeddings = await self.provider.aembed([texts[i] for i in missing]) if missing else None
+        return self._merge(keys, cached, missing, embeddings)
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        """
+        検索クエリの埋め込み生成（非同期）
+
+        同時に届いた他のクエリと1回のAPI呼び出しにまとめる
+        """
+        return await self._query_batcher.embed(text)
+
+    def _lookup(self, texts: List[str]):
+        """
+        キャッシュを引き、APIに送る必要のあるテキストの位置を返す
+
+        同じ呼び出しの中で重複しているテキストも1回だけ送る
+        """
+        if self.cache is None:
+            return None, None, list(range(len(texts)))
+        keys = [self.cache.key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        missing: Dict[bytes, int] = {}
+        for i, (key, vector) in enumerate(zip(keys, cached)):
+            if vector is None and key not in missing:
+                missing[key] = i
+        if not missing:
+            self.cache.record_saved_call()
+        return keys, cached, list(missing.values())
+
+    def _merge(self, keys, cached, missing: List[int], embeddings: Optional[np.ndarray]) -> np.ndarray:
+        """APIの結果をキャッシュに登録し、キャッシュ済みの結果と入力順に並べる"""
+        if self.cache is None:
+            return embeddings
+        if missing:
+            self.cache.put_many([keys[i] for i in missing], embeddings)
+            fetched = dict(zip((keys[i] for i in missing), embeddings))
+            cached = [vector if vector is not None else fetched[key] for key, vector in zip(keys, cached)]
+        return np.array(cached, dtype=np.float32).reshape(len(keys), self.dimension)
+
+    def stats(self) -> dict:
+        """プロバイダーの状況（JinaならHTTP接続の再利用状況、ONNXなら推論バッチの状況）"""
+        return {'provider': self.provider.name, 'model': self.model_name, **self.provider.stats()}
+
+    def query_batch_stats(self) -> dict:
+        """検索クエリのまとめ送信の状況（平均何件ずつ送れているか）"""
+        return self._query_batcher.stats()
+
+    def cache_stats(self) -> dict:
+        """埋め込みキャッシュのヒット率とAPI呼び出しの削減数（キャッシュ無効なら空）"""
+        return self.cache.stats() if self.cache is not None else {}
+
+    def close(self):
+        self.provider.close()
+
+    async def aclose(self):
+        await self.provider.aclose()
+
+
+def _create_embedding_cache(model_name: str, dimension: int) -> Optional[EmbeddingCache]:
+    """設定に従って埋め込みキャッシュを作る（メモリ件数0で無効）"""
+    if settings.EMBEDDING_CACHE_ENTRIES <= 0:
+        return None
+    return EmbeddingCache(
+        model_name,
+        dimension,
+        max_entries=settings.EMBEDDING_CACHE_ENTRIES,
+        directory=settings.EMBEDDING_CACHE_DIR or None,
+        max_disk_bytes=settings.EMBEDDING_CACHE_DISK_MB * 1024 * 1024
+    )
+
+
+# シングルトン管理
+_embedding_service: Optional[EmbeddingService] = None
+_embedding_service_lock = threading.Lock()
+
 
 def get_embedding_service() -> EmbeddingService:
-    """埋め込みサービスのインスタンスを取得"""
-    return EmbeddingService()
+    """埋め込みサービスのインスタンスを取得（プロセス全体で共有）"""
+    global _embedding_service
+    if _embedding_service is None:
+        with _embedding_service_lock:
+            if _embedding_service is None:
+                provider = create_provider(settings)
+                _embedding_service = EmbeddingService(
+                    provider,
+                    cache=_create_embedding_cache(provider.model_name, provider.dimension),
+                    query_batch_window_ms=settings.QUERY_EMBEDDING_BATCH_WINDOW_MS,
+                    query_batch_size=settings.QUERY_EMBEDDING_BATCH_SIZE
+                )
+    return _embedding_service
+
+
+async def close_embedding_service():
+    """共有の埋め込みサービスの接続を閉じる（アプリ終了時）"""
+    global _embedding_service
+    if _embedding_service is not None:
+        await _embedding_service.aclose()
+        _embedding_service = None
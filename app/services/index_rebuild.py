@@ -0,0 +1,213 @@
+"""
+DBからのインデックス再構築
+document_chunks に保存した埋め込みから、ユーザーのベクトルストアを作り直す
+
+埋め込みを呼び直すのは、保存された埋め込みがないチャンク（埋め込みに失敗した、別のモデルで作った、
+参照先の既存チャンクがなくなった）だけ。チャンクの行がないドキュメント（この表ができる前に登録したもの）は
+本文をチャンクに分けて行を作ってから埋め込む。ベクトルストアのファイルは読まずに作り直すので、
+ファイルが壊れていても、インデックスの種類を変えた場合でも使える
+
+サーバーとは別のプロセスで実行するので、対象ユーザーへの書き込みがない時（サーバーを止めた状態など）に実行する
+
+使い方:
+    python -m app.services.index_rebuild --user-id 1 --user-id 2
+    python -m app.services.index_rebuild --all
+"""
+import argparse
+import asyncio
+import logging
+from typing import Callable, Optional
+
+import numpy as np
+from sqlalchemy import insert, update
+
+from app.models.document import Document
+from app.models.document_chunk import DocumentChunk
+from app.services.chunk_store import EMBEDDING_DTYPE, chunk_rows, decode_embeddings, encode_embedding
+from app.services.chunking import chunk_text
+from app.services.dedup import NearDuplicateIndex, all_alive, simhashes
+
+logger = logging.getLogger(__name__)
+
+
+def _chunk_missing_documents(db, user_id: int, documents: dict, model: Optional[str], max_length: int,
+                             overlap: int, max_tokens: Optional[int]) -> int:
+    """チャンクの行がないドキュメントを分割して、埋め込みなしの行を作る（作ったドキュメント数を返す）"""
+    chunked = {
+        document_id for (document_id,) in
+        db.query(DocumentChunk.document_id).filter(DocumentChunk.user_id == user_id).distinct()
+    }
+    missing = sorted(documents.keys() - chunked)
+    for document_id in missing:
+        title, content = documents[document_id]
+        chunks = chunk_text(content, max_length, overlap, max_tokens)
+        fingerprints = simhashes([chunk.text for chunk in chunks])
+        metadatas = [
+            {'content': chunk.text, 'start': chunk.start, 'end': chunk.end, 'simhash': int(fingerprint)}
+            for chunk, fingerprint in zip(chunks, fingerprints)
+        ]
+        rows = chunk_rows(user_id, document_id, metadatas, {}, model)
+        if rows:
+            db.execute(insert(DocumentChunk), rows)
+    db.commit()
+    return len(missing)
+
+
+async def rebuild_user_index(
+    db,
+    user_id: int,
+    embedder,
+    load_vector_store: Callable,
+    dimension: int,
+    model: Optional[str] = None,
+    max_length: int = 800,
+    overlap: int = 100,
+    max_tokens: Optional[int] = None,
+    dedup_max_distance: Optional[int] = 3,
+) -> dict:
+    """
+    ユーザーのインデックスをDBから作り直し、件数の内訳を返す
+
+    保存された埋め込みのないチャンクは、SimHashがほぼ同じチャンクが先にあればその参照にし、
+    なければ埋め込んで、その埋め込みもDBに保存する
+
+    Args:
+        db: DBセッション
+        embedder: BatchEmbedder（埋め込みのないチャンクだけを渡す）
+        load_vector_store: 空のベクトルストアを返す関数（埋め込みが揃ってから呼ぶ）
+        dimension: 埋め込みの次元数
+        model: 埋め込みモデル（保存された埋め込みのうち、このモデルのものだけを使う）
+        dedup_max_distance: ほぼ同じとみなすSimHashのハミング距離（Noneなら参照にしない）
+    """
+    documents = {
+        document_id: (title, content) for document_id, title, content in
+        db.query(Document.id, Document.title, Document.content).filter(Document.user_id == user_id)
+    }
+    chunked = await asyncio.to_thread(
+        _chunk_missing_documents, db, user_id, documents, model, max_length, overlap, max_tokens
+    )
+    rows = db.query(
+        DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.content, DocumentChunk.start_offset,
+        DocumentChunk.end_offset, DocumentChunk.simhash, DocumentChunk.embedding, DocumentChunk.embedding_model
+    ).join(Document, Document.id == DocumentChunk.document_id)\
+        .filter(DocumentChunk.user_id == user_id)\
+        .order_by(DocumentChunk.document_id, DocumentChunk.position)\
+        .all()
+
+    # 保存された埋め込みを使うチャンク・参照にするチャンク・埋め込むチャンクに分ける（ドキュメントの登録順）
+    blob_size = dimension * np.dtype(EMBEDDING_DTYPE).itemsize
+    stored, references, to_embed = [], [], []
+    near_duplicates = NearDuplicateIndex(dedup_max_distance) if dedup_max_distance is not None else None
+    for position, row in enumerate(rows):
+        has_embedding = row.embedding is not None and row.embedding_model == model and len(row.embedding) == blob_size
+        if not has_embedding and near_duplicates is not None:
+            original = int(near_duplicates.find(np.array([row.simhash], dtype=np.int64), all_alive)[0])
+            if original >= 0:
+                references.append((position, original))
+                continue
+        (stored if has_embedding else to_embed).append(position)
+        if near_duplicates is not None:
+            near_duplicates.add(np.array([position]), np.array([row.simhash], dtype=np.int64))
+
+    result = await embedder.embed([rows[position].content for position in to_embed])
+    indices, embeddings = result.successful()
+    embedded = [to_embed[i] for i in indices.tolist()]
+    if embedded:
+        db.execute(update(DocumentChunk), [
+            {'id': rows[position].id, 'embedding': encode_embedding(embedding), 'embedding_model': model}
+            for position, embedding in zip(embedded, embeddings)
+        ])
+        db.commit()
+
+    # 新しいインデックスのチャンクは行の順に並べる
+    positions = sorted(stored + embedded)
+    vectors = np.zeros((len(rows), dimension), dtype=np.float32)
+    vectors[stored] = decode_embeddings([rows[position].embedding for position in stored], dimension)
+    vectors[embedded] = embeddings
+    chunk_ids = {position: chunk_id for chunk_id, position in enumerate(positions)}
+    metadatas = [
+        {
+            'document_id': rows[position].document_id,
+            'title': documents[rows[position].document_id][0],
+            'content': rows[position].content,
+            'start': rows[position].start_offset,
+            'end': rows[position].end_offset,
+            'simhash': rows[position].simhash,
+        }
+        for position in positions
+    ]
+    # 参照先の埋め込みに失敗したチャンクは次の再構築で埋め込む
+    kept = [(position, original) for position, original in references if original in chunk_ids]
+    vector_store = load_vector_store()
+    await asyncio.to_thread(
+        vector_store.replace_chunks, vectors[positions], metadatas, [
+            (chunk_ids[original], rows[position].document_id, rows[position].start_offset, rows[position].end_offset)
+            for position, original in kept
+        ]
+    )
+
+    summary = {
+        'documents': len(documents),
+        'documents_chunked': chunked,
+        'chunks_total': len(rows),
+        'chunks_reused': len(stored),
+        'chunks_embedded': len(embedded),
+        'chunks_deduplicated': len(kept),
+        'chunks_failed': len(rows) - len(positions) - len(kept),
+    }
+    if result.errors:
+        logger.error(f"Failed to embed {len(result.errors)} chunks for user {user_id}: "
+                     f"{result.errors[result.failed_indices[0]]}")
+    logger.info(f"Rebuilt index for user {user_id} from database: {summary}")
+    return summary
+
+
+async def _rebuild(user_ids, all_users: bool):
+    from app.config import settings
+    from app.database import SessionLocal
+    from app.models.user import User
+    from app.services.embedding_batcher import get_batch_embedder
+    from app.services.embeddings import get_embedding_service
+    from app.services.vector_store import discard_vector_store, get_vector_store
+
+    embedding_service = get_embedding_service()
+
+    def fresh_store(user_id: int):
+        discard_vector_store(user_id, settings.VECTOR_STORE_DIR)
+        return get_vector_store(user_id)
+
+    db = SessionLocal()
+    try:
+        if all_users:
+            user_ids = [user_id for (user_id,) in db.query(User.id).order_by(User.id)]
+        for user_id in user_ids:
+            summary = await rebuild_user_index(
+                db,
+                user_id,
+                get_batch_embedder(),
+                lambda: fresh_store(user_id),
+                embedding_service.dimension,
+                model=embedding_service.model_name,
+                max_length=settings.CHUNK_MAX_CHARS,
+                overlap=settings.CHUNK_OVERLAP,
+                max_tokens=settings.CHUNK_MAX_TOKENS or None,
+                dedup_max_distance=settings.DEDUP_MAX_DISTANCE if settings.DEDUP_ENABLED else None
+            )
+            print(f"user {user_id}: {summary}")
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--user-id", type=int, action="append", help="作り直すユーザーのID（複数指定可）")
+    target.add_argument("--all", action="store_true", help="全ユーザーを作り直す")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_rebuild(args.user_id, args.all))
+
+
+if __name__ == "__main__":
+    main()
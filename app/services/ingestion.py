@@ -0,0 +1,708 @@
+"""
+バックグラウンドの取り込みパイプライン
+アップロードはファイルを一時保存してジョブを登録するだけにし、重い処理はワーカーで行う
+
+抽出 → チャンク分割 → 埋め込み → インデックス追加 の各段階を別々のワーカーが担当し、
+段階の間を上限付きのキューでつなぐ（あるファイルの埋め込み中に次のファイルの抽出を進める）。
+失敗したジョブは失敗した段階から指数バックオフで再試行し、上限に達したら dead_letter として
+エラーの履歴と一時ファイルを残す。処理中に再起動した場合は起動時に最初からやり直す
+
+アップロードはブロックごとにディスクへ書き出し、抽出したテキストもページごとに
+一時ファイルへ書き出してから、チャンク分割が少しずつ読む。チャンクは chunk_group_size 件ずつの
+グループで埋め込み・インデックス追加まで進め、追加し終えたら次のグループを分割する
+（ファイルの大きさによらず、1ジョブが持つチャンクは1グループ分まで）
+"""
+import asyncio
+import codecs
+import itertools
+import json
+import logging
+import shutil
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+import numpy as np
+
+from app.models.document import Document
+from app.models.ingestion_job import STAGES, IngestionJob
+from app.services.chunk_store import embeddings_by_hash, save_document_chunks, save_restored_embeddings
+from app.services.chunking import TextChunk, iter_text_chunks
+from app.services.dedup import (
+    DuplicateMatches, add_deduplicated, find_duplicates, load_documents, restore_references, simhashes
+)
+from app.services.pdf_extraction import PdfExtractionTimeout, PdfExtractor, PdfWorkerLost
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_RETRYING = "retrying"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_DEAD_LETTER = "dead_letter"
+# 再起動時にやり直す状態
+UNFINISHED_STATUSES = (STATUS_QUEUED, STATUS_RUNNING, STATUS_RETRYING)
+
+STAGE_EXTRACT, STAGE_CHUNK, STAGE_EMBED, STAGE_INDEX = STAGES
+
+DEAD_LETTER_DIR = "dead_letter"
+# アップロードの書き出しとテキストファイルの読み込みの単位
+BLOCK_SIZE = 64 * 1024
+# 本文のカラムへ1回の UPDATE で連結する最大文字数
+CONTENT_WRITE_CHARS = 1024 * 1024
+
+
+class IngestionError(Exception):
+    """取り込みの失敗（retryable=False なら再試行せずに dead_letter にする）"""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def is_pdf(filename: str, content_type: Optional[str]) -> bool:
+    return content_type == "application/pdf" or filename.lower().endswith('.pdf')
+
+
+class UploadTooLargeError(Exception):
+    """アップロードが上限サイズを超えた"""
+
+
+def iter_text(path: Path, filename: str, content_type: Optional[str],
+              pdf_extractor: PdfExtractor) -> Iterator[str]:
+    """
+    一時保存したファイルからテキストを少しずつ抽出（PDFかUTF-8のテキスト）
+
+    PDFは1ページずつ（抽出はプロセスプールで並列に行う）、テキストはブロックごとに返す
+    """
+    if is_pdf(filename, content_type):
+        try:
+            yield from pdf_extractor.iter_pages(path)
+        except PdfExtractionTimeout:
+            raise IngestionError(
+                f"PDFのテキスト抽出が{pdf_extractor.timeout:g}秒以内に終わりませんでした", retryable=False
+            )
+        except PdfWorkerLost as e:
+            raise IngestionError(str(e))
+        except Exception as e:
+            raise IngestionError(f"PDFの読み取りに失敗しました: {str(e)}", retryable=False)
+        return
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                text = decoder.decode(block, final=not block)
+                if text:
+                    yield text
+                if not block:
+                    return
+    except UnicodeDecodeError:
+        raise IngestionError("UTF-8でデコードできません", retryable=False)
+
+
+def iter_file_text(path: Path) -> Iterator[str]:
+    """抽出済みのテキストファイルをブロックごとに読む"""
+    with open(path, encoding='utf-8') as f:
+        while True:
+            text = f.read(BLOCK_SIZE)
+            if not text:
+                return
+            yield text
+
+
+class _Work:
+    """パイプラインを流れる1ジョブ分の作業（段階ごとの途中結果を持つ）"""
+
+    def __init__(self, job: IngestionJob, title: str, recovered: bool = False):
+        self.job_id = job.id
+        self.user_id = job.user_id
+        self.document_id = job.document_id
+        self.title = title
+        self.filename = job.filename
+        self.content_type = job.content_type
+        self.source_path = Path(job.source_path) if job.source_path else None
+        self.attempts = job.attempts
+        # 再起動前にインデックスへ途中まで追加していた可能性がある
+        self.recovered = recovered
+
+        # 抽出したテキストの一時ファイル
+        self.text_path: Optional[Path] = None
+        # 本文として保存する時に先頭から除いた空白の文字数（チャンクの位置を本文上の位置にずらす）
+        self.text_offset = 0
+        self.reset_chunks()
+
+    def reset_chunks(self):
+        """チャンク分割を最初からやり直す状態にする（再試行時）"""
+        self.close_chunks()
+        # テキストファイルから続きのチャンクを返すイテレータ
+        self.chunk_iter: Optional[Iterator[TextChunk]] = None
+        # 今のグループのチャンクと、その前までにインデックスへ追加したチャンク数（グループの先頭の位置）
+        self.chunks: List[TextChunk] = []
+        self.chunks_done = 0
+        self.last_group = False
+        # チャンクごとのSimHashと、ほぼ同じ既存チャンク・先に出てくるチャンクとの突き合わせ結果
+        self.simhashes: Optional[np.ndarray] = None
+        self.matches: Optional[DuplicateMatches] = None
+        # 埋め込むチャンクの位置（embedding_result の各行がどのチャンクか）
+        self.unique: Optional[np.ndarray] = None
+        self.embedding_result = None
+        # 前のグループまでの件数
+        self.indexed = 0
+        self.deduplicated = 0
+        self.failed_chunks: List[dict] = []
+
+    def close_chunks(self):
+        chunk_iter = getattr(self, 'chunk_iter', None)
+        if chunk_iter is not None:
+            chunk_iter.close()
+            self.chunk_iter = None
+
+
+class IngestionPipeline:
+    def __init__(
+        self,
+        session_factory: Callable,
+        embedder_factory: Callable,
+        vector_store_factory: Callable,
+        pdf_extractor: Optional[PdfExtractor] = None,
+        spool_dir: str = "./ingestion_spool",
+        workers: int = 2,
+        queue_size: int = 8,
+        max_attempts: int = 3,
+        retry_backoff: float = 2.0,
+        chunk_max_length: int = 800,
+        chunk_overlap: int = 100,
+        chunk_max_tokens: Optional[int] = None,
+        chunk_group_size: int = 256,
+        dedup_max_distance: Optional[int] = 3,
+    ):
+        """
+        Args:
+            session_factory: DBセッションを作る関数（ワーカーはリクエストと別のセッションを使う）
+            embedder_factory: BatchEmbedder を返す関数
+            vector_store_factory: ユーザーIDから VectorStore を返す関数
+            pdf_extractor: PDFのテキスト抽出（Noneならプロセスを使わずに抽出する）
+            spool_dir: アップロードファイルの一時保存先
+            workers: 抽出・埋め込みの段階それぞれのワーカー数（チャンク分割とインデックス追加は1つ）
+            queue_size: 段階の間のキューの上限（前の段階が先に進みすぎないようにする）
+            max_attempts: 1ジョブの最大試行回数
+            retry_backoff: 1回目の再試行までの待ち時間（秒）。以降は倍々に伸ばす
+            chunk_max_length: 1チャンクの最大文字数
+            chunk_overlap: 前のチャンクと重ねる最大文字数
+            chunk_max_tokens: 1チャンクの最大トークン数（Noneなら数えない）
+            chunk_group_size: 一度に埋め込み・インデックス追加まで進めるチャンク数
+            dedup_max_distance: ユーザーのインデックスにある既存チャンクとSimHashのハミング距離がこれ以下の
+                チャンクは埋め込まずに既存チャンクを参照する（Noneなら重複を除かない）
+        """
+        self.session_factory = session_factory
+        self.embedder_factory = embedder_factory
+        self.vector_store_factory = vector_store_factory
+        self.pdf_extractor = pdf_extractor or PdfExtractor(workers=0)
+        self.spool_dir = Path(spool_dir)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.chunk_max_length = chunk_max_length
+        self.chunk_overlap = chunk_overlap
+        self.chunk_max_tokens = chunk_max_tokens
+        self.chunk_group_size = chunk_group_size
+        self.dedup_max_distance = dedup_max_distance
+
+        # 新しいジョブは受け付けを止めないように上限なし、段階の間は上限付き。
+        # チャンク分割のキューにはインデックス追加から次のグループのジョブが戻るので上限なしにする
+        # （上限があると段階が輪になって詰まる。ここで待つジョブはチャンクを持たない）
+        self._queues: Dict[str, asyncio.Queue] = {
+            STAGE_EXTRACT: asyncio.Queue(),
+            STAGE_CHUNK: asyncio.Queue(),
+            STAGE_EMBED: asyncio.Queue(queue_size),
+            STAGE_INDEX: asyncio.Queue(queue_size),
+        }
+        self._tasks: List[asyncio.Task] = []
+        # 待ち時間の後に再投入するタスク（イベントループは弱参照しか持たないので、終わるまでここで参照を持つ）
+        self._retry_tasks: Set[asyncio.Task] = set()
+
+        self.succeeded = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.deduplicated = 0
+
+    # --- 起動・停止 ---
+
+    async def start(self):
+        """ワーカーを起動し、前回終了時に処理中だったジョブを再投入する"""
+        if self._tasks:
+            return
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        concurrency = {STAGE_EXTRACT: self.workers, STAGE_CHUNK: 1, STAGE_EMBED: self.workers, STAGE_INDEX: 1}
+        for stage, count in concurrency.items():
+            for i in range(count):
+                self._tasks.append(asyncio.create_task(self._worker(stage), name=f"ingestion-{stage}-{i}"))
+        await self._recover()
+
+    async def stop(self):
+        """ワーカーを止める（処理中のジョブは次回起動時にやり直す）"""
+        retry_tasks = list(self._retry_tasks)
+        for task in self._tasks + retry_tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *retry_tasks, return_exceptions=True)
+        self._tasks = []
+        self._retry_tasks.clear()
+        self.pdf_extractor.close()
+
+    async def _recover(self):
+        jobs = await asyncio.to_thread(self._load_unfinished_jobs)
+        for job, title in jobs:
+            await self._queues[STAGE_EXTRACT].put(_Work(job, title, recovered=True))
+        if jobs:
+            logger.info(f"Re-queued {len(jobs)} unfinished ingestion jobs")
+
+    def _load_unfinished_jobs(self):
+        db = self.session_factory()
+        try:
+            rows = db.query(IngestionJob, Document.title)\
+                .join(Document, Document.id == IngestionJob.document_id)\
+                .filter(IngestionJob.status.in_(UNFINISHED_STATUSES))\
+                .order_by(IngestionJob.id)\
+                .all()
+            return [(job, title) for job, title in rows]
+        finally:
+            db.close()
+
+    # --- 受け付け ---
+
+    async def spool_upload(self, upload, max_bytes: int) -> Path:
+        """
+        アップロードされたファイルをブロックごとに一時保存し、そのパスを返す
+
+        上限を超えた時点で書き込みをやめて UploadTooLargeError を送出する（全体をメモリに読み込まない）
+
+        Args:
+            upload: 非同期の read(size) を持つファイル（FastAPIのUploadFile）
+        """
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spool_dir / f"{uuid.uuid4().hex}{Path(upload.filename or '').suffix.lower()}"
+        size = 0
+        try:
+            with open(path, 'wb') as f:
+                while True:
+                    block = await upload.read(BLOCK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > max_bytes:
+                        raise UploadTooLargeError(f"Upload exceeds {max_bytes} bytes")
+                    await asyncio.to_thread(f.write, block)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        return path
+
+    async def submit(self, db, document: Document, filename: str, content_type: Optional[str],
+                     source_path: Path) -> IngestionJob:
+        """ジョブを登録してキューに入れる（登録をコミットしてからキューに入れる）"""
+        job = IngestionJob(
+            user_id=document.user_id,
+            document_id=document.id,
+            status=STATUS_QUEUED,
+            stage=STAGE_EXTRACT,
+            attempts=0,
+            max_attempts=self.max_attempts,
+            filename=filename,
+            content_type=content_type,
+            source_path=str(source_path),
+            chunks_total=0,
+            chunks_indexed=0
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        await self._queues[STAGE_EXTRACT].put(_Work(job, document.title))
+        return job
+
+    # --- ワーカー ---
+
+    async def _worker(self, stage: str):
+        handler = getattr(self, f"_{stage}")
+        next_stage = self._next_stage(stage)
+        queue = self._queues[stage]
+        while True:
+            work = await queue.get()
+            try:
+                await self._update_job(work.job_id, status=STATUS_RUNNING, stage=stage)
+                done = await handler(work)
+                if done:
+                    await self._finish(work)
+                else:
+                    await self._queues[next_stage].put(work)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                try:
+                    await self._fail(work, stage, e)
+                except Exception:
+                    # DBに書けないなどで記録できなくても、ワーカー自体は止めない
+                    logger.exception(f"Failed to record failure of ingestion job {work.job_id}")
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    def _next_stage(stage: str) -> str:
+        # インデックス追加の後は、次のグループのためにチャンク分割へ戻る
+        if stage == STAGE_INDEX:
+            return STAGE_CHUNK
+        return STAGES[STAGES.index(stage) + 1]
+
+    async def _extract(self, work: _Work) -> bool:
+        if work.source_path is None or not work.source_path.exists():
+            raise IngestionError("アップロードファイルが見つかりません", retryable=False)
+        work.text_path = work.source_path.with_name(f"{work.source_path.stem}.extracted.txt")
+        await asyncio.to_thread(self._extract_to_file, work)
+        work.text_offset = await asyncio.to_thread(self._save_content, work.document_id, work.text_path)
+        return False
+
+    def _extract_to_file(self, work: _Work):
+        """抽出したテキストをページ（ブロック）ごとに一時ファイルへ書き出す"""
+        with open(work.text_path, 'w', encoding='utf-8') as f:
+            for text in iter_text(work.source_path, work.filename, work.content_type, self.pdf_extractor):
+                f.write(text)
+
+    async def _chunk(self, work: _Work) -> bool:
+        """次のグループのチャンクを分割する（残りがなければ完了）"""
+        if work.chunk_iter is None:
+            work.chunk_iter = iter_text_chunks(
+                iter_file_text(work.text_path), self.chunk_max_length, self.chunk_overlap, self.chunk_max_tokens
+            )
+        work.chunks = await asyncio.to_thread(
+            lambda: list(itertools.islice(work.chunk_iter, self.chunk_group_size))
+        )
+        work.last_group = len(work.chunks) < self.chunk_group_size
+        # 分割し終えるまでは、ここまでに見つかったチャンク数
+        await self._update_job(work.job_id, chunks_total=work.chunks_done + len(work.chunks))
+        # 残りがなければ（本文が空の場合も）インデックスに追加するものはない
+        return not work.chunks
+
+    async def _embed(self, work: _Work) -> bool:
+        texts = [chunk.text for chunk in work.chunks]
+        work.simhashes = await asyncio.to_thread(simhashes, texts)
+        # ストアの読み込み（スナップショット・ログの再生）はイベントループを止めないようスレッドで行う
+        vector_store = await asyncio.to_thread(self.vector_store_factory, work.user_id)
+        work.matches = await asyncio.to_thread(
+            find_duplicates, vector_store, work.simhashes, self.dedup_max_distance
+        )
+        # ほぼ同じチャンクがあるものは埋め込まない
+        work.unique = work.matches.unique
+        result = await self.embedder_factory().embed([texts[i] for i in work.unique])
+        if len(work.unique) > 0 and not result.succeeded.any():
+            raise IngestionError(f"全チャンクの埋め込みに失敗しました: {result.errors[0]}")
+        work.embedding_result = result
+        return False
+
+    def _metadata(self, work: _Work, position: int) -> dict:
+        chunk = work.chunks[position]
+        return {
+            'document_id': work.document_id,
+            'title': work.title,
+            'content': chunk.text,
+            'start': chunk.start - work.text_offset,
+            'end': chunk.end - work.text_offset,
+            'simhash': int(work.simhashes[position]),
+        }
+
+    async def _index(self, work: _Work) -> bool:
+        result = work.embedding_result
+        indices, embeddings = result.successful()
+        positions = work.unique[indices]
+        duplicates = work.matches.duplicates
+        # 前回の試行の分を消すのは最初のグループを追加する時だけ
+        retry = work.chunks_done == 0 and (work.recovered or work.attempts > 0)
+        orphaned, missing = await asyncio.to_thread(self._add_to_index, work, positions, embeddings, retry)
+        vector_store = await asyncio.to_thread(self.vector_store_factory, work.user_id)
+        failed_chunks = [
+            {'index': work.chunks_done + int(work.unique[i]), 'error': result.errors[i]} for i in result.failed_indices
+        ]
+        vectors = embeddings_by_hash([work.chunks[i].text for i in positions.tolist()], embeddings)
+
+        # 参照先が埋め込みの間に削除されていた（または埋め込みに失敗した）チャンクは、ここで埋め込んで追加する
+        indexed = len(positions)
+        if len(missing) > 0:
+            missing_result = await self.embedder_factory().embed([work.chunks[i].text for i in missing])
+            missing_indices, missing_embeddings = missing_result.successful()
+            await asyncio.to_thread(
+                vector_store.add_documents,
+                missing_embeddings, [self._metadata(work, position) for position in missing[missing_indices].tolist()]
+            )
+            indexed += len(missing_indices)
+            vectors.update(embeddings_by_hash(
+                [work.chunks[i].text for i in missing[missing_indices].tolist()], missing_embeddings
+            ))
+            failed_chunks.extend(
+                {'index': work.chunks_done + int(missing[i]), 'error': missing_result.errors[i]}
+                for i in missing_result.failed_indices
+            )
+
+        # 前回の試行で追加したチャンクを参照していたほかのドキュメントの箇所を埋め込み直す
+        await restore_references(
+            vector_store, self.embedder_factory(), self._load_documents, orphaned, self._save_restored_embeddings
+        )
+
+        # 埋め込みをDBにも残す（参照で済ませたチャンクと失敗したチャンクは埋め込みなし）
+        await asyncio.to_thread(self._save_chunks, work, vectors)
+
+        deduplicated = len(duplicates) - len(missing)
+        self.deduplicated += deduplicated
+        work.indexed += indexed
+        work.deduplicated += deduplicated
+        work.failed_chunks.extend(sorted(failed_chunks, key=lambda failure: failure['index']))
+        work.chunks_done += len(work.chunks)
+        await self._update_job(
+            work.job_id,
+            chunks_indexed=work.indexed,
+            chunks_deduplicated=work.deduplicated,
+            failed_chunks=json.dumps(work.failed_chunks, ensure_ascii=False)
+        )
+        if deduplicated:
+            logger.info(
+                f"Ingestion job {work.job_id}: {deduplicated} of {len(work.chunks)} chunks "
+                f"referenced near-duplicates"
+            )
+        # グループのチャンクを手放してから次のグループへ
+        work.chunks, work.simhashes, work.matches, work.unique, work.embedding_result = [], None, None, None, None
+        return work.last_group
+
+    def _add_to_index(self, work: _Work, positions: np.ndarray, embeddings, retry: bool):
+        """
+        埋め込んだチャンクを追加し、ほぼ同じチャンクがあるものは参照として記録する
+
+        前回の試行の分を消した時に参照を失った箇所と、参照先がなかったチャンクの位置を返す
+        """
+        if not self._document_exists(work.document_id):
+            raise IngestionError("ドキュメントは削除されています", retryable=False)
+        vector_store = self.vector_store_factory(work.user_id)
+        orphaned = []
+        if retry:
+            # 前回の試行で追加済みのチャンクを重複させない
+            orphaned = vector_store.remove_document(work.document_id)
+        metadatas = [self._metadata(work, position) for position in range(len(work.chunks))]
+        missing = add_deduplicated(vector_store, work.matches, positions, embeddings, metadatas)
+        return orphaned, missing
+
+    def _save_chunks(self, work: _Work, embeddings: dict):
+        """グループのチャンクの行を書く（前回の試行で書いた同じ位置の行は書き直す）"""
+        model = self.vector_store_factory(work.user_id).embedding_model
+        metadatas = [self._metadata(work, position) for position in range(len(work.chunks))]
+        db = self.session_factory()
+        try:
+            save_document_chunks(
+                db, work.user_id, work.document_id, metadatas, embeddings, model,
+                first_position=work.chunks_done, last=work.last_group
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    # --- 完了・失敗 ---
+
+    async def _finish(self, work: _Work):
+        self._remove_text(work)
+        if work.source_path is not None:
+            work.source_path.unlink(missing_ok=True)
+        await self._update_job(work.job_id, status=STATUS_SUCCEEDED, stage=None,
+                               source_path=None, error=None, finished_at=datetime.utcnow())
+        self.succeeded += 1
+        logger.info(f"Ingestion job {work.job_id} succeeded (document {work.document_id})")
+
+    async def _fail(self, work: _Work, stage: str, error: Exception):
+        work.attempts += 1
+        message = str(error) or type(error).__name__
+        retryable = getattr(error, 'retryable', True)
+        error_log = await asyncio.to_thread(
+            self._append_error, work.job_id, {'attempt': work.attempts, 'stage': stage, 'error': message}
+        )
+        if error_log is None:
+            # ドキュメントごと削除された
+            logger.info(f"Ingestion job {work.job_id} was deleted; dropping it")
+            return
+
+        if retryable and work.attempts < self.max_attempts:
+            delay = self.retry_backoff * 2 ** (work.attempts - 1)
+            if stage != STAGE_EXTRACT:
+                # 前のグループまで追加済みの分も含め、チャンク分割から最初のグループをやり直す
+                # （最初のグループの追加時に、前回の試行で追加したチャンクを消す）
+                work.reset_chunks()
+                stage = STAGE_CHUNK
+            await self._update_job(work.job_id, status=STATUS_RETRYING, stage=stage,
+                                   attempts=work.attempts, error=message)
+            self.retried += 1
+            logger.warning(f"Ingestion job {work.job_id} failed at {stage} ({message}); retrying in {delay:.1f}s")
+            task = asyncio.create_task(self._requeue_later(work, stage, delay))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+            return
+
+        self._remove_text(work)
+        source_path = await asyncio.to_thread(self._keep_for_dead_letter, work)
+        await self._update_job(work.job_id, status=STATUS_DEAD_LETTER, stage=stage, attempts=work.attempts,
+                               error=message, source_path=source_path, finished_at=datetime.utcnow())
+        self.dead_lettered += 1
+        logger.error(f"Ingestion job {work.job_id} moved to dead letter after {work.attempts} attempts: {message}")
+
+    async def _requeue_later(self, work: _Work, stage: str, delay: float):
+        await asyncio.sleep(delay)
+        await self._queues[stage].put(work)
+
+    @staticmethod
+    def _remove_text(work: _Work):
+        work.close_chunks()
+        if work.text_path is not None:
+            work.text_path.unlink(missing_ok=True)
+
+    def _keep_for_dead_letter(self, work: _Work) -> Optional[str]:
+        """再処理できるように一時ファイルを dead_letter ディレクトリに移す"""
+        if work.source_path is None or not work.source_path.exists():
+            return None
+        directory = self.spool_dir / DEAD_LETTER_DIR
+        directory.mkdir(parents=True, exist_ok=True)
+        destination = directory / f"job_{work.job_id}{work.source_path.suffix}"
+        shutil.move(str(work.source_path), destination)
+        return str(destination)
+
+    # --- DB ---
+
+    async def _update_job(self, job_id: int, **fields):
+        await asyncio.to_thread(self._update_job_sync, job_id, fields)
+
+    def _update_job_sync(self, job_id: int, fields: dict):
+        db = self.session_factory()
+        try:
+            db.query(IngestionJob).filter(IngestionJob.id == job_id)\
+                .update({**fields, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _append_error(self, job_id: int, entry: dict) -> Optional[list]:
+        db = self.session_factory()
+        try:
+            job = db.query(IngestionJob).filter(IngestionJob.id == job_id).first()
+            if job is None:
+                return None
+            error_log = json.loads(job.error_log) if job.error_log else []
+            error_log.append(entry)
+            job.error_log = json.dumps(error_log, ensure_ascii=False)
+            db.commit()
+            return error_log
+        finally:
+            db.close()
+
+    def _document_exists(self, document_id: int) -> bool:
+        db = self.session_factory()
+        try:
+            return db.query(Document.id).filter(Document.id == document_id).first() is not None
+        finally:
+            db.close()
+
+    def _load_documents(self, document_ids: List[int]) -> dict:
+        db = self.session_factory()
+        try:
+            return load_documents(db, document_ids)
+        finally:
+            db.close()
+
+    def _save_restored_embeddings(self, metadatas: List[dict], embeddings, model: Optional[str]):
+        db = self.session_factory()
+        try:
+            save_restored_embeddings(db, metadatas, embeddings, model)
+            db.commit()
+        finally:
+            db.close()
+
+    def _save_content(self, document_id: int, text_path: Path) -> int:
+        """
+        抽出したテキストを前後の空白を除いて本文に保存し、先頭から除いた文字数を返す
+
+        全体を1つの文字列として読み込まず、CONTENT_WRITE_CHARS 文字ずつ本文の末尾に連結する
+        （コミットは最後に1回なので、途中までの本文は見えない）。末尾の空白は続きがあるまで書かずに持っておく
+        """
+        db = self.session_factory()
+        try:
+            documents = db.query(Document).filter(Document.id == document_id)
+            documents.update({'content': ""}, synchronize_session=False)
+            offset = 0
+            started = False
+            pending = []
+            pending_chars = 0
+            trailing = ""
+            for block in iter_file_text(text_path):
+                if not started:
+                    stripped = block.lstrip()
+                    offset += len(block) - len(stripped)
+                    if not stripped:
+                        continue
+                    started = True
+                    block = stripped
+                body = block.rstrip()
+                if not body:
+                    trailing += block
+                    continue
+                pending.append(trailing + body)
+                pending_chars += len(pending[-1])
+                trailing = block[len(body):]
+                if pending_chars >= CONTENT_WRITE_CHARS:
+                    documents.update({'content': Document.content + "".join(pending)}, synchronize_session=False)
+                    pending, pending_chars = [], 0
+            if pending:
+                documents.update({'content': Document.content + "".join(pending)}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        return offset
+
+    def stats(self) -> dict:
+        return {
+            'queued': {stage: queue.qsize() for stage, queue in self._queues.items()},
+            'succeeded': self.succeeded,
+            'retried': self.retried,
+            'dead_lettered': self.dead_lettered,
+            'deduplicated': self.deduplicated,
+            'pdf_extraction': self.pdf_extractor.stats(),
+        }
+
+
+# シングルトン管理
+_ingestion_pipeline: Optional[IngestionPipeline] = None
+
+
+def get_ingestion_pipeline() -> IngestionPipeline:
+    """取り込みパイプラインを取得（プロセス全体で共有）"""
+    global _ingestion_pipeline
+    if _ingestion_pipeline is None:
+        from app.config import settings
+        from app.database import SessionLocal
+        from app.services.embedding_batcher import get_batch_embedder
+        from app.services.vector_store import get_vector_store
+
+        _ingestion_pipeline = IngestionPipeline(
+            SessionLocal,
+            get_batch_embedder,
+            get_vector_store,
+            pdf_extractor=PdfExtractor(
+                workers=settings.PDF_EXTRACT_WORKERS,
+                pages_per_task=settings.PDF_PAGES_PER_TASK,
+                timeout=settings.PDF_EXTRACT_TIMEOUT
+            ),
+            spool_dir=settings.INGESTION_SPOOL_DIR,
+            workers=settings.INGESTION_WORKERS,
+            queue_size=settings.INGESTION_QUEUE_SIZE,
+            max_attempts=settings.INGESTION_MAX_ATTEMPTS,
+            retry_backoff=settings.INGESTION_RETRY_BACKOFF,
+            chunk_max_length=settings.CHUNK_MAX_CHARS,
+            chunk_overlap=settings.CHUNK_OVERLAP,
+            chunk_max_tokens=settings.CHUNK_MAX_TOKENS or None,
+            chunk_group_size=settings.INGESTION_CHUNK_GROUP_SIZE,
+            dedup_max_distance=settings.DEDUP_MAX_DISTANCE if settings.DEDUP_ENABLED else None
+        )
+    return _ingestion_pipeline
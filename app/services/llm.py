@@ -0,0 +1,41 @@
+"""
+LLM（Groq）クライアント
+OpenAI互換APIの非同期クライアントをプロセス全体で共有し、接続プールを使い回す
+"""
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from app.config import settings
+
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+
+# シングルトン管理
+_llm_client: Optional[AsyncOpenAI] = None
+
+
+def get_llm_client() -> AsyncOpenAI:
+    """LLMクライアントを取得（最初の呼び出しで作成し、以降は同じインスタンスを返す）"""
+    global _llm_client
+    if _llm_client is None:
+        _llm_client = AsyncOpenAI(
+            api_key=settings.GROQ_API_KEY,
+            base_url=GROQ_BASE_URL,
+            timeout=settings.LLM_TIMEOUT,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=settings.LLM_HTTP_POOL_SIZE,
+                    max_keepalive_connections=settings.LLM_HTTP_POOL_SIZE
+                )
+            )
+        )
+    return _llm_client
+
+
+async def close_llm_client():
+    """共有のLLMクライアントの接続を閉じる（アプリ終了時）"""
+    global _llm_client
+    if _llm_client is not None:
+        await _llm_client.close()
+        _llm_client = None
@@ -0,0 +1,216 @@
+"""
+NumPyだけで動くベクトル検索エンジン
+FAISSが使えない環境向けのフラット（厳密）インデックス
+
+ベクトルは事前確保して倍々に伸ばす連続した行列（float32 または float16）に持ち、
+検索は行列積1回 + argpartition で上位k件を求める。
+スナップショットはFAISSの IndexIDMap2(IndexFlatIP) と同じバイナリ形式で読み書きするので、
+FAISSエンジンとNumPyエンジンは同じストアをそのまま開ける
+"""
+import struct
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from app.services.vector_index import (
+    FULL_IDS_FILE, FULL_VECTORS_FILE, INDEX_FILE, INDEX_FLAT, VectorIndex
+)
+
+# FAISSのインデックスヘッダー: d(int32), ntotal(int64), dummy(int64) x2, is_trained(uint8), metric_type(int32)
+_FAISS_HEADER = struct.Struct("<iqqqBi")
+_FAISS_DUMMY = 1 << 20
+_METRIC_INNER_PRODUCT = 0
+_FOURCC_ID_MAP2 = b"IxM2"
+_FOURCC_FLAT_IP = b"IxFI"
+
+_INITIAL_CAPACITY = 1024
+# 検索時にfloat32へ変換しながら処理する行数（float16の行列を一度に展開しないため）
+_SEARCH_BLOCK_ROWS = 16384
+
+
+def _read_header(buffer: np.ndarray, offset: int, fourcc: bytes) -> Tuple[int, int, int]:
+    if buffer[offset:offset + 4].tobytes() != fourcc:
+        raise ValueError(f"Unsupported FAISS index type: {buffer[offset:offset + 4].tobytes()!r}")
+    offset += 4
+    d, ntotal, _, _, _, metric = _FAISS_HEADER.unpack(buffer[offset:offset + _FAISS_HEADER.size].tobytes())
+    if metric != _METRIC_INNER_PRODUCT:
+        raise ValueError(f"Unsupported FAISS metric type: {metric}")
+    return d, ntotal, offset + _FAISS_HEADER.size
+
+
+def read_faiss_flat(path: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    FAISSの IndexIDMap2(IndexFlatIP) または IndexFlatIP のファイルをmmapで読む
+
+    Returns:
+        (チャンクID, ベクトル行列)。ベクトルはファイルをmmapしたビュー
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    offset = 0
+    has_id_map = buffer[:4].tobytes() == _FOURCC_ID_MAP2
+    if has_id_map:
+        _, _, offset = _read_header(buffer, offset, _FOURCC_ID_MAP2)
+    d, ntotal, offset = _read_header(buffer, offset, _FOURCC_FLAT_IP)
+
+    (count,) = struct.unpack("<Q", buffer[offset:offset + 8].tobytes())
+    offset += 8
+    if count != ntotal * d:
+        raise ValueError(f"Corrupted FAISS flat index: {count} floats for {ntotal}x{d}")
+    vectors = np.ndarray((ntotal, d), dtype=np.float32, buffer=buffer, offset=offset)
+    offset += count * 4
+
+    if has_id_map:
+        (id_count,) = struct.unpack("<Q", buffer[offset:offset + 8].tobytes())
+        ids = np.ndarray((id_count,), dtype=np.int64, buffer=buffer, offset=offset + 8)
+    else:
+        ids = np.arange(ntotal, dtype=np.int64)
+    return ids, vectors
+
+
+def write_faiss_flat(path: Path, ids: np.ndarray, vectors: np.ndarray):
+    """FAISSの IndexIDMap2(IndexFlatIP) と同じ形式で書き出す（float16はfloat32に戻して書く）"""
+    ntotal, d = vectors.shape
+    header = _FAISS_HEADER.pack(d, ntotal, _FAISS_DUMMY, _FAISS_DUMMY, 1, _METRIC_INNER_PRODUCT)
+    with open(path, 'wb') as f:
+        f.write(_FOURCC_ID_MAP2 + header)
+        f.write(_FOURCC_FLAT_IP + header)
+        f.write(struct.pack("<Q", ntotal * d))
+        for start in range(0, ntotal, _SEARCH_BLOCK_ROWS):
+            f.write(np.ascontiguousarray(vectors[start:start + _SEARCH_BLOCK_ROWS], dtype=np.float32).tobytes())
+        f.write(struct.pack("<Q", ntotal))
+        f.write(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+
+
+class NumpyFlatIndex(VectorIndex):
+    """NumPyの行列でベクトルを持つフラットインデックス（FAISSのFlatIndexと同じインターフェース）"""
+
+    kind = INDEX_FLAT
+
+    def __init__(self, dimension: int, dtype=np.float32,
+                 ids: Optional[np.ndarray] = None, vectors: Optional[np.ndarray] = None, mapped: bool = False):
+        super().__init__(None, mapped=mapped)
+        self._dimension = dimension
+        self.dtype = np.dtype(dtype)
+        if vectors is None:
+            self._ids = np.zeros(_INITIAL_CAPACITY, dtype=np.int64)
+            self._vectors = np.zeros((_INITIAL_CAPACITY, dimension), dtype=self.dtype)
+            self._size = 0
+        else:
+            self._ids = ids
+            self._vectors = vectors
+            self._size = len(ids)
+
+    @classmethod
+    def create(cls, dimension: int, dtype=np.float32) -> "NumpyFlatIndex":
+        return cls(dimension, dtype)
+
+    @classmethod
+    def load(cls, directory: Path, dtype=np.float32) -> "NumpyFlatIndex":
+        """
+        フラットインデックスのスナップショットをmmapで開く
+
+        量子化インデックスのスナップショットは再スコアリング用の非圧縮ベクトルから開く
+        """
+        directory = Path(directory)
+        full_vectors = directory / FULL_VECTORS_FILE
+        if full_vectors.exists():
+            ids = np.load(directory / FULL_IDS_FILE, mmap_mode='r')
+            vectors = np.load(full_vectors, mmap_mode='r')
+        else:
+            ids, vectors = read_faiss_flat(directory / INDEX_FILE)
+        return cls(vectors.shape[1], dtype, ids, vectors, mapped=True)
+
+    def reopen(self, directory: Path) -> Optional["NumpyFlatIndex"]:
+        return NumpyFlatIndex.load(directory, self.dtype)
+
+    @property
+    def ntotal(self) -> int:
+        return self._size
+
+    @property
+    def dimension(self) -> int:
+        return self._dimension
+
+    def ensure_writable(self):
+        """mmapしたスナップショットは読み取り専用なので、最初の書き込み時にメモリへコピーする"""
+        if self.mapped:
+            self._ids = np.array(self._ids[:self._size], dtype=np.int64)
+            self._vectors = np.array(self._vectors[:self._size], dtype=self.dtype)
+            self.mapped = False
+
+    def _reserve(self, count: int):
+        needed = self._size + count
+        capacity = len(self._ids)
+        if needed <= capacity:
+            return
+        capacity = max(capacity, _INITIAL_CAPACITY)
+        while capacity < needed:
+            capacity *= 2
+        ids = np.zeros(capacity, dtype=np.int64)
+        vectors = np.zeros((capacity, self._dimension), dtype=self.dtype)
+        ids[:self._size] = self._ids[:self._size]
+        vectors[:self._size] = self._vectors[:self._size]
+        self._ids, self._vectors = ids, vectors
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        self.ensure_writable()
+        self._reserve(len(ids))
+        end = self._size + len(ids)
+        self._vectors[self._size:end] = vectors
+        self._ids[self._size:end] = ids
+        self._size = end
+
+    def remove(self, ids: np.ndarray):
+        self.ensure_writable()
+        keep = ~np.isin(self._ids[:self._size], ids)
+        # その場で詰めずに新しい配列を作る（書き込み中のスナップショットが古い配列を参照しているため）
+        self._ids = self._ids[:self._size][keep]
+        self._vectors = self._vectors[:self._size][keep]
+        self._size = len(self._ids)
+
+    def search(self, queries: np.ndarray, k: int, params: Optional[dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.asarray(queries, dtype=np.float32)
+        n = self._size
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        if n == 0:
+            return scores, labels
+
+        vectors = self._vectors[:n]
+        if self.dtype == np.float32:
+            similarities = queries @ vectors.T
+        else:
+            similarities = np.empty((len(queries), n), dtype=np.float32)
+            for start in range(0, n, _SEARCH_BLOCK_ROWS):
+                block = vectors[start:start + _SEARCH_BLOCK_ROWS].astype(np.float32)
+                similarities[:, start:start + len(block)] = queries @ block.T
+
+        top_k = min(k, n)
+        # 上位k件を線形時間で選んでから、その中だけを並べ替える
+        top = np.argpartition(-similarities, top_k - 1, axis=1)[:, :top_k]
+        top_scores = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        scores[:, :top_k] = np.take_along_axis(top_scores, order, axis=1)
+        labels[:, :top_k] = self._ids[:n][np.take_along_axis(top, order, axis=1)]
+        return scores, labels
+
+    def ids(self) -> np.ndarray:
+        return np.array(self._ids[:self._size])
+
+    def vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.ids(), np.asarray(self._vectors[:self._size], dtype=np.float32)
+
+    def snapshot_writer(self) -> Callable[[Path], None]:
+        # 既存の行はその場で書き換えないので、ビューを渡すだけでよい
+        ids = self._ids[:self._size]
+        vectors = self._vectors[:self._size]
+
+        def write(directory: Path):
+            write_faiss_flat(Path(directory) / INDEX_FILE, ids, vectors)
+        return write
+
+    def memory_usage(self) -> int:
+        if self.mapped:
+            return 0
+        return self._ids.nbytes + self._vectors.nbytes
@@ -0,0 +1,162 @@
+"""
+PDFのテキスト抽出（プロセスプール）
+PyPDF2の extract_text はPythonだけで書かれた重い処理なので、別プロセスでページ範囲ごとに並列に行う
+
+- ページを pages_per_task ページずつの範囲に分けてワーカーに割り振り、結果はページ順に返す
+- 先に投入する範囲はワーカー数の2倍までにして、抽出済みのテキストが溜まりすぎないようにする
+- 1文書の抽出が timeout 秒を超えたら打ち切り、詰まったワーカーごとプールを作り直す
+"""
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+
+class PdfExtractionTimeout(Exception):
+    """1文書の抽出が制限時間を超えた"""
+
+
+class PdfWorkerLost(Exception):
+    """ワーカープロセスが落ちたか、別の文書のタイムアウトでプールが作り直された（やり直せば成功しうる）"""
+
+
+# PdfReaderにパスを渡すとファイル全体をメモリに読み込むので、開いたファイルを渡す
+def _count_pages(path: str) -> int:
+    with open(path, 'rb') as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def _extract_range(path: str, start: int, stop: int) -> List[str]:
+    """ワーカープロセスで実行: start〜stop-1ページのテキストを抽出"""
+    with open(path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+class PdfExtractor:
+    def __init__(self, workers: int = 2, pages_per_task: int = 8, timeout: float = 120.0):
+        """
+        Args:
+            workers: ワーカープロセス数（0ならプロセスを使わずに呼び出し元のスレッドで抽出する）
+            pages_per_task: 1回にワーカーへ渡すページ数
+            timeout: 1文書の抽出の制限時間（秒）
+        """
+        self.workers = workers
+        self.pages_per_task = pages_per_task
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+        self.documents = 0
+        self.pages = 0
+        self.seconds = 0.0
+        self.timeouts = 0
+        self.last_pages_per_second = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # リクエスト処理のスレッドを抱えたプロセスをforkしないよう、spawnで起動する
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _reset_executor(self, executor: ProcessPoolExecutor):
+        """詰まったワーカーを止めてプールを捨てる（次の抽出で作り直す）"""
+        with self._lock:
+            if self._executor is not executor:
+                # 別の抽出がすでに作り直している
+                return
+            self._executor = None
+        terminate = getattr(executor, "terminate_workers", None)
+        if terminate is not None:
+            terminate()
+        else:
+            # Python 3.14より前は実行中のタスクを止める公開APIがない
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_pages(self, path: Path) -> Iterator[str]:
+        """ページのテキストをページ順に返す（各ページの末尾に改行を付ける）"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        pages = 0
+        if self.workers <= 0:
+            with open(path, 'rb') as f:
+                for page in PyPDF2.PdfReader(f).pages:
+                    if time.monotonic() > deadline:
+                        self._raise_timeout(path)
+                    yield page.extract_text() + "\n"
+                    pages += 1
+            self._record(pages, time.monotonic() - started)
+            return
+
+        executor = self._get_executor()
+        page_count = self._wait(executor, executor.submit(_count_pages, str(path)), deadline, path)
+        ranges = deque(
+            (start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        )
+        in_flight = deque()
+        try:
+            while ranges or in_flight:
+                while ranges and len(in_flight) < self.workers * 2:
+                    start, stop = ranges.popleft()
+                    in_flight.append(executor.submit(_extract_range, str(path), start, stop))
+                for text in self._wait(executor, in_flight.popleft(), deadline, path):
+                    yield text + "\n"
+                    pages += 1
+        finally:
+            for future in in_flight:
+                future.cancel()
+        self._record(pages, time.monotonic() - started)
+
+    def _wait(self, executor: ProcessPoolExecutor, future, deadline: float, path: Path):
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            self._reset_executor(executor)
+            self._raise_timeout(path)
+        except (BrokenProcessPool, CancelledError) as e:
+            self._reset_executor(executor)
+            raise PdfWorkerLost(f"PDF extraction worker was lost while reading {Path(path).name}") from e
+
+    def _raise_timeout(self, path: Path):
+        self.timeouts += 1
+        raise PdfExtractionTimeout(f"PDF extraction of {Path(path).name} exceeded {self.timeout}s")
+
+    def _record(self, pages: int, seconds: float):
+        self.documents += 1
+        self.pages += pages
+        self.seconds += seconds
+        self.last_pages_per_second = pages / seconds if seconds > 0 else 0.0
+        logger.info(f"Extracted {pages} PDF pages in {seconds:.2f}s ({self.last_pages_per_second:.1f} pages/s)")
+
+    def stats(self) -> dict:
+        """抽出のスループット（プールの大きさを決める目安）"""
+        return {
+            'workers': self.workers,
+            'documents': self.documents,
+            'pages': self.pages,
+            'pages_per_second': self.pages / self.seconds if self.seconds > 0 else 0.0,
+            'last_pages_per_second': self.last_pages_per_second,
+            'timeouts': self.timeouts,
+        }
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,144 @@
+"""
+ドキュメント更新時の差分インデックス
+新しい本文をチャンクに分け、ベクトルストアにあるチャンクと本文のハッシュで突き合わせて、
+変わったチャンクだけを埋め込み・追加し、消えたチャンクだけを削除する
+
+本文が同じチャンクは埋め込みも同じなので、位置（start, end）やタイトルが変わっていても書き換えるだけで済む
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.services.chunk_store import embeddings_by_hash
+from app.services.chunking import TextChunk, chunk_hash, chunk_text
+from app.services.dedup import simhashes
+
+logger = logging.getLogger(__name__)
+
+
+class ReindexError(Exception):
+    """差分の埋め込みに失敗した（ベクトルストアは変更していない）"""
+
+
+class ChunkDiff:
+    """保存済みのチャンクと新しいチャンクの差分"""
+
+    def __init__(self):
+        # 埋め込んで追加する新しいチャンク
+        self.added: List[TextChunk] = []
+        # 削除するチャンクID
+        self.removed_ids: List[int] = []
+        # 残すチャンクID → 書き換えるフィールド（title / start / end）
+        self.updates: Dict[int, dict] = {}
+        # 本文が一致して埋め込みを再利用したチャンク数
+        self.reused = 0
+
+    def summary(self, chunks_total: int) -> dict:
+        return {
+            'chunks_total': chunks_total,
+            'chunks_embedded': len(self.added),
+            'chunks_reused': self.reused,
+            'chunks_removed': len(self.removed_ids),
+        }
+
+
+class ReindexResult:
+    """差分インデックスの結果"""
+
+    def __init__(self, summary: dict, metadatas: List[dict], embeddings: Dict[str, np.ndarray],
+                 orphaned: List[Tuple[int, int, int]]):
+        # 件数の内訳（chunks_total / chunks_embedded / chunks_reused / chunks_removed）
+        self.summary = summary
+        # 新しい本文の全チャンクのメタデータ（チャンクの順）と、今回埋め込んだ本文のハッシュ → 埋め込み
+        self.metadatas = metadatas
+        self.embeddings = embeddings
+        # 削除したチャンクを重複として参照していたほかのドキュメントの箇所
+        self.orphaned = orphaned
+
+
+def diff_chunks(stored: List[Tuple[int, dict]], chunks: List[TextChunk], title: str) -> ChunkDiff:
+    """
+    本文のハッシュでチャンクを突き合わせる
+
+    同じ本文のチャンクが複数あれば出現順に対応させる。対応する保存済みチャンクがない新しいチャンクは追加、
+    どの新しいチャンクにも対応しなかった保存済みチャンクは削除する
+    """
+    diff = ChunkDiff()
+    by_hash = defaultdict(list)
+    for chunk_id, metadata in stored:
+        by_hash[chunk_hash(metadata['content'])].append((chunk_id, metadata))
+    for candidates in by_hash.values():
+        candidates.reverse()
+
+    for chunk in chunks:
+        candidates = by_hash.get(chunk_hash(chunk.text))
+        if not candidates:
+            diff.added.append(chunk)
+            continue
+        chunk_id, metadata = candidates.pop()
+        diff.reused += 1
+        fields = {'title': title, 'start': chunk.start, 'end': chunk.end}
+        changed = {key: value for key, value in fields.items() if metadata.get(key) != value}
+        if changed:
+            diff.updates[chunk_id] = changed
+
+    for candidates in by_hash.values():
+        diff.removed_ids.extend(chunk_id for chunk_id, _ in candidates)
+    diff.removed_ids.sort()
+    return diff
+
+
+async def reindex_document(
+    vector_store,
+    embedder,
+    document_id: int,
+    title: str,
+    content: str,
+    max_length: int = 800,
+    overlap: int = 100,
+    max_tokens: Optional[int] = None,
+) -> ReindexResult:
+    """
+    ドキュメントの新しい本文をベクトルストアに差分で反映する
+
+    Args:
+        vector_store: ドキュメントの持ち主の VectorStore
+        embedder: BatchEmbedder（変わったチャンクだけを渡す）
+
+    Raises:
+        ReindexError: 変わったチャンクの埋め込みに1件でも失敗した
+    """
+    chunks = await asyncio.to_thread(chunk_text, content, max_length, overlap, max_tokens)
+    stored = await asyncio.to_thread(vector_store.document_chunks, document_id)
+    diff = diff_chunks(stored, chunks, title)
+
+    result = await embedder.embed([chunk.text for chunk in diff.added])
+    if result.errors:
+        raise ReindexError(result.errors[result.failed_indices[0]])
+
+    fingerprints = simhashes([chunk.text for chunk in chunks])
+    metadatas = [
+        {
+            'document_id': document_id,
+            'title': title,
+            'content': chunk.text,
+            'start': chunk.start,
+            'end': chunk.end,
+            'simhash': int(fingerprint),
+        }
+        for chunk, fingerprint in zip(chunks, fingerprints)
+    ]
+    added = {id(chunk) for chunk in diff.added}
+    orphaned = await asyncio.to_thread(
+        vector_store.update_document_chunks,
+        document_id, diff.removed_ids, diff.updates, result.embeddings,
+        [metadata for chunk, metadata in zip(chunks, metadatas) if id(chunk) in added]
+    )
+    summary = diff.summary(len(chunks))
+    logger.info(f"Reindexed document {document_id}: {summary}")
+    return ReindexResult(
+        summary, metadatas, embeddings_by_hash([chunk.text for chunk in diff.added], result.embeddings), orphaned
+    )
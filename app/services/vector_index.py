@@ -0,0 +1,551 @@
+"""
+ベクトルインデックスの種類ごとの実装
+VectorStoreはここで定義したラッパー経由でFAISSを扱う
+
+- flat: 厳密検索（IndexFlatIP）。小規模ストアのデフォルト
+- ivf:  IVF-Flat。クラスタ単位で絞り込む近似検索（nprobeで精度と速度を調整）
+- hnsw: HNSW。グラフ探索による近似検索（efSearchで精度と速度を調整）
+- sq8 / pq / binary: 圧縮したコード（8bitスカラー量子化 / 直積量子化 / 符号ビット）で候補を絞り、
+  ディスク上の非圧縮ベクトルで上位候補を再スコアリングする
+
+どの種類もチャンクIDで追加・削除できる。HNSWは削除に対応していないので、
+インデックスに残ったベクトルはメタデータ側で除外し、検索時は多めに取得して補う
+
+FAISSが入っていない環境では numpy エンジン（numpy_index.py）のフラットインデックスを使う。
+スナップショットの形式は共通なので、どちらのエンジンでも同じストアを開ける
+"""
+import math
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+INDEX_FLAT = "flat"
+INDEX_IVF = "ivf"
+INDEX_HNSW = "hnsw"
+INDEX_SQ8 = "sq8"
+INDEX_PQ = "pq"
+INDEX_BINARY = "binary"
+INDEX_TYPES = (INDEX_FLAT, INDEX_IVF, INDEX_HNSW, INDEX_SQ8, INDEX_PQ, INDEX_BINARY)
+
+# 検索エンジン（auto はFAISSがあればFAISS、なければNumPy）
+ENGINE_AUTO = "auto"
+ENGINE_FAISS = "faiss"
+ENGINE_NUMPY = "numpy"
+ENGINES = (ENGINE_AUTO, ENGINE_FAISS, ENGINE_NUMPY)
+FAISS_AVAILABLE = faiss is not None
+
+# スナップショット内のファイル名
+INDEX_FILE = "index.faiss"
+FULL_IDS_FILE = "full_ids.npy"
+FULL_VECTORS_FILE = "full_vectors.npy"
+
+# 検索時パラメータの既定値
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+# 量子化インデックスで再スコアリングする候補数（top_kの倍数）
+DEFAULT_RESCORE_FACTOR = 4
+# 直積量子化の1サブベクトルあたりの次元数
+PQ_SUBVECTOR_DIM = 8
+
+
+class VectorIndex:
+    """FAISSインデックスの共通ラッパー（チャンクIDでアドレスする内積インデックス）"""
+
+    kind = INDEX_FLAT
+    # 削除したベクトルがインデックス内に残るか（残る場合はメタデータで除外する）
+    lazy_delete = False
+
+    def __init__(self, index, mapped: bool = False):
+        self.index = index
+        # スナップショットをmmapしたままか（変更前にコピーが必要）
+        self.mapped = mapped
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def dimension(self) -> int:
+        return self.index.d
+
+    def ensure_writable(self):
+        """mmapしたインデックスは変更できないので、最初の書き込み時にメモリへコピーする"""
+        if self.mapped:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self.mapped = False
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        self.ensure_writable()
+        self.index.add_with_ids(vectors, ids)
+
+    def remove(self, ids: np.ndarray):
+        self.ensure_writable()
+        self.index.remove_ids(ids)
+
+    def _search_params(self, params: Optional[dict]):
+        return None
+
+    def search(self, queries: np.ndarray, k: int, params: Optional[dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+        search_params = self._search_params(params or {})
+        if search_params is None:
+            return self.index.search(queries, k)
+        return self.index.search(queries, k, params=search_params)
+
+    def ids(self) -> np.ndarray:
+        return faiss.vector_to_array(self.index.id_map)
+
+    def vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(チャンクID, ベクトル) をすべて取り出す（インデックスの作り直し用）"""
+        inner = faiss.downcast_index(self.index.index)
+        return self.ids(), inner.reconstruct_n(0, inner.ntotal)
+
+    def snapshot_writer(self) -> Callable[[Path], None]:
+        """
+        現在の状態をスナップショットとして書き出す関数を返す
+
+        ストアのロック内で呼び、返された関数はロック外で実行してよい
+        """
+        index_bytes = faiss.serialize_index(self.index)
+
+        def write(directory: Path):
+            index_bytes.tofile(str(Path(directory) / INDEX_FILE))
+        return write
+
+    @classmethod
+    def load(cls, directory: Path) -> "VectorIndex":
+        return cls(faiss.read_index(str(Path(directory) / INDEX_FILE)))
+
+    def reopen(self, directory: Path) -> Optional["VectorIndex"]:
+        """
+        書き出したスナップショットをmmapで開き直したインデックスを返す
+
+        ヒープに置くしかない種類（IVF・HNSW）は None（今のインデックスを使い続ける）
+        """
+        return None
+
+    def memory_usage(self) -> int:
+        """ヒープ上の概算メモリ使用量（mmap中のベクトルは数えない）"""
+        vector_bytes = 0 if self.mapped else self.ntotal * self.dimension * 4
+        return vector_bytes + self.ntotal * 8
+
+
+def _read_mapped(directory: Path):
+    """フラットなベクトル領域をmmapで開く（対応していないFAISSでは通常の読み込み）"""
+    mmap_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+    path = str(Path(directory) / INDEX_FILE)
+    if mmap_flag is None:
+        return faiss.read_index(path), False
+    return faiss.read_index(path, mmap_flag), True
+
+
+class FlatIndex(VectorIndex):
+    kind = INDEX_FLAT
+
+    @classmethod
+    def load(cls, directory: Path) -> "FlatIndex":
+        index, mapped = _read_mapped(directory)
+        return cls(index, mapped=mapped)
+
+    @classmethod
+    def create(cls, dimension: int) -> "FlatIndex":
+        return cls(faiss.IndexIDMap2(faiss.IndexFlatIP(dimension)))
+
+    def reopen(self, directory: Path) -> Optional["FlatIndex"]:
+        return FlatIndex.load(directory)
+
+
+class IVFIndex(VectorIndex):
+    """IVF-Flat。IDはIVF自身が保持し、ハッシュテーブルのダイレクトマップで削除・復元する"""
+
+    kind = INDEX_IVF
+
+    @classmethod
+    def create(cls, dimension: int, training_vectors: np.ndarray, nlist: Optional[int] = None) -> "IVFIndex":
+        n = len(training_vectors)
+        if nlist is None:
+            # 目安は 4√n。学習には1クラスタあたり39件以上必要なのでその範囲に収める
+            nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(training_vectors)
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        index.nprobe = min(DEFAULT_NPROBE, nlist)
+        return cls(index)
+
+    def _search_params(self, params):
+        return faiss.SearchParametersIVF(nprobe=int(params.get('nprobe') or self.index.nprobe))
+
+    def ids(self) -> np.ndarray:
+        invlists = self.index.invlists
+        parts = [
+            faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+            for list_no in range(invlists.nlist)
+            if invlists.list_size(list_no) > 0
+        ]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def vectors(self):
+        ids = self.ids()
+        if len(ids) == 0:
+            return ids, np.zeros((0, self.dimension), dtype=np.float32)
+        return ids, self.index.reconstruct_batch(ids)
+
+    def memory_usage(self) -> int:
+        # 転置リストはmmapされないので常に数える（ID + ベクトル + ダイレクトマップ）
+        return self.ntotal * (self.dimension * 4 + 8 + 16) + self.index.nlist * self.dimension * 4
+
+
+class HNSWIndex(VectorIndex):
+    """HNSW。FAISSのHNSWは削除できないため、削除は論理削除として扱う"""
+
+    kind = INDEX_HNSW
+    lazy_delete = True
+
+    @classmethod
+    def create(cls, dimension: int) -> "HNSWIndex":
+        hnsw = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw.hnsw.efSearch = DEFAULT_EF_SEARCH
+        return cls(faiss.IndexIDMap2(hnsw))
+
+    @classmethod
+    def load(cls, directory: Path) -> "HNSWIndex":
+        index, mapped = _read_mapped(directory)
+        return cls(index, mapped=mapped)
+
+    def remove(self, ids: np.ndarray):
+        # ベクトルはインデックスに残し、メタデータ側の削除で検索結果から除外する
+        pass
+
+    def _search_params(self, params):
+        ef_search = params.get('ef_search')
+        if not ef_search:
+            return None
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search))
+
+    def memory_usage(self) -> int:
+        # グラフのリンク（レベル0で2M本 + 上位レベル分）を加算
+        return super().memory_usage() + self.ntotal * HNSW_M * 2 * 4 * 11 // 10
+
+
+class FullPrecisionVectors:
+    """
+    再スコアリング用の非圧縮ベクトル
+
+    スナップショット分はmmapしたままディスクに置き、以降の追加分だけをメモリに持つ。
+    IDはどちらも昇順なので二分探索で引ける
+    """
+
+    def __init__(self, dimension: int, base_ids: Optional[np.ndarray] = None, base_vectors: Optional[np.ndarray] = None):
+        self.dimension = dimension
+        self.base_ids = base_ids if base_ids is not None else np.zeros(0, dtype=np.int64)
+        self.base_vectors = base_vectors if base_vectors is not None else np.zeros((0, dimension), dtype=np.float32)
+        self.base_alive = np.ones(len(self.base_ids), dtype=bool)
+        self.tail_ids = np.zeros(0, dtype=np.int64)
+        self.tail_vectors = np.zeros((0, dimension), dtype=np.float32)
+
+    @classmethod
+    def load(cls, directory: Path, dimension: int) -> "FullPrecisionVectors":
+        directory = Path(directory)
+        return cls(
+            dimension,
+            np.load(directory / FULL_IDS_FILE, mmap_mode='r'),
+            np.load(directory / FULL_VECTORS_FILE, mmap_mode='r'),
+        )
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        # 追加分はチェックポイントまでの差分だけなので連結し直しても小さい
+        self.tail_ids = np.concatenate((self.tail_ids, ids))
+        self.tail_vectors = np.concatenate((self.tail_vectors, vectors))
+
+    def _find(self, sorted_ids: np.ndarray, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if len(sorted_ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        rows = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return rows, sorted_ids[rows] == ids
+
+    def remove(self, ids: np.ndarray):
+        rows, found = self._find(self.base_ids, ids)
+        self.base_alive[rows[found]] = False
+        keep = ~np.isin(self.tail_ids, ids)
+        self.tail_ids = self.tail_ids[keep]
+        self.tail_vectors = self.tail_vectors[keep]
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        """IDの順にベクトルを返す（見つからないIDはゼロベクトル）"""
+        result = np.zeros((len(ids), self.dimension), dtype=np.float32)
+        rows, found = self._find(self.base_ids, ids)
+        if found.any():
+            # mmapから必要な行だけを読む
+            result[found] = self.base_vectors[rows[found]]
+        rows, in_tail = self._find(self.tail_ids, ids)
+        in_tail &= ~found
+        result[in_tail] = self.tail_vectors[rows[in_tail]]
+        return result
+
+    def all(self) -> Tuple[np.ndarray, np.ndarray]:
+        ids = np.concatenate((self.base_ids[self.base_alive], self.tail_ids))
+        vectors = np.concatenate((self.base_vectors[self.base_alive], self.tail_vectors))
+        return ids, vectors
+
+    def snapshot_writer(self) -> Callable[[Path], None]:
+        base_ids, base_vectors = self.base_ids, self.base_vectors
+        base_alive = self.base_alive.copy()
+        tail_ids, tail_vectors = self.tail_ids, self.tail_vectors
+        dimension = self.dimension
+
+        def write(directory: Path):
+            directory = Path(directory)
+            rows = np.flatnonzero(base_alive)
+            count = len(rows) + len(tail_ids)
+            np.save(directory / FULL_IDS_FILE, np.concatenate((base_ids[rows], tail_ids)).astype(np.int64))
+            # ベクトル本体は一度に読み込まず、出力先をmmapして少しずつコピーする
+            out = np.lib.format.open_memmap(
+                directory / FULL_VECTORS_FILE, mode='w+', dtype=np.float32, shape=(count, dimension)
+            )
+            step = 4096
+            for start in range(0, len(rows), step):
+                chunk = rows[start:start + step]
+                out[start:start + len(chunk)] = base_vectors[chunk]
+            out[len(rows):] = tail_vectors
+            out.flush()
+            del out
+        return write
+
+    def memory_usage(self) -> int:
+        return self.tail_vectors.nbytes + self.tail_ids.nbytes + self.base_alive.nbytes
+
+
+class QuantizedIndex(VectorIndex):
+    """
+    圧縮コードで候補を取り、非圧縮ベクトルで再スコアリングするインデックスの共通部分
+
+    検索パラメータ rescore_factor で再スコアリングする候補数（top_k の倍数）を調整できる
+    """
+
+    def __init__(self, index, full: FullPrecisionVectors, mapped: bool = False):
+        super().__init__(index, mapped=False)
+        self.full = full
+
+    @property
+    def dimension(self) -> int:
+        return self.full.dimension
+
+    @property
+    def code_size(self) -> int:
+        """1ベクトルあたりの圧縮コードのバイト数"""
+        return faiss.downcast_index(self.index.index).code_size
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        self.index.add_with_ids(self._encode(vectors), ids)
+        self.full.add(vectors, ids)
+
+    def remove(self, ids: np.ndarray):
+        self.index.remove_ids(ids)
+        self.full.remove(ids)
+
+    def search(self, queries, k, params=None):
+        params = params or {}
+        factor = int(params.get('rescore_factor') or DEFAULT_RESCORE_FACTOR)
+        candidate_k = min(self.ntotal, k * factor)
+        _, candidates = self.index.search(self._encode(queries), candidate_k)
+
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            ids = candidates[i][candidates[i] >= 0]
+            exact = self.full.get(ids) @ query
+            top = np.argsort(-exact)[:k]
+            scores[i, :len(top)] = exact[top]
+            labels[i, :len(top)] = ids[top]
+        return scores, labels
+
+    def vectors(self):
+        return self.full.all()
+
+    def snapshot_writer(self):
+        write_codes = super().snapshot_writer()
+        write_full = self.full.snapshot_writer()
+
+        def write(directory: Path):
+            write_codes(directory)
+            write_full(directory)
+        return write
+
+    @classmethod
+    def load(cls, directory: Path) -> "QuantizedIndex":
+        index = faiss.read_index(str(Path(directory) / INDEX_FILE))
+        return cls(index, FullPrecisionVectors.load(directory, index.d))
+
+    def reopen(self, directory: Path) -> Optional["QuantizedIndex"]:
+        # 非圧縮ベクトルをスナップショットのmmapに載せ替え、メモリ上の追加分を手放す
+        return type(self).load(directory)
+
+    def memory_usage(self) -> int:
+        # 圧縮コード + IDマップ + メモリ上の非圧縮ベクトル（未チェックポイント分）
+        return self.ntotal * (self.code_size + 8) + self.full.memory_usage()
+
+
+class SQ8Index(QuantizedIndex):
+    """8bitスカラー量子化（1次元1バイト、float32の1/4）"""
+
+    kind = INDEX_SQ8
+
+    @classmethod
+    def create(cls, dimension: int, training_vectors: np.ndarray) -> "SQ8Index":
+        sq = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        sq.train(training_vectors)
+        return cls(faiss.IndexIDMap2(sq), FullPrecisionVectors(dimension))
+
+
+class PQIndex(QuantizedIndex):
+    """直積量子化（8次元ごとに1バイト、float32の1/32）"""
+
+    kind = INDEX_PQ
+
+    @classmethod
+    def create(cls, dimension: int, training_vectors: np.ndarray) -> "PQIndex":
+        m = dimension // PQ_SUBVECTOR_DIM if dimension % PQ_SUBVECTOR_DIM == 0 else 1
+        # コードブックの学習には 2^nbits 件以上必要なので、少ない場合はビット数を落とす
+        nbits = max(1, min(8, int(math.log2(max(2, len(training_vectors))))))
+        pq = faiss.IndexPQ(dimension, m, nbits, faiss.METRIC_INNER_PRODUCT)
+        pq.train(training_vectors)
+        return cls(faiss.IndexIDMap2(pq), FullPrecisionVectors(dimension))
+
+
+class BinaryIndex(QuantizedIndex):
+    """符号ビット（1次元1ビット、float32の1/32）をハミング距離で検索"""
+
+    kind = INDEX_BINARY
+
+    @classmethod
+    def create(cls, dimension: int, training_vectors: np.ndarray = None) -> "BinaryIndex":
+        if dimension % 8:
+            raise ValueError("Binary index requires a dimension divisible by 8")
+        return cls(faiss.IndexBinaryIDMap2(faiss.IndexBinaryFlat(dimension)), FullPrecisionVectors(dimension))
+
+    @property
+    def code_size(self) -> int:
+        return self.full.dimension // 8
+
+    def _encode(self, vectors):
+        return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+    def ids(self):
+        return faiss.vector_to_array(self.index.id_map)
+
+    def snapshot_writer(self):
+        index_bytes = faiss.serialize_index_binary(self.index)
+        write_full = self.full.snapshot_writer()
+
+        def write(directory: Path):
+            index_bytes.tofile(str(Path(directory) / INDEX_FILE))
+            write_full(directory)
+        return write
+
+    @classmethod
+    def load(cls, directory: Path) -> "BinaryIndex":
+        index = faiss.read_index_binary(str(Path(directory) / INDEX_FILE))
+        return cls(index, FullPrecisionVectors.load(directory, index.d))
+
+
+def resolve_engine(engine: str) -> str:
+    """設定のエンジン名を実際に使うエンジンに解決する"""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown vector engine: {engine}")
+    if engine == ENGINE_AUTO:
+        return ENGINE_FAISS if FAISS_AVAILABLE else ENGINE_NUMPY
+    if engine == ENGINE_FAISS and not FAISS_AVAILABLE:
+        raise ValueError("Vector engine 'faiss' requested but faiss is not installed")
+    return engine
+
+
+def normalize_L2(vectors: np.ndarray):
+    """各行をその場でL2正規化する（faiss.normalize_L2と同じくゼロベクトルはそのまま）"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+
+_INDEX_CLASSES = {
+    INDEX_FLAT: FlatIndex,
+    INDEX_IVF: IVFIndex,
+    INDEX_HNSW: HNSWIndex,
+    INDEX_SQ8: SQ8Index,
+    INDEX_PQ: PQIndex,
+    INDEX_BINARY: BinaryIndex,
+}
+
+
+def create_flat_index(dimension: int, engine: str = ENGINE_FAISS, dtype: str = "float32") -> VectorIndex:
+    """空のフラットインデックスを作る（dtype は numpy エンジンのみ有効）"""
+    if engine == ENGINE_NUMPY:
+        from app.services.numpy_index import NumpyFlatIndex
+        return NumpyFlatIndex.create(dimension, dtype)
+    return FlatIndex.create(dimension)
+
+
+def load_index(directory: Path, kind: str, engine: str = ENGINE_FAISS, dtype: str = "float32") -> VectorIndex:
+    """
+    スナップショットからインデックスを読み込む
+
+    numpy エンジンはフラットインデックスと、量子化インデックスの非圧縮ベクトルを読める。
+    量子化インデックスはフラットインデックスとして開き、次のチェックポイントでフラット形式になる
+    """
+    if engine == ENGINE_NUMPY:
+        if kind in (INDEX_IVF, INDEX_HNSW):
+            raise ValueError(f"Index type '{kind}' requires the faiss engine")
+        from app.services.numpy_index import NumpyFlatIndex
+        return NumpyFlatIndex.load(directory, dtype)
+    return _INDEX_CLASSES[kind].load(directory)
+
+
+def build_index(kind: str, dimension: int, ids: np.ndarray, vectors: np.ndarray,
+                engine: str = ENGINE_FAISS, dtype: str = "float32") -> VectorIndex:
+    """指定した種類のインデックスを作り、ベクトルをまとめて追加する"""
+    if engine == ENGINE_NUMPY:
+        if kind != INDEX_FLAT:
+            raise ValueError(f"Index type '{kind}' requires the faiss engine")
+        index = create_flat_index(dimension, engine, dtype)
+    elif kind in (INDEX_FLAT, INDEX_HNSW, INDEX_BINARY):
+        index = _INDEX_CLASSES[kind].create(dimension)
+    elif kind in (INDEX_IVF, INDEX_SQ8, INDEX_PQ):
+        # 学習が必要な種類
+        index = _INDEX_CLASSES[kind].create(dimension, vectors)
+    else:
+        raise ValueError(f"Unknown index type: {kind}")
+    if len(ids):
+        # 再スコアリング用ベクトルなどはIDの昇順を前提にしているので並べ替えて追加
+        order = np.argsort(ids, kind='stable')
+        index.add(np.ascontiguousarray(vectors[order]), ids[order])
+    return index
+
+
+def recall_at_k(index: VectorIndex, queries: np.ndarray, k: int, params: Optional[dict] = None) -> Dict[str, float]:
+    """
+    厳密検索（全件の内積）を正解として recall@k を測る
+
+    queries はL2正規化済みであること
+    """
+    ids, vectors = index.vectors()
+    k = min(k, len(ids))
+    if k == 0:
+        return {'recall': 1.0, 'k': 0, 'queries': len(queries)}
+
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    expected = ids[top]
+
+    _, found = index.search(queries, k, params)
+    hits = sum(len(set(e.tolist()) & set(f.tolist())) for e, f in zip(expected, found))
+    return {'recall': hits / (len(queries) * k), 'k': k, 'queries': len(queries)}
@@ -0,0 +1,211 @@
+"""
+ベクトルストアの永続化レイヤー
+スナップショット + 追記ログ（WAL）で差分だけを書き込む
+
+ディレクトリ構成（ユーザーごと）:
+    user_{id}/CURRENT            現在のスナップショット名（アトミックに置き換え）
+    user_{id}/snap-{gen}/        スナップショット本体（中身のファイル形式は呼び出し側が決める）
+    user_{id}/wal-{gen}.log      スナップショット以降の変更ログ
+
+snap-{G} は wal-{G} より前のログをすべて反映した状態を表す。
+読み込み時は CURRENT のスナップショットを開き、gen >= G のログを順に再生する。
+"""
+import os
+import pickle
+import shutil
+import struct
+import zlib
+import logging
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# ログレコードのヘッダー（ペイロード長, CRC32）
+_RECORD_HEADER = struct.Struct("<II")
+
+CURRENT_FILE = "CURRENT"
+
+
+class PersistenceError(Exception):
+    """スナップショットやログが読み込めない場合の例外"""
+
+
+def _fsync_dir(path: Path):
+    """ディレクトリエントリ（renameの結果）をディスクに反映"""
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return  # Windowsなどディレクトリをopenできない環境
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_file(path: Path, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class StorePersistence:
+    """1ユーザー分のスナップショットと追記ログを管理"""
+
+    def __init__(self, root: Path, checkpoint_bytes: int = 16 * 1024 * 1024, fsync: bool = True):
+        self.root = Path(root)
+        self.checkpoint_bytes = checkpoint_bytes
+        self.fsync = fsync
+
+        self.snapshot_gen = 0
+        self.active_gen = 0
+        self._log_file = None
+        self._log_size = 0
+
+    # ---------- 読み込み ----------
+
+    def exists(self) -> bool:
+        return self.root.exists()
+
+    def _snapshot_dir(self, gen: int) -> Path:
+        return self.root / f"snap-{gen:08d}"
+
+    def _log_path(self, gen: int) -> Path:
+        return self.root / f"wal-{gen:08d}.log"
+
+    def _log_gens(self):
+        gens = []
+        for path in self.root.glob("wal-*.log"):
+            gens.append(int(path.stem[len("wal-"):]))
+        return sorted(gens)
+
+    def read_snapshot(self) -> Optional[Path]:
+        """
+        CURRENTが指すスナップショットのディレクトリを返す
+
+        Returns:
+            スナップショットのディレクトリ。スナップショットがなければNone
+        """
+        current_path = self.root / CURRENT_FILE
+        if not current_path.exists():
+            self.snapshot_gen = 0
+            return None
+
+        name = current_path.read_text().strip()
+        snapshot_dir = self.root / name
+        if not snapshot_dir.is_dir():
+            raise PersistenceError(f"Snapshot {snapshot_dir} referenced by CURRENT does not exist")
+        self.snapshot_gen = int(name[len("snap-"):])
+        return snapshot_dir
+
+    def replay_log(self) -> Iterator[tuple]:
+        """
+        スナップショット以降のログレコードを古い順に返す
+
+        末尾の書きかけレコード（クラッシュ時）は切り捨てる
+        """
+        gens = [gen for gen in self._log_gens() if gen >= self.snapshot_gen]
+        for gen in gens:
+            path = self._log_path(gen)
+            valid_size = 0
+            with open(path, "rb") as f:
+                while True:
+                    header = f.read(_RECORD_HEADER.size)
+                    if len(header) < _RECORD_HEADER.size:
+                        break
+                    length, crc = _RECORD_HEADER.unpack(header)
+                    data = f.read(length)
+                    if len(data) < length or zlib.crc32(data) != crc:
+                        break
+                    valid_size = f.tell()
+                    yield pickle.loads(data)
+
+            if valid_size < path.stat().st_size:
+                logger.warning(f"Truncating torn write at end of {path} ({valid_size} bytes kept)")
+                with open(path, "r+b") as f:
+                    f.truncate(valid_size)
+
+        self.active_gen = gens[-1] if gens else self.snapshot_gen
+        self._log_size = self._log_path(self.active_gen).stat().st_size if gens else 0
+
+    # ---------- 書き込み ----------
+
+    def append(self, record: tuple):
+        """変更レコードをログ末尾に追記（書き込み量は差分の大きさに比例）"""
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._log_file is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self._log_file = open(self._log_path(self.active_gen), "ab")
+
+        # ヘッダーと本体を1回のwriteで書き、途中で切れた場合はCRCで検出する
+        self._log_file.write(_RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data)
+        self._log_file.flush()
+        if self.fsync:
+            os.fsync(self._log_file.fileno())
+        self._log_size += _RECORD_HEADER.size + len(data)
+
+    def needs_checkpoint(self) -> bool:
+        return self._log_size >= self.checkpoint_bytes
+
+    def rotate(self) -> int:
+        """
+        新しいログに切り替え、次のスナップショット世代を返す
+
+        呼び出し元はストアのロックを保持した状態で呼び、
+        同じロック内でスナップショット対象の状態をコピーすること
+        """
+        self.close()
+        self.active_gen += 1
+        self._log_size = 0
+        return self.active_gen
+
+    def write_snapshot(self, gen: int, writer: Callable[[Path], None]) -> Path:
+        """
+        スナップショットを書き込み、CURRENTをアトミックに切り替えて、そのディレクトリを返す
+
+        writer は一時ディレクトリを受け取り、スナップショットのファイルを書き出す。
+        rotate() の後であればロック外から呼んでよい（書き込み中の変更は新しいログに入る）
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        snapshot_dir = self._snapshot_dir(gen)
+        tmp_dir = self.root / f"{snapshot_dir.name}.tmp"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        tmp_dir.mkdir()
+
+        writer(tmp_dir)
+        for path in tmp_dir.iterdir():
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+        _fsync_dir(tmp_dir)
+
+        if snapshot_dir.exists():
+            shutil.rmtree(snapshot_dir)
+        os.rename(tmp_dir, snapshot_dir)
+
+        current_tmp = self.root / f"{CURRENT_FILE}.tmp"
+        _write_file(current_tmp, f"{snapshot_dir.name}\n".encode())
+        os.replace(current_tmp, self.root / CURRENT_FILE)
+        _fsync_dir(self.root)
+
+        self.snapshot_gen = gen
+        self._cleanup(gen)
+        logger.info(f"Checkpointed {self.root} at generation {gen}")
+        return snapshot_dir
+
+    def _cleanup(self, gen: int):
+        """新しいスナップショットに取り込まれた古いログとスナップショットを削除"""
+        for path in self.root.glob("wal-*.log"):
+            if int(path.stem[len("wal-"):]) < gen:
+                path.unlink(missing_ok=True)
+        for path in self.root.glob("snap-*"):
+            if path.name.endswith(".tmp"):
+                continue
+            if int(path.name[len("snap-"):]) < gen:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
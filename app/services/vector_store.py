@@ -1,174 +1,820 @@
 """
-FAISSベクトルストアサービス
-ユーザーごとにFAISSインデックスを管理
+ベクトルストアサービス
+ユーザーごとにベクトルインデックスを管理（エンジンはFAISSまたはNumPy）
 """
+import json
 import numpy as np
 import pickle
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Callable, Dict, List, Tuple, Optional
 import logging
 
-# 起動時に一度だけFAISSをインポート
-try:
-    import faiss
-    print("✅ FAISS imported successfully at startup")
-    FAISS_AVAILABLE = True
-except ImportError as e:
-    print(f"❌ FAISS import failed: {e}")
-    FAISS_AVAILABLE = False
-    faiss = None
+from app.services.chunk_metadata import ChunkMetadata, MappedChunkTable
+from app.services.dedup import NearDuplicateIndex
+from app.services.numpy_index import read_faiss_flat
+from app.services.vector_index import (
+    ENGINE_AUTO, ENGINE_NUMPY, FAISS_AVAILABLE, INDEX_FLAT, INDEX_TYPES,
+    VectorIndex, build_index, create_flat_index, load_index, normalize_L2, recall_at_k, resolve_engine
+)
+from app.services.vector_persistence import StorePersistence
 
 logger = logging.getLogger(__name__)
 
+# スナップショットのフォーマットバージョン
+# 1: チャンクのリスト（旧形式、FAISSの連番位置と対応）
+# 2: チャンクID → メタデータの辞書をpickle（IndexIDMap2のIDと対応）
+# 3: mmap可能な列形式のメタデータ（chunk_metadata.py）+ manifest.json
+SNAPSHOT_FORMAT_VERSION = 3
+
+SNAPSHOT_MANIFEST_FILE = "manifest.json"
+# フォーマット2のスナップショットのメタデータ
+SNAPSHOT_PICKLE_FILE = "metadata.pkl"
+
+# HNSWで論理削除されたベクトルがこの割合を超えたら作り直す
+HNSW_REBUILD_DEAD_RATIO = 0.2
+
+# チェックポイントやインデックスの作り直しはリクエスト処理の外で1本ずつ実行
+_maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vector-maintenance")
+
+
 class VectorStore:
-    def __init__(self, user_id: int, dimension: int = 1024, storage_dir: str = "./vector_stores"):
+    def __init__(
+        self,
+        user_id: int,
+        dimension: int = 1024,
+        storage_dir: str = "./vector_stores",
+        checkpoint_bytes: int = 16 * 1024 * 1024,
+        ann_index_type: str = INDEX_FLAT,
+        ann_threshold: int = 20000,
+        engine: str = ENGINE_AUTO,
+        vector_dtype: str = "float32",
+        reembed: Optional[Callable[[List[str]], np.ndarray]] = None,
+        embedding_model: Optional[str] = None,
+    ):
+        if ann_index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {ann_index_type}")
         self.user_id = user_id
         self.dimension = dimension
+        # 検索エンジン（faiss / numpy）。vector_dtype は numpy エンジンの行列の型（float32 / float16）
+        self.engine = resolve_engine(engine)
+        self.vector_dtype = vector_dtype
+        # 保存済みのストアより次元数を増やした場合や埋め込みモデルを変えた場合に、
+        # チャンク本文から埋め込みを作り直す関数
+        self._reembed = reembed
+        # 埋め込みを作ったモデル（マニフェストに記録し、変わっていたら読み込み時に埋め込み直す）
+        self.embedding_model = embedding_model
+        self._stored_embedding_model: Optional[str] = None
+        if self.engine == ENGINE_NUMPY and ann_index_type != INDEX_FLAT:
+            logger.warning(f"Index type '{ann_index_type}' requires the faiss engine; staying on flat search")
+            ann_index_type = INDEX_FLAT
+        # チャンク数が閾値を超えたら近似インデックスに昇格させる（flatなら昇格しない）
+        self.ann_index_type = ann_index_type
+        self.ann_threshold = ann_threshold
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
         
+        # 旧形式（全体を毎回書き直す2ファイル構成）のパス。移行時のみ参照
         self.index_path = self.storage_dir / f"user_{user_id}_index.faiss"
         self.metadata_path = self.storage_dir / f"user_{user_id}_metadata.pkl"
         
-        self.index = None
-        self.metadata = []
+        self._persistence = StorePersistence(
+            self.storage_dir / f"user_{user_id}",
+            checkpoint_bytes=checkpoint_bytes
+        )
+        # チェックポイント用スレッドとリクエスト処理の排他
+        self._lock = threading.RLock()
+        # スナップショットの書き込みは同時に1つだけ
+        self._checkpoint_lock = threading.Lock()
+        self._checkpoint_scheduled = False
+        self._rebuild_scheduled = False
+        # インデックス作り直し中に発生した変更（作り直し後の新インデックスにも反映する）
+        self._pending_records: Optional[List[tuple]] = None
+        # スナップショット書き込み中に発生した変更（開き直したスナップショットにも反映する）
+        self._unsnapshotted_records: Optional[List[tuple]] = None
+        
+        self.index: Optional[VectorIndex] = None
+        # チャンクID → メタデータ
+        self.metadata = ChunkMetadata()
+        self.next_id = 0
+        # ほぼ同じチャンクの検出用のSimHash索引（最初の照会時に metadata から作る）
+        self._near_duplicates: Optional[NearDuplicateIndex] = None
+        self._near_duplicates_of: Optional[ChunkMetadata] = None
         
         # 既存インデックスの読み込み
         self._load_or_create()
     
     def _load_or_create(self):
-        """既存インデックスを読み込むか、新規作成"""
-        import faiss  # ここでインポート！
-        if self.index_path.exists() and self.metadata_path.exists():
+        """
+        既存インデックスを読み込むか、新規作成
+
+        読み込みに失敗した場合は空のインデックスで上書きせず例外を送出する
+        """
+        self._create_new_index()
+        
+        if self._persistence.exists():
+            try:
+                snapshot_dir = self._persistence.read_snapshot()
+                if snapshot_dir is not None:
+                    self._read_snapshot(snapshot_dir)
+                
+                # スナップショット以降の変更を再生
+                replayed = 0
+                for record in self._persistence.replay_log():
+                    if record[0] == 'add' and self.index.ntotal == 0 \
+                            and record[2].shape[1] != self.index.dimension:
+                        # スナップショットがなく、別の次元数のログだけが残っている
+                        self.index = create_flat_index(record[2].shape[1], self.engine, self.vector_dtype)
+                    self._apply(record)
+                    replayed += 1
+            except Exception as e:
+                logger.error(f"Failed to load index for user {self.user_id}: {e}")
+                raise
+            logger.info(
+                f"Loaded existing index for user {self.user_id}: "
+                f"{len(self.metadata)} documents ({replayed} log records replayed)"
+            )
+        elif self.index_path.exists() and self.metadata_path.exists():
             try:
-                self.index = faiss.read_index(str(self.index_path))
+                # 旧形式はフラットな内積インデックスなので、エンジンに関係なく直接読める
+                index = read_faiss_flat(self.index_path)
                 with open(self.metadata_path, 'rb') as f:
-                    self.metadata = pickle.load(f)
-                logger.info(f"Loaded existing index for user {self.user_id}: {len(self.metadata)} documents")
+                    payload = pickle.load(f)
             except Exception as e:
-                logger.error(f"Failed to load index: {e}")
-                self._create_new_index()
+                logger.error(f"Failed to load legacy index for user {self.user_id}: {e}")
+                raise
+            self._migrate_legacy(index, payload)
+        
+        model_changed = (self.embedding_model is not None and self._stored_embedding_model is not None
+                         and self._stored_embedding_model != self.embedding_model)
+        if model_changed or self.index.dimension != self.dimension:
+            self._migrate_embeddings(model_changed)
+    
+    def _read_snapshot(self, snapshot_dir: Path):
+        """
+        スナップショットを読み込む
+
+        インデックスとメタデータはmmapで開くので、ヒープにはほぼ載らず
+        同じファイルを開いた他のワーカープロセスともページを共有できる
+        """
+        manifest_path = snapshot_dir / SNAPSHOT_MANIFEST_FILE
+        
+        if manifest_path.exists():
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            # フラットなベクトル領域や再スコアリング用ベクトルはmmapで開く
+            self.index = load_index(
+                snapshot_dir, manifest.get('index_type', INDEX_FLAT), self.engine, self.vector_dtype
+            )
+            self.metadata = ChunkMetadata(MappedChunkTable(snapshot_dir))
+            self.next_id = manifest['next_id']
+            self._stored_embedding_model = manifest.get('embedding_model')
         else:
-            self._create_new_index()
+            # フォーマット2（pickle）のスナップショット。次のチェックポイントで新形式になる
+            self.index = load_index(snapshot_dir, INDEX_FLAT, self.engine, self.vector_dtype)
+            with open(snapshot_dir / SNAPSHOT_PICKLE_FILE, 'rb') as f:
+                payload = pickle.load(f)
+            self._set_chunks(payload['chunks'])
+            self.next_id = payload['next_id']
     
     def _create_new_index(self):
-        """新規インデックス作成"""
-        import faiss  # ここでインポート！
-        self.index = faiss.IndexFlatIP(self.dimension)  # 内積インデックスに変更
-        self.metadata = []
-        logger.info(f"Created new index for user {self.user_id}")
+        """新規インデックス作成（最初は厳密検索のフラットインデックス）"""
+        self.index = create_flat_index(self.dimension, self.engine, self.vector_dtype)
+        self.metadata = ChunkMetadata()
+        self.next_id = 0
     
-    def add_document(self, document_id: int, title: str, content: str, embedding: List[float]):
-        print(f"🔍 add_document called: self.index={self.index}, dimension={self.dimension}")
-        """ドキュメントをFAISSインデックスに追加"""
-        import faiss
-        import numpy as np
+    def _set_chunks(self, chunks: Dict[int, dict]):
+        """チャンクID → メタデータの辞書を列形式のメタデータに変換"""
+        chunk_ids = sorted(chunks)
+        self.metadata = ChunkMetadata()
+        self.metadata.add_batch(
+            np.array(chunk_ids, dtype='int64'),
+            [chunks[chunk_id] for chunk_id in chunk_ids]
+        )
+    
+    def _migrate_legacy(self, legacy_index: Tuple[np.ndarray, np.ndarray], legacy_metadata):
+        """
+        旧形式のインデックスをIDマップ形式のスナップショットに変換
+
+        旧形式ではFAISS内の位置がそのままメタデータリストの位置なので、
+        位置をそのままチャンクIDとして採番する
+        """
+        ids, vectors = legacy_index
+        self.index = create_flat_index(vectors.shape[1], self.engine, self.vector_dtype)
         
-        if self.index is None:
-            self.index = faiss.IndexFlatIP(self.dimension)  # 内積インデックスに統一
+        if isinstance(legacy_metadata, dict) and 'next_id' in legacy_metadata:
+            # IDマップ形式の2ファイル構成はIDをそのまま取り込む
+            if len(ids):
+                self.index.add(np.array(vectors), np.array(ids))
+            self._set_chunks(legacy_metadata['chunks'])
+            self.next_id = legacy_metadata['next_id']
+        else:
+            if isinstance(legacy_metadata, dict):
+                chunks = legacy_metadata['chunks']
+                legacy_metadata = [chunks[i] for i in sorted(chunks)]
+            
+            count = min(len(ids), len(legacy_metadata))
+            if count:
+                self.index.add(np.array(vectors[:count]), np.arange(count, dtype='int64'))
+            self._set_chunks({i: legacy_metadata[i] for i in range(count)})
+            self.next_id = count
         
-        # 埋め込みベクトルをnumpy配列に変換
-        embedding_array = np.array([embedding]).astype('float32')
+        self.checkpoint()
         
-        # L2正規化を適用
-        faiss.normalize_L2(embedding_array)
+        # スナップショットが確定してから旧ファイルを削除
+        self.index_path.unlink(missing_ok=True)
+        self.metadata_path.unlink(missing_ok=True)
+        logger.info(f"Migrated legacy index for user {self.user_id}: {len(self.metadata)} chunks")
+    
+    def _migrate_embeddings(self, model_changed: bool = False):
+        """
+        保存済みのストアを設定の埋め込みモデル・次元数に変換してスナップショットを作り直す
+
+        同じモデルで次元数を減らす場合は先頭の次元に切り詰めて再正規化する（Matryoshka表現の埋め込み）。
+        次元数を増やす場合やモデルが変わった場合は既存の埋め込みから作れないので、チャンク本文から埋め込み直す
+        """
+        source = self.index.dimension
+        change = (f"model {self._stored_embedding_model} to {self.embedding_model}" if model_changed
+                  else f"dimension {source} to {self.dimension}")
+        ids, vectors = self.index.vectors()
+        alive = self.metadata.contains(ids)
+        ids, vectors = ids[alive], vectors[alive]
         
-        # インデックスにベクトルを追加
-        self.index.add(embedding_array)
+        if not model_changed and source > self.dimension:
+            vectors = np.ascontiguousarray(vectors[:, :self.dimension], dtype='float32')
+        elif self._reembed is not None:
+            contents = [self.metadata.get(int(chunk_id))['content'] for chunk_id in ids]
+            vectors = np.array(self._reembed(contents), dtype='float32').reshape(len(ids), self.dimension)
+        elif model_changed:
+            raise ValueError(
+                f"Vector store for user {self.user_id} was embedded with {self._stored_embedding_model}, "
+                f"expected {self.embedding_model}; re-embedding is required"
+            )
+        else:
+            raise ValueError(
+                f"Vector store for user {self.user_id} has dimension {source}, "
+                f"expected {self.dimension}; re-embedding is required"
+            )
+        normalize_L2(vectors)
         
-        # メタデータを追加
-        self.metadata.append({
-            'document_id': document_id,
-            'title': title,
-            'content': content
-        })
+        self.index = build_index(INDEX_FLAT, self.dimension, ids, vectors, self.engine, self.vector_dtype)
+        self._stored_embedding_model = self.embedding_model
+        self.checkpoint()
+        logger.info(
+            f"Migrated vector store for user {self.user_id} from {change} "
+            f"({len(ids)} chunks)"
+        )
+        # 大きいストアは設定の近似インデックスに戻す
+        with self._lock:
+            self._maybe_schedule_rebuild()
+    
+    @staticmethod
+    def _apply_to_index(index: VectorIndex, record: tuple):
+        op = record[0]
+        if op == 'add':
+            index.add(record[2], record[1])
+        elif op == 'remove':
+            index.remove(record[1])
+        elif op in ('update', 'reference', 'unreference'):
+            pass  # メタデータだけの変更
+        else:
+            raise ValueError(f"Unknown log record: {op}")
+    
+    @staticmethod
+    def _apply_to_metadata(metadata: ChunkMetadata, record: tuple):
+        op = record[0]
+        if op == 'add':
+            metadata.add_batch(record[1], record[3])
+        elif op == 'update':
+            metadata.update(record[1], record[2])
+        elif op == 'reference':
+            metadata.add_references(record[1], record[2])
+        elif op == 'unreference':
+            metadata.drop_references(record[1])
+        else:
+            metadata.remove_ids(record[1])
+    
+    def _apply(self, record: tuple):
+        """変更レコードをメモリ上のインデックスとメタデータに反映"""
+        self._apply_to_index(self.index, record)
+        self._apply_to_metadata(self.metadata, record)
+        if record[0] == 'add':
+            _, ids, vectors, metadatas = record
+            self.next_id = max(self.next_id, int(ids[-1]) + 1)
+            if self._near_duplicates is not None and self._near_duplicates_of is self.metadata:
+                self._near_duplicates.add(ids, [meta.get('simhash', 0) for meta in metadatas])
         
-        # 即時保存
-        self._save()
-        logger.info(f"Added document {document_id} to index. Total: {len(self.metadata)}")
+        if self._pending_records is not None:
+            self._pending_records.append(record)
+        if self._unsnapshotted_records is not None:
+            self._unsnapshotted_records.append(record)
+    
+    def _commit(self, record: tuple):
+        """ログに追記してからメモリに反映（先行書き込み）"""
+        with self._lock:
+            self._persistence.append(record)
+            self._apply(record)
+            self._maybe_schedule_checkpoint()
+            self._maybe_schedule_rebuild()
+    
+    def _maybe_schedule_checkpoint(self):
+        if self._persistence.needs_checkpoint() and not self._checkpoint_scheduled:
+            self._checkpoint_scheduled = True
+            _maintenance_executor.submit(self.checkpoint)
     
-    def remove_document(self, document_id: int):
-        """ドキュメントをFAISSから削除"""
-        if not FAISS_AVAILABLE:
+    def _dead_vectors(self) -> int:
+        """インデックスに残っている論理削除済みベクトルの数"""
+        return max(0, self.index.ntotal - len(self.metadata)) if self.index.lazy_delete else 0
+    
+    def _maybe_schedule_rebuild(self):
+        """閾値を超えたフラットインデックスの昇格や、削除の溜まったHNSWの作り直しを予約"""
+        if self._rebuild_scheduled:
             return
+        kind = None
+        if self.index.kind == INDEX_FLAT and self.ann_index_type != INDEX_FLAT \
+                and len(self.metadata) >= self.ann_threshold:
+            kind = self.ann_index_type
+        elif self.index.lazy_delete and self._dead_vectors() > self.index.ntotal * HNSW_REBUILD_DEAD_RATIO:
+            kind = self.index.kind
+        if kind is not None:
+            self._rebuild_scheduled = True
+            _maintenance_executor.submit(self.rebuild_index, kind)
+    
+    def rebuild_index(self, kind: Optional[str] = None):
+        """
+        インデックスを指定した種類で作り直す（近似インデックスへの昇格など）
+
+        ロック内では現在のベクトルを取り出すだけで、学習と追加はロック外で行う。
+        その間の変更は記録しておき、差し替え直前に新しいインデックスにも反映する
+        """
+        kind = kind or self.index.kind
+        try:
+            with self._lock:
+                if self._pending_records is not None:
+                    return  # 作り直し中
+                ids, vectors = self.index.vectors()
+                if self.index.lazy_delete:
+                    alive = self.metadata.contains(ids)
+                    ids, vectors = ids[alive], vectors[alive]
+                self._pending_records = []
+            
+            new_index = build_index(kind, self.dimension, ids, vectors, self.engine, self.vector_dtype)
+            
+            with self._lock:
+                for record in self._pending_records:
+                    self._apply_to_index(new_index, record)
+                old_kind = self.index.kind
+                self.index = new_index
+                self._pending_records = None
+            logger.info(f"Rebuilt index for user {self.user_id}: {old_kind} -> {kind} ({new_index.ntotal} vectors)")
+        except Exception as e:
+            logger.error(f"Index rebuild failed for user {self.user_id}: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._pending_records = None
+                self._rebuild_scheduled = False
         
-        # 削除対象のメタデータを探す
-        new_metadata = []
-        remove_indices = []
+        # 新しい種類のインデックスをスナップショットに反映
+        self.checkpoint()
+    
+    def checkpoint(self):
+        """
+        現在の状態をスナップショットとして書き出し、取り込んだログを削除
+
+        ロック内ではログの切り替えと状態のコピーだけを行い、
+        ディスクへの書き込みはロック外で行う
+        """
+        try:
+            with self._checkpoint_lock:
+                self._write_checkpoint()
+        except Exception as e:
+            logger.error(f"Checkpoint failed for user {self.user_id}: {e}")
+            raise
+        finally:
+            self._checkpoint_scheduled = False
+    
+    def _write_checkpoint(self):
+        with self._lock:
+            gen = self._persistence.rotate()
+            write_index = self.index.snapshot_writer()
+            metadata = self.metadata.frozen()
+            manifest = {
+                'format_version': SNAPSHOT_FORMAT_VERSION,
+                'index_type': self.index.kind,
+                'dimension': self.dimension,
+                'next_id': self.next_id,
+                'count': len(metadata),
+                'embedding_model': self.embedding_model,
+            }
+            self._unsnapshotted_records = []
         
-        for i, meta in enumerate(self.metadata):
-            if meta['document_id'] != document_id:
-                new_metadata.append(meta)
-            else:
-                remove_indices.append(i)
+        def write(snapshot_dir: Path):
+            write_index(snapshot_dir)
+            metadata.write(snapshot_dir)
+            with open(snapshot_dir / SNAPSHOT_MANIFEST_FILE, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
         
-        if not remove_indices:
-            return  # 削除対象がなかった
+        try:
+            snapshot_dir = self._persistence.write_snapshot(gen, write)
+        except Exception:
+            with self._lock:
+                self._unsnapshotted_records = None
+            raise
+        self._reopen_snapshot(snapshot_dir)
+    
+    def _reopen_snapshot(self, snapshot_dir: Path):
+        """
+        書き出したスナップショットをmmapで開き直し、ヒープ上のインデックスとメタデータの追記分を手放す
+
+        書き込み中に入った変更は開き直したものにも反映する。インデックスの作り直し中は、
+        作り直し後のチェックポイントで開き直すのでメタデータだけを差し替える
+        """
+        with self._lock:
+            records, self._unsnapshotted_records = self._unsnapshotted_records, None
+            if records is None:
+                return
+            index = self.index.reopen(snapshot_dir) if self._pending_records is None else None
+            metadata = ChunkMetadata(MappedChunkTable(snapshot_dir))
+            for record in records:
+                if index is not None:
+                    self._apply_to_index(index, record)
+                self._apply_to_metadata(metadata, record)
+            if index is not None:
+                self.index = index
+            if self._near_duplicates_of is self.metadata:
+                # 中身は同じなのでSimHash索引はそのまま使う
+                self._near_duplicates_of = metadata
+            self.metadata = metadata
+        logger.info(f"Reopened snapshot {snapshot_dir.name} for user {self.user_id} with memory mapping")
+    
+    def add_document(self, document_id: int, title: str, content: str, embedding: List[float]):
+        """ドキュメント（1チャンク）をインデックスに追加"""
+        self.add_documents(
+            np.asarray(embedding, dtype='float32').reshape(1, -1),
+            [{'document_id': document_id, 'title': title, 'content': content}]
+        )
+
+    def add_documents(self, embeddings: np.ndarray, metadatas: List[dict]) -> np.ndarray:
+        """
+        複数チャンクをまとめてインデックスに追加し、採番したチャンクIDを返す
+
+        正規化・index.add・ログ追記をそれぞれ1回で済ませる
+        """
+        if not metadatas:
+            return np.zeros(0, dtype='int64')
+
+        # 呼び出し元の配列を書き換えないようにコピーしてから正規化
+        embedding_array = np.array(embeddings, dtype='float32').reshape(len(metadatas), -1)
+        if embedding_array.shape[1] != self.dimension:
+            raise ValueError(
+                f"Embedding dimension mismatch: expected {self.dimension}, got {embedding_array.shape[1]}"
+            )
+
+        # L2正規化を一括適用
+        normalize_L2(embedding_array)
+
+        with self._lock:
+            # チャンクIDを採番してまとめて追加
+            ids = np.arange(self.next_id, self.next_id + len(metadatas), dtype='int64')
+            self._commit(('add', ids, embedding_array, list(metadatas)))
+        logger.info(f"Added {len(metadatas)} chunks to index. Total: {len(self.metadata)}")
+        return ids
+
+    def replace_chunks(self, embeddings: np.ndarray, metadatas: List[dict],
+                       references: Optional[List[Tuple[int, int, int, int]]] = None):
+        """
+        全チャンクを入れ替えてスナップショットを書き出す（DBからのインデックス再構築用）
+
+        チャンクIDは metadatas の順に0から振り直す。ログを通さずにインデックスをまとめて作るので、
+        チャンクが多くてもログは膨らまない
+
+        Args:
+            references: 埋め込みを省いた箇所 (参照先の metadatas 上の位置, ドキュメントID, start, end)
+        """
+        vectors = np.array(embeddings, dtype='float32').reshape(len(metadatas), -1) if metadatas \
+            else np.zeros((0, self.dimension), dtype='float32')
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(
+                f"Embedding dimension mismatch: expected {self.dimension}, got {vectors.shape[1]}"
+            )
+        normalize_L2(vectors)
+        ids = np.arange(len(metadatas), dtype='int64')
+        kind = self.ann_index_type if len(metadatas) >= self.ann_threshold else INDEX_FLAT
+        index = build_index(kind, self.dimension, ids, vectors, self.engine, self.vector_dtype)
+        metadata = ChunkMetadata()
+        metadata.add_batch(ids, list(metadatas))
+        if references:
+            metadata.add_references(
+                np.array([reference[0] for reference in references], dtype='int64'),
+                [reference[1:] for reference in references]
+            )
         
-        # 新しいインデックスを作成
-        if new_metadata:
-            # 残りのドキュメントで新しいインデックスを作成
-            new_index = faiss.IndexFlatIP(self.dimension)  # IndexFlatIPに統一
-            
-            # 既存の埋め込みを再構築（簡易的な実装）
-            # 実際には埋め込みを保存しておく必要がある
-            for i in range(self.index.ntotal):
-                if i not in remove_indices:
-                    embedding = self.index.reconstruct(i)
-                    # L2正規化を適用して追加
-                    normalized_embedding = embedding.reshape(1, -1)
-                    faiss.normalize_L2(normalized_embedding)
-                    new_index.add(normalized_embedding)
+        # 差し替えとスナップショットの間にほかの書き込みが入らないようにする
+        with self._checkpoint_lock, self._lock:
+            if self._pending_records is not None:
+                raise RuntimeError(f"Index rebuild in progress for user {self.user_id}")
+            self.index = index
+            self.metadata = metadata
+            self.next_id = len(metadatas)
+            self._stored_embedding_model = self.embedding_model
+            self._write_checkpoint()
+        logger.info(f"Replaced all chunks for user {self.user_id}: {len(metadatas)} chunks ({kind})")
+
+    def remove_document(self, document_id: int) -> List[Tuple[int, int, int]]:
+        """
+        ドキュメントをインデックスから削除
+
+        削除したチャンクを重複として参照していたほかのドキュメントの箇所 (ドキュメントID, start, end) を返す
+        （呼び出し元で埋め込み直して追加する）
+        """
+        with self._lock:
+            self._drop_references(document_id)
+            # ドキュメントID → 行範囲の索引から対象チャンクを取得（全件走査しない）
+            chunk_ids = self.metadata.chunk_ids_for_document(document_id)
+            if len(chunk_ids) == 0:
+                return []  # 削除対象がなかった
+            orphaned = self.metadata.references_of(chunk_ids)
             
-            self.index = new_index
-            self.metadata = new_metadata
-        else:
-            # 全部削除の場合
-            self.index = faiss.IndexFlatIP(self.dimension)  # IndexFlatIPに統一
-            self.metadata = []
-        
-        self._save()
-        logger.info(f"Removed document {document_id} from FAISS")
+            # 対象チャンクのIDだけを一括削除（インデックスの再構築は不要）
+            self._commit(('remove', chunk_ids.astype('int64')))
+            self.metadata.forget_document(document_id)
+        logger.info(f"Removed document {document_id} from vector index")
+        return orphaned
+
+    def _drop_references(self, document_id: int):
+        if self.metadata.has_references_from(document_id):
+            self._commit(('unreference', document_id))
+
+    def find_near_duplicates(self, simhashes: np.ndarray, max_distance: int) -> np.ndarray:
+        """SimHashごとに、ほぼ同じ本文の既存チャンクIDを返す（なければ -1）"""
+        with self._lock:
+            if self._near_duplicates is None or self._near_duplicates_of is not self.metadata \
+                    or self._near_duplicates.max_distance != max_distance:
+                self._near_duplicates = NearDuplicateIndex(max_distance)
+                self._near_duplicates.add(*self.metadata.simhash_rows())
+                self._near_duplicates_of = self.metadata
+            return self._near_duplicates.find(simhashes, self.metadata.contains)
+
+    def add_references(self, chunk_ids: np.ndarray, references: List[Tuple[int, int, int]]) -> np.ndarray:
+        """
+        既存チャンクと同じ内容のため埋め込みを省いた箇所 (ドキュメントID, start, end) を記録
+
+        参照先がすでに削除されていた箇所は記録せず、そのフラグを返す（呼び出し元で埋め込んで追加する）
+        """
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        with self._lock:
+            alive = self.metadata.contains(chunk_ids)
+            if alive.any():
+                self._commit(('reference', chunk_ids[alive], [
+                    tuple(reference) for reference, ok in zip(references, alive.tolist()) if ok
+                ]))
+        return ~alive
     
-    def search(self, query_embedding: np.ndarray, top_k: int = 3):
+    def document_chunks(self, document_id: int) -> List[Tuple[int, dict]]:
+        """ドキュメントのチャンクを (チャンクID, メタデータ) のリストで返す（追加順）"""
+        with self._lock:
+            return [
+                (int(chunk_id), self.metadata.get(int(chunk_id)))
+                for chunk_id in self.metadata.chunk_ids_for_document(document_id)
+            ]
 
-        if self.index.ntotal == 0:
-            return []
-        k = min(top_k, self.index.ntotal)
+    def update_document_chunks(
+        self,
+        document_id: int,
+        removed_ids: List[int],
+        updates: Dict[int, dict],
+        embeddings: np.ndarray,
+        metadatas: List[dict],
+    ):
+        """
+        ドキュメントのチャンクを差分で更新
 
-        distances, indices = self.index.search(
-            query_embedding.reshape(1, -1),
-            k
+        消えたチャンクを削除し、残ったチャンクはタイトル・位置だけを書き換え、新しいチャンクを追加する。
+        ほかの書き込みが途中の状態を見ないよう、ロックを持ったまま続けて行う。
+        ドキュメントから既存チャンクへの参照は外し（新しい本文は参照を使わずに突き合わせている）、
+        削除したチャンクを参照していたほかのドキュメントの箇所を返す
+        """
+        with self._lock:
+            self._drop_references(document_id)
+            orphaned = self.metadata.references_of(np.asarray(removed_ids, dtype='int64'))
+            if removed_ids:
+                self._commit(('remove', np.asarray(removed_ids, dtype='int64')))
+            if updates:
+                self._commit(('update', np.asarray(list(updates), dtype='int64'), list(updates.values())))
+            self.add_documents(embeddings, metadatas)
+        logger.info(
+            f"Updated document {document_id}: {len(removed_ids)} removed, "
+            f"{len(updates)} updated, {len(metadatas)} added"
         )
+        return orphaned
 
-        results = []
+    def search(self, query_embedding: np.ndarray, top_k: int = 3, params: Optional[dict] = None):
+        """
+        類似チャンク検索
 
-        for idx, distance in zip(indices[0], distances[0]):
-            if idx < len(self.metadata):
-                metadata = self.metadata[idx]
-                results.append((metadata, float(distance)))
+        params で近似インデックスの検索パラメータ（nprobe / ef_search）をリクエスト単位で指定できる
+        """
+        return self.search_batch(np.asarray(query_embedding).reshape(1, -1), top_k, params)[0]
 
-        return results
-    
-    def _save(self):
-        import faiss  # ここでインポート！
-        faiss.write_index(self.index, str(self.index_path))
-        with open(self.metadata_path, 'wb') as f:
-            pickle.dump(self.metadata, f)
+    def search_batch(
+        self, query_embeddings: np.ndarray, top_k: int = 3, params: Optional[dict] = None
+    ) -> List[List[Tuple[dict, float]]]:
+        """
+        複数クエリの類似チャンクをまとめて検索
+
+        インデックスへの検索は (クエリ数, 次元) の行列で1回だけ行い、クエリごとの結果を入力順に返す
+        """
+        queries = np.ascontiguousarray(query_embeddings, dtype='float32').reshape(-1, self.dimension)
+        with self._lock:
+            if self.index.ntotal == 0:
+                return [[] for _ in range(len(queries))]
+            # 論理削除済みのベクトルが混ざる分だけ多めに取得する
+            k = min(top_k + self._dead_vectors(), self.index.ntotal)
+
+            distances, indices = self.index.search(queries, k, params)
+
+            batch_results = []
+            for row_indices, row_distances in zip(indices, distances):
+                results = []
+                for idx, distance in zip(row_indices, row_distances):
+                    # 上位k件の行だけをデコードする
+                    metadata = self.metadata.get(int(idx))
+                    if metadata is not None:
+                        results.append((metadata, float(distance)))
+                        if len(results) == top_k:
+                            break
+                batch_results.append(results)
+
+        return batch_results
+
+    def evaluate_recall(self, query_embeddings: np.ndarray, top_k: int = 3, params: Optional[dict] = None) -> dict:
+        """現在のインデックスの recall@k を厳密検索と比較して測る（クエリはL2正規化済み）"""
+        with self._lock:
+            result = recall_at_k(self.index, np.asarray(query_embeddings, dtype='float32'), top_k, params)
+        result['index_type'] = self.index.kind
+        return result
 
     def get_document_count(self) -> int:
         return len(self.metadata)
 
-# シングルトン管理
-_vector_stores = {}
+    def memory_usage(self) -> int:
+        """
+        ヒープ上のインデックスとメタデータの概算メモリ使用量（バイト）
 
-def get_vector_store(user_id: int) -> VectorStore:
-    """ユーザーごとのVectorStoreシングルトンを取得"""
+        mmap中のスナップショットはページキャッシュでプロセス間共有されるため数えない
+        """
+        if self.index is None:
+            return 0
+        return self.index.memory_usage() + self.metadata.memory_usage()
+
+    def close(self):
+        """開いているログファイルを閉じる（キャッシュから追い出す時に呼ぶ）"""
+        with self._lock:
+            self._persistence.close()
+
+
+class VectorStoreCache:
+    """
+    ユーザーごとのVectorStoreのLRUキャッシュ
+
+    全ストアの概算メモリ使用量の合計が予算を超えたら、
+    最近使われていないストアから追い出す。追い出したストアは次回アクセス時にディスクから再読み込みする
+    """
+
+    def __init__(self, budget_bytes: int, loader: Callable[[int], VectorStore]):
+        self.budget_bytes = budget_bytes
+        self._loader = loader
+        self._stores: "OrderedDict[int, VectorStore]" = OrderedDict()
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> VectorStore:
+        with self._lock:
+            store = self._stores.get(user_id)
+            if store is not None:
+                self.hits += 1
+                self._stores.move_to_end(user_id)
+            else:
+                self.misses += 1
+                store = self._loader(user_id)
+                self._stores[user_id] = store
+            
+            self._enforce_budget()
+            return store
+
+    def _enforce_budget(self):
+        """予算を超えている間、古いストアから追い出す（直近に使ったストアは残す）"""
+        total = self.memory_usage()
+        while total > self.budget_bytes and len(self._stores) > 1:
+            user_id, store = self._stores.popitem(last=False)
+            total -= store.memory_usage()
+            store.close()
+            self.evictions += 1
+            logger.info(f"Evicted VectorStore for user {user_id} from cache")
+
+    def invalidate(self, user_id: int):
+        """指定ユーザーのストアをキャッシュから外す"""
+        with self._lock:
+            store = self._stores.pop(user_id, None)
+            if store is not None:
+                store.close()
+
+    def memory_usage(self) -> int:
+        return sum(store.memory_usage() for store in self._stores.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'stores': len(self._stores),
+                'memory_bytes': self.memory_usage(),
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _load_vector_store(user_id: int) -> VectorStore:
+    """設定に従ってディスクからVectorStoreを読み込む"""
+    from app.config import settings
     from app.services.embeddings import get_embedding_service
     
-    if user_id not in _vector_stores:
-        embedding_service = get_embedding_service()
-        _vector_stores[user_id] = VectorStore(user_id, dimension=embedding_service.dimension)
-        logger.info(f"Created new VectorStore for user {user_id}")
+    embedding_service = get_embedding_service()
     
-    return _vector_stores[user_id]
\ No newline at end of file
+    def reembed(contents: List[str]) -> np.ndarray:
+        # 次元数を増やした・モデルを変えた既存ストアの移行用。埋め込みの呼び出しはバッチ単位
+        step = settings.EMBEDDING_BATCH_SIZE
+        parts = [embedding_service.embed_texts(contents[i:i + step]) for i in range(0, len(contents), step)]
+        return np.vstack(parts) if parts else np.zeros((0, embedding_service.dimension), dtype='float32')
+    
+    store = VectorStore(
+        user_id,
+        dimension=embedding_service.dimension,
+        storage_dir=settings.VECTOR_STORE_DIR,
+        checkpoint_bytes=settings.VECTOR_STORE_CHECKPOINT_MB * 1024 * 1024,
+        ann_index_type=settings.VECTOR_ANN_INDEX_TYPE,
+        ann_threshold=settings.VECTOR_ANN_THRESHOLD,
+        engine=settings.VECTOR_ENGINE,
+        vector_dtype=settings.VECTOR_NUMPY_DTYPE,
+        reembed=reembed,
+        embedding_model=embedding_service.model_name
+    )
+    logger.info(f"Created new VectorStore for user {user_id}")
+    return store
+
+
+# シングルトン管理
+_vector_store_cache: Optional[VectorStoreCache] = None
+
+
+def get_vector_store_cache() -> VectorStoreCache:
+    global _vector_store_cache
+    if _vector_store_cache is None:
+        from app.config import settings
+        _vector_store_cache = VectorStoreCache(
+            budget_bytes=settings.VECTOR_STORE_CACHE_MB * 1024 * 1024,
+            loader=_load_vector_store
+        )
+    return _vector_store_cache
+
+
+def get_vector_store(user_id: int) -> VectorStore:
+    """ユーザーごとのVectorStoreをキャッシュから取得（なければディスクから読み込む）"""
+    return get_vector_store_cache().get(user_id)
+
+
+def discard_vector_store(user_id: int, storage_dir: str = "./vector_stores"):
+    """
+    ユーザーのベクトルストアのファイル（スナップショット・ログ・旧形式）を削除する
+
+    壊れたストアを読み込まずにDBから作り直す時に使う。使用中のストアはキャッシュから外してから消す
+    """
+    if _vector_store_cache is not None:
+        _vector_store_cache.invalidate(user_id)
+    root = Path(storage_dir)
+    shutil.rmtree(root / f"user_{user_id}", ignore_errors=True)
+    (root / f"user_{user_id}_index.faiss").unlink(missing_ok=True)
+    (root / f"user_{user_id}_metadata.pkl").unlink(missing_ok=True)
+    logger.info(f"Discarded vector store files for user {user_id}")
+
+
+def migrate_legacy_stores(storage_dir: str = "./vector_stores", dimension: int = 1024) -> List[int]:
+    """
+    旧形式（2ファイル構成）の全ユーザーのインデックスを一括変換
+
+    読み込み時にも自動で変換されるが、デプロイ前にまとめて移行したい場合に使う
+    例: python -c "from app.services.vector_store import migrate_legacy_stores; migrate_legacy_stores()"
+    """
+    migrated = []
+    for index_path in sorted(Path(storage_dir).glob("user_*_index.faiss")):
+        user_id = int(index_path.name[len("user_"):-len("_index.faiss")])
+        VectorStore(user_id, dimension=dimension, storage_dir=storage_dir)
+        migrated.append(user_id)
+    return migrated
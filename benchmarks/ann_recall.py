@@ -0,0 +1,61 @@
+"""
+近似インデックス（IVF / HNSW）の recall@k と検索レイテンシをフラットインデックスと比較
+
+使い方:
+    python -m benchmarks.ann_recall --vectors 50000 --dimension 1024 --queries 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.services.vector_index import INDEX_FLAT, INDEX_HNSW, INDEX_IVF, build_index, recall_at_k
+
+
+def _normalized(rng, n, dimension):
+    vectors = rng.standard_normal((n, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def _latency_ms(index, queries, k, params):
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query.reshape(1, -1), k, params)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = _normalized(rng, args.vectors, args.dimension)
+    ids = np.arange(args.vectors, dtype=np.int64)
+    # 実データに近づけるため、クエリは既存ベクトルにノイズを加えたもの
+    queries = vectors[rng.integers(0, args.vectors, args.queries)] \
+        + 0.05 * _normalized(rng, args.queries, args.dimension)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    cases = [
+        (INDEX_FLAT, [None]),
+        (INDEX_IVF, [{'nprobe': n} for n in (4, 16, 64)]),
+        (INDEX_HNSW, [{'ef_search': ef} for ef in (16, 64, 256)]),
+    ]
+    print(f"{'index':<6} {'params':<20} {'build[s]':>9} {'recall@k':>9} {'latency[ms]':>12}")
+    for kind, param_sets in cases:
+        start = time.perf_counter()
+        index = build_index(kind, args.dimension, ids, vectors)
+        build_seconds = time.perf_counter() - start
+        for params in param_sets:
+            recall = recall_at_k(index, queries, args.k, params)['recall']
+            latency = _latency_ms(index, queries, args.k, params)
+            print(f"{kind:<6} {str(params or '-'):<20} {build_seconds:>9.2f} {recall:>9.3f} {latency:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
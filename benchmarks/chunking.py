@@ -0,0 +1,111 @@
+"""
+旧チャンク分割（chunk_text_semantic: 文字列の連結と overlap のスライス）と
+オフセットベースのストリーミング分割（iter_text_chunks）を比較
+日本語・英語・混在の数MBのテキストで、処理時間・チャンク数・上限を超えたチャンク数を出力する
+
+使い方:
+    python -m benchmarks.chunking --megabytes 4 --max-length 800 --overlap 100
+"""
+import argparse
+import random
+import re
+import time
+
+from app.services.chunking import iter_text_chunks
+
+_JAPANESE = ["東京の天気は晴れです。", "明日は雨が降るでしょう！", "会議は何時からですか？",
+             "このドキュメントは社内向けの資料です。", "詳細は「別紙」を参照してください。"]
+_ENGLISH = ["The quick brown fox jumps over the lazy dog. ", "Is this the right way? ",
+            "Embeddings are computed in batches. ", "See section 3.2 for details! ",
+            "Each chunk keeps its offsets into the original document. "]
+
+
+def chunk_text_semantic(text: str, max_length: int = 500, overlap: int = 50):
+    """旧実装（比較用にそのまま残す）"""
+
+    chunks = []
+
+    paragraphs = re.split(r'\n\n+', text)
+
+    for paragraph in paragraphs:
+
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+
+        sentences = re.split(r'(?<=[。！？])', paragraph)
+
+        current_chunk = ""
+
+        for sentence in sentences:
+
+            if len(current_chunk) + len(sentence) <= max_length:
+                current_chunk += sentence
+
+            else:
+                chunks.append(current_chunk.strip())
+
+                current_chunk = current_chunk[-overlap:] + sentence
+
+        if current_chunk.strip():
+            chunks.append(current_chunk.strip())
+
+    return chunks
+
+
+def _generate(rng, sentences, size: int) -> str:
+    """段落（3〜40文）を空行でつないで約 size 文字のテキストを作る"""
+    parts = []
+    length = 0
+    while length < size:
+        paragraph = "".join(rng.choice(sentences) for _ in range(rng.randint(3, 40)))
+        parts.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(parts)
+
+
+def _pieces(text: str, size: int = 64 * 1024):
+    """取り込みパイプラインと同じくブロックごとに渡す"""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--megabytes", type=float, default=2.0)
+    parser.add_argument("--max-length", type=int, default=800)
+    parser.add_argument("--overlap", type=int, default=100)
+    parser.add_argument("--max-tokens", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    size = int(args.megabytes * 1_000_000)
+    inputs = {
+        "japanese": _generate(rng, _JAPANESE, size // 3),
+        "english": _generate(rng, _ENGLISH, size),
+        "mixed": _generate(rng, _JAPANESE + _ENGLISH, size // 2),
+    }
+
+    print(f"{'input':<9} {'chars':>10} {'method':<10} {'time[s]':>8} {'MB/s':>7} {'chunks':>7} {'oversized':>10}")
+    for name, text in inputs.items():
+        megabytes = len(text.encode('utf-8')) / 1_000_000
+
+        start = time.perf_counter()
+        legacy = chunk_text_semantic(text, args.max_length, args.overlap)
+        legacy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chunks = list(iter_text_chunks(_pieces(text), args.max_length, args.overlap, args.max_tokens or None))
+        seconds = time.perf_counter() - start
+
+        for method, elapsed, texts in (
+            ("legacy", legacy_seconds, legacy),
+            ("streaming", seconds, [chunk.text for chunk in chunks]),
+        ):
+            oversized = sum(1 for chunk in texts if len(chunk) > args.max_length)
+            print(f"{name:<9} {len(text):>10} {method:<10} {elapsed:>8.2f} {megabytes / elapsed:>7.1f} "
+                  f"{len(texts):>7} {oversized:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+量子化インデックス（sq8 / pq / binary + 再スコアリング）のメモリ削減量と recall@k の低下を
+フラットインデックス（IndexFlatIP）と比較
+
+使い方:
+    python -m benchmarks.quantization --vectors 50000 --dimension 1024 --queries 200
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from app.services.vector_index import (
+    INDEX_BINARY, INDEX_FLAT, INDEX_PQ, INDEX_SQ8, build_index, load_index, recall_at_k
+)
+
+
+def _normalized(rng, n, dimension):
+    vectors = rng.standard_normal((n, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def _reloaded_memory(index) -> int:
+    """スナップショットに書き出して読み直した後のヒープ使用量（再スコアリング用ベクトルはmmap）"""
+    with tempfile.TemporaryDirectory() as directory:
+        index.snapshot_writer()(Path(directory))
+        return load_index(Path(directory), index.kind).memory_usage()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = _normalized(rng, args.vectors, args.dimension)
+    ids = np.arange(args.vectors, dtype=np.int64)
+    queries = vectors[rng.integers(0, args.vectors, args.queries)] \
+        + 0.05 * _normalized(rng, args.queries, args.dimension)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    flat = build_index(INDEX_FLAT, args.dimension, ids, vectors)
+    # 非圧縮ベクトルがメモリに載った状態の使用量を基準にする
+    flat_bytes = flat.memory_usage()
+
+    # in process: 作った直後（再スコアリング用ベクトルがすべてメモリ上）、reloaded: チェックポイント後の読み直し
+    print(
+        f"{'index':<7} {'rescore':>7} {'in process[MB]':>15} {'saved':>7} {'reloaded[MB]':>13} {'saved':>7} "
+        f"{'recall@k':>9} {'lost':>7} {'latency[ms]':>12}"
+    )
+    for kind in (INDEX_FLAT, INDEX_SQ8, INDEX_PQ, INDEX_BINARY):
+        index = flat if kind == INDEX_FLAT else build_index(kind, args.dimension, ids, vectors)
+        memory = index.memory_usage()
+        reloaded = _reloaded_memory(index)
+        for factor in ([None] if kind == INDEX_FLAT else [1, 4, 16]):
+            params = {'rescore_factor': factor} if factor else None
+            recall = recall_at_k(index, queries, args.k, params)['recall']
+            start = time.perf_counter()
+            for query in queries:
+                index.search(query.reshape(1, -1), args.k, params)
+            latency = (time.perf_counter() - start) * 1000 / len(queries)
+            print(
+                f"{kind:<7} {str(factor or '-'):>7} {memory / 1024 / 1024:>15.1f} {1 - memory / flat_bytes:>7.1%} "
+                f"{reloaded / 1024 / 1024:>13.1f} {1 - reloaded / flat_bytes:>7.1%} "
+                f"{recall:>9.3f} {1 - recall:>7.3f} {latency:>12.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
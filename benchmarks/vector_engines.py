@@ -0,0 +1,65 @@
+"""
+FAISSエンジンとNumPyエンジンのフラット検索（厳密検索）を比較
+追加時間・1クエリあたりのレイテンシ・バッチ検索のスループット・上位k件の一致率を出力する
+
+使い方:
+    python -m benchmarks.vector_engines --vectors 50000 --dimension 1024 --queries 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.services.vector_index import (
+    ENGINE_FAISS, ENGINE_NUMPY, FAISS_AVAILABLE, INDEX_FLAT, build_index, normalize_L2
+)
+
+
+def _normalized(rng, n, dimension):
+    vectors = rng.standard_normal((n, dimension)).astype(np.float32)
+    normalize_L2(vectors)
+    return vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = _normalized(rng, args.vectors, args.dimension)
+    ids = np.arange(args.vectors, dtype=np.int64)
+    queries = _normalized(rng, args.queries, args.dimension)
+
+    cases = [(ENGINE_NUMPY, "float32"), (ENGINE_NUMPY, "float16")]
+    if FAISS_AVAILABLE:
+        cases.insert(0, (ENGINE_FAISS, "float32"))
+
+    reference = None
+    print(f"{'engine':<7} {'dtype':<8} {'build[s]':>9} {'latency[ms]':>12} {'batch[q/s]':>11} {'agree@k':>8}")
+    for engine, dtype in cases:
+        start = time.perf_counter()
+        index = build_index(INDEX_FLAT, args.dimension, ids, vectors, engine, dtype)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query.reshape(1, -1), args.k)
+        latency = (time.perf_counter() - start) * 1000 / len(queries)
+
+        start = time.perf_counter()
+        _, found = index.search(queries, args.k)
+        throughput = len(queries) / (time.perf_counter() - start)
+
+        # 最初のエンジンの結果との上位k件の一致率
+        if reference is None:
+            reference = found
+        agree = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(reference.tolist(), found.tolist())])
+        print(f"{engine:<7} {dtype:<8} {build_seconds:>9.2f} {latency:>12.3f} {throughput:>11.0f} {agree:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
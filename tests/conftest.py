@@ -0,0 +1,74 @@
+"""
+テスト共通の設定
+
+app.config の必須設定はテストでは使わないので、読み込めるようにダミー値を入れておく
+（DBを使うテストは一時ディレクトリのSQLiteに自分でエンジンを作る）
+"""
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///./test.db")
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("GROQ_API_KEY", "test-groq-key")
+os.environ.setdefault("JINA_API_KEY", "test-jina-key")
+
+import hashlib  # noqa: E402
+
+import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.models.init import Base, User  # noqa: E402
+from app.services.embedding_batcher import BatchEmbeddingResult  # noqa: E402
+
+
+class HashEmbedder:
+    """本文のハッシュから決まる埋め込みを返す BatchEmbedder の代わり（"BAD" を含む本文は失敗にする）"""
+
+    def __init__(self, dimension: int = 16):
+        self.dimension = dimension
+        # embed に渡された本文（呼び出しごと）
+        self.calls = []
+
+    def vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+        return np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+
+    async def embed(self, texts):
+        self.calls.append(list(texts))
+        result = BatchEmbeddingResult(len(texts), self.dimension)
+        for i, text in enumerate(texts):
+            if "BAD" in text:
+                result.errors[i] = "rejected"
+            else:
+                result.embeddings[i] = self.vector(text)
+                result.succeeded[i] = True
+        return result
+
+
+@pytest.fixture
+def embedder():
+    return HashEmbedder()
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def user(db):
+    user = User(email="user@example.com", hashed_password="x")
+    db.add(user)
+    db.commit()
+    return user
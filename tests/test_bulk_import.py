@@ -0,0 +1,71 @@
+"""
+一括取り込みの上限（件数・展開後のバイト数・ユーザーごとのドキュメント数）
+"""
+import zipfile
+
+import pytest
+
+from app.models.document import Document
+from app.services.bulk_import import (
+    STATUS_FAILED, STATUS_IMPORTED, BulkBudget, BulkItem, BulkLimitError, import_items, iter_bulk_items
+)
+from app.services.pdf_extraction import PdfExtractor
+from app.services.vector_store import VectorStore
+
+
+def _zip(path, entries):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in entries.items():
+            archive.writestr(name, content)
+    return path
+
+
+def test_archive_stops_once_decompressed_bytes_exceed_budget(tmp_path):
+    # 圧縮すると小さいが、展開すると各エントリが上限の半分を超える
+    path = _zip(tmp_path / "bomb.zip", {f"{i}.txt": "a" * 6000 for i in range(50)})
+    assert path.stat().st_size < 10_000
+    budget = BulkBudget(max_items=1000, max_bytes=10_000)
+    read = []
+
+    with pytest.raises(BulkLimitError):
+        for item in iter_bulk_items(path, "bomb.zip", None, PdfExtractor(workers=0), 1_000_000, budget):
+            read.append(item)
+
+    assert len(read) == 1
+    assert budget.bytes == 12_000
+
+
+def test_item_limit_is_counted_across_files(tmp_path):
+    budget = BulkBudget(max_items=3, max_bytes=1_000_000)
+    first = tmp_path / "a.ndjson"
+    first.write_text('{"title": "a", "content": "x"}\n{"title": "b", "content": "y"}\n', encoding="utf-8")
+    second = _zip(tmp_path / "b.zip", {"c.txt": "z", "d.txt": "w"})
+    read = list(iter_bulk_items(first, "a.ndjson", None, PdfExtractor(workers=0), 1_000_000, budget))
+
+    with pytest.raises(BulkLimitError):
+        for item in iter_bulk_items(second, "b.zip", None, PdfExtractor(workers=0), 1_000_000, budget):
+            read.append(item)
+
+    assert [item.name for item in read] == ["a.ndjson:1", "a.ndjson:2", "b.zip/c.txt"]
+
+
+async def test_items_beyond_document_quota_fail(tmp_path, db, user, embedder):
+    db.add_all([Document(user_id=user.id, title=f"old {i}", content="kept") for i in range(8)])
+    db.commit()
+    store = VectorStore(user.id, dimension=embedder.dimension, storage_dir=str(tmp_path / "vectors"))
+    try:
+        items = [
+            BulkItem("broken.txt", error="本文が空です"),
+            BulkItem("a.txt", "a", "Descale the boiler once a month with citric acid."),
+            BulkItem("b.txt", "b", "Store the grinder burrs dry to keep them from rusting."),
+            BulkItem("c.txt", "c", "Empty the drip tray before it overflows onto the counter."),
+        ]
+        results = await import_items(db, user.id, items, embedder, store, max_documents=10)
+    finally:
+        store.close()
+
+    assert [result['status'] for result in results] == [STATUS_FAILED, STATUS_IMPORTED, STATUS_IMPORTED, STATUS_FAILED]
+    assert results[3]['error'] == "ドキュメント数の上限（10件）に達しています"
+    # 上限を超えた項目は埋め込まない
+    assert embedder.calls == [[items[1].content, items[2].content]]
+    assert db.query(Document).filter(Document.user_id == user.id).count() == 10
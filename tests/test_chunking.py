@@ -0,0 +1,72 @@
+"""
+ストリーミングのチャンク分割（iter_text_chunks）のオフセット
+"""
+import random
+
+import pytest
+
+from app.services.chunking import chunk_text, iter_text_chunks
+
+WORDS = [
+    "東京", "の", "天気", "は", "晴れ", "。", "！", "？", "」", "The", "quick", "brown", "fox.", "jumps!",
+    " ", " ", "\n", "\n\n", "\t", "supercalifragilistic", "x" * 120, "مرحبا؟", "नमस्ते।",
+]
+
+
+def _random_text(rng: random.Random) -> str:
+    return "".join(rng.choice(WORDS) for _ in range(rng.randint(0, 600)))
+
+
+def _split(rng: random.Random, text: str):
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text), rng.randint(0, 30))))
+    return [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_offsets_round_trip_to_source_text(seed):
+    rng = random.Random(seed)
+    for _ in range(20):
+        text = _random_text(rng)
+        max_length = rng.choice([50, 120, 300, 800])
+        overlap = rng.choice([0, 20, 100])
+        max_tokens = rng.choice([None, 30, 100])
+        chunks = chunk_text(text, max_length, overlap, max_tokens)
+
+        covered = bytearray(len(text))
+        for chunk in chunks:
+            assert text[chunk.start:chunk.end] == chunk.text
+            assert 0 < len(chunk.text) <= max_length
+            covered[chunk.start:chunk.end] = b"\x01" * (chunk.end - chunk.start)
+        # 空白以外の文字はどれかのチャンクに入る
+        assert all(covered[i] or text[i].isspace() for i in range(len(text)))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_split_input_gives_same_chunks_as_whole_text(seed):
+    rng = random.Random(seed)
+    for _ in range(20):
+        text = _random_text(rng)
+        max_length = rng.choice([50, 120, 300])
+        overlap = rng.choice([0, 20])
+        whole = [(chunk.start, chunk.end, chunk.text) for chunk in chunk_text(text, max_length, overlap)]
+        pieces = _split(rng, text)
+        streamed = [(chunk.start, chunk.end, chunk.text) for chunk in iter_text_chunks(pieces, max_length, overlap)]
+        assert streamed == whole
+
+
+def test_overlap_repeats_trailing_sentence():
+    text = "一文目。二文目。三文目。四文目。"
+    chunks = chunk_text(text, 9, 4)
+
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [(0, 8), (4, 12), (8, 16)]
+    assert [chunk.text for chunk in chunks] == ["一文目。二文目。", "二文目。三文目。", "三文目。四文目。"]
+
+
+def test_chunks_do_not_cross_paragraphs():
+    text = "これはテスト。二文目です！\n\nNew paragraph. Second sentence here? Yes."
+    chunks = chunk_text(text, 20, 8)
+
+    assert [chunk.text for chunk in chunks] == [
+        "これはテスト。二文目です！", "New paragraph.", "Second sentence", "here? Yes."
+    ]
+    assert all(text[chunk.start:chunk.end] == chunk.text for chunk in chunks)
@@ -0,0 +1,171 @@
+"""
+ほぼ同じチャンクの参照（SimHash）と、参照先を削除した時の埋め込み直し
+"""
+from app.models.document import Document
+from app.models.document_chunk import DocumentChunk
+from app.services.bulk_import import STATUS_FAILED, STATUS_IMPORTED, BulkItem, import_items
+from app.services.chunk_store import encode_embedding, save_document_chunks, save_restored_embeddings
+from app.services.dedup import find_duplicates, load_documents, restore_references, simhashes
+from app.services.vector_store import VectorStore
+
+DIMENSION = 16
+
+ORIGINAL = "Replace the filter cartridge every three months and record the date on the maintenance sheet."
+# 数文字だけ違う版（同じ内容とみなしたい）
+REVISION = "Replace the filter cartridge every three months and record the date on the maintenance sheet!"
+UNRELATED = "The warranty does not cover damage caused by using the appliance outdoors or in heavy rain."
+# 埋め込みに失敗する本文（HashEmbedder は "BAD" を含む本文を失敗にする）
+REJECTED = "BAD request: the embedding API rejects this paragraph, so it can never be indexed at all."
+
+
+def _store(tmp_path):
+    return VectorStore(1, dimension=DIMENSION, storage_dir=str(tmp_path / "vectors"))
+
+
+def _add(store, embedder, document_id, text, start=0):
+    fingerprint = int(simhashes([text])[0])
+    store.add_documents(embedder.vector(text).reshape(1, -1), [{
+        'document_id': document_id, 'title': f"doc {document_id}", 'content': text,
+        'start': start, 'end': start + len(text), 'simhash': fingerprint,
+    }])
+
+
+def test_find_near_duplicates_matches_revised_text_only(tmp_path, embedder):
+    store = _store(tmp_path)
+    try:
+        _add(store, embedder, 1, ORIGINAL)
+        found = store.find_near_duplicates(simhashes([REVISION, UNRELATED]), 3)
+        assert found.tolist() == [0, -1]
+        # 削除したチャンクは参照先にしない
+        store.remove_document(1)
+        assert store.find_near_duplicates(simhashes([REVISION]), 3).tolist() == [-1]
+    finally:
+        store.close()
+
+
+def test_find_duplicates_also_matches_within_batch(tmp_path, embedder):
+    store = _store(tmp_path)
+    try:
+        _add(store, embedder, 1, ORIGINAL)
+        matches = find_duplicates(store, simhashes([UNRELATED, REVISION, UNRELATED + "."]), 3)
+        assert matches.existing.tolist() == [-1, 0, -1]
+        assert matches.within.tolist() == [-1, -1, 0]
+        assert matches.unique.tolist() == [0]
+    finally:
+        store.close()
+
+
+async def test_restore_references_after_deleting_original(tmp_path, embedder):
+    store = _store(tmp_path)
+    try:
+        _add(store, embedder, 1, ORIGINAL)
+        content = "Intro. " + REVISION
+        start = content.index(REVISION)
+        original = int(store.find_near_duplicates(simhashes([REVISION]), 3)[0])
+        missing = store.add_references([original], [(2, start, len(content))])
+        assert not missing.any()
+
+        orphaned = store.remove_document(1)
+        assert orphaned == [(2, start, len(content))]
+
+        await restore_references(store, embedder, lambda ids: {2: ("doc 2", content)}, orphaned)
+
+        chunks = store.document_chunks(2)
+        assert [metadata['content'] for _, metadata in chunks] == [REVISION]
+        assert (chunks[0][1]['start'], chunks[0][1]['end']) == (start, len(content))
+        assert embedder.calls[-1] == [REVISION]
+        assert store.search(embedder.vector(REVISION), top_k=1)[0][0]['document_id'] == 2
+    finally:
+        store.close()
+
+
+async def test_restore_references_saves_embeddings_to_chunk_rows(tmp_path, db, user, embedder):
+    store = _store(tmp_path)
+    try:
+        _add(store, embedder, 100, ORIGINAL)
+        document = Document(user_id=user.id, title="doc 2", content="Intro. " + REVISION)
+        db.add(document)
+        db.flush()
+        start = document.content.index(REVISION)
+        # 参照にしたチャンクの行は埋め込みなし
+        save_document_chunks(db, user.id, document.id, [
+            {'content': "Intro.", 'start': 0, 'end': 6},
+            {'content': REVISION, 'start': start, 'end': len(document.content)},
+        ], {}, store.embedding_model)
+        db.commit()
+        store.add_references([0], [(document.id, start, len(document.content))])
+        orphaned = store.remove_document(100)
+
+        def save(metadatas, embeddings, model):
+            save_restored_embeddings(db, metadatas, embeddings, model)
+            db.commit()
+
+        await restore_references(store, embedder, lambda ids: load_documents(db, ids), orphaned, save)
+
+        rows = db.query(DocumentChunk).filter(DocumentChunk.document_id == document.id)\
+            .order_by(DocumentChunk.position).all()
+        assert rows[0].embedding is None
+        assert rows[1].embedding == encode_embedding(embedder.vector(REVISION))
+        assert rows[1].embedding_model == store.embedding_model
+    finally:
+        store.close()
+
+
+async def test_restore_references_skips_deleted_documents(tmp_path, embedder):
+    store = _store(tmp_path)
+    try:
+        _add(store, embedder, 1, ORIGINAL)
+        store.add_references([0], [(2, 0, len(REVISION))])
+        orphaned = store.remove_document(1)
+
+        await restore_references(store, embedder, lambda ids: {}, orphaned)
+
+        assert len(store.metadata) == 0
+    finally:
+        store.close()
+
+
+async def test_bulk_import_references_existing_and_earlier_chunks(tmp_path, db, user, embedder):
+    store = _store(tmp_path)
+    try:
+        _add(store, embedder, 100, ORIGINAL)
+        items = [
+            BulkItem("a.txt", "a", REVISION),
+            BulkItem("b.txt", "b", UNRELATED),
+            BulkItem("c.txt", "c", UNRELATED + "."),
+            BulkItem("d.txt", "d", REJECTED),
+        ]
+        results = await import_items(db, user.id, items, embedder, store, dedup_max_distance=3)
+
+        assert [result['status'] for result in results] == [STATUS_IMPORTED] * 3 + [STATUS_FAILED]
+        assert [result['chunks_deduplicated'] for result in results[:3]] == [1, 0, 1]
+        assert [result['chunks_indexed'] for result in results[:3]] == [0, 1, 0]
+        # 埋め込んだのは、近いチャンクのない b と d だけ
+        assert embedder.calls == [[UNRELATED, REJECTED]]
+        assert len(store.metadata) == 2
+
+        # c の参照先（同じ回の b）を削除すると、c の本文を埋め込み直す
+        orphaned = store.remove_document(results[1]['document_id'])
+        document_id = results[2]['document_id']
+        assert orphaned == [(document_id, 0, len(UNRELATED) + 1)]
+    finally:
+        store.close()
+
+
+async def test_bulk_import_embeds_duplicates_of_failed_items(tmp_path, db, user, embedder):
+    store = _store(tmp_path)
+    try:
+        # 大文字小文字だけ違うので同じSimHashになるが、b は埋め込める
+        retyped = REJECTED.replace("BAD", "bad")
+        items = [BulkItem("a.txt", "a", REJECTED), BulkItem("b.txt", "b", retyped)]
+        results = await import_items(db, user.id, items, embedder, store, dedup_max_distance=3)
+
+        # 参照先の a が取り込めなかったので、b は参照にせず自分で埋め込む
+        assert [result['status'] for result in results] == [STATUS_FAILED, STATUS_IMPORTED]
+        assert results[1]['chunks_deduplicated'] == 0
+        assert results[1]['chunks_indexed'] == 1
+        assert embedder.calls == [[REJECTED], [retyped]]
+        chunks = store.document_chunks(results[1]['document_id'])
+        assert [metadata['content'] for _, metadata in chunks] == [retyped]
+    finally:
+        store.close()
@@ -0,0 +1,64 @@
+"""
+ローカルONNXプロバイダーのワーカースレッド（モデルの代わりに推論を差し替える）
+"""
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from app.services.embedding_providers import LocalONNXProvider
+
+DIMENSION = 4
+
+
+class _BlockingProvider(LocalONNXProvider):
+    """最初の推論を release されるまで止める"""
+
+    def __init__(self):
+        super().__init__("unused", DIMENSION, quantized=False, batch_wait_ms=0)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _load(self):
+        self._session = object()
+
+    def _infer(self, texts):
+        self.started.set()
+        self.release.wait(5)
+        return np.array([[len(text)] * DIMENSION for text in texts], dtype=np.float32)
+
+
+async def test_cancelled_requests_do_not_stop_the_worker():
+    provider = _BlockingProvider()
+    running = asyncio.ensure_future(provider.aembed(["running"]))
+    await asyncio.to_thread(provider.started.wait, 5)
+    queued = asyncio.ensure_future(provider.aembed(["queued"]))
+    await asyncio.sleep(0.01)
+
+    # 推論中と、キューで待っている呼び出しの両方をキャンセルする（クライアントの切断など）
+    running.cancel()
+    queued.cancel()
+    for task in (running, queued):
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    provider.release.set()
+
+    vectors = await asyncio.wait_for(provider.aembed(["after", "cancel"]), timeout=5)
+    assert vectors[:, 0].tolist() == [5, 6]
+    assert provider._worker.is_alive()
+
+
+async def test_worker_survives_inference_errors():
+    class FailingProvider(_BlockingProvider):
+        def _infer(self, texts):
+            if "boom" in texts:
+                raise RuntimeError("inference failed")
+            return super()._infer(texts)
+
+    provider = FailingProvider()
+    provider.release.set()
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(provider.aembed(["boom"]), timeout=5)
+    vectors = await asyncio.wait_for(provider.aembed(["ok"]), timeout=5)
+    assert vectors[0, 0] == 2
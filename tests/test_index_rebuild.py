@@ -0,0 +1,90 @@
+"""
+document_chunks に保存した埋め込みからのインデックス再構築
+"""
+import shutil
+
+from app.models.document import Document
+from app.models.document_chunk import DocumentChunk
+from app.services.chunk_store import embeddings_by_hash, save_document_chunks
+from app.services.chunking import chunk_text
+from app.services.dedup import simhashes
+from app.services.index_rebuild import rebuild_user_index
+from app.services.vector_store import VectorStore
+
+MODEL = "test-model"
+
+FIRST = (
+    "Clean the intake filter every week.\n\n"
+    "Check the drain hose for kinks before each run.\n\n"
+    "Descale the heating element with citric acid once a month."
+)
+SECOND = "Keep the warranty card together with the receipt in a safe place for at least two years."
+LEGACY = "This document was uploaded before chunks were stored in the database."
+
+
+def _metadatas(document, max_length=60):
+    chunks = chunk_text(document.content, max_length, 0)
+    fingerprints = simhashes([chunk.text for chunk in chunks])
+    return [
+        {'document_id': document.id, 'title': document.title, 'content': chunk.text,
+         'start': chunk.start, 'end': chunk.end, 'simhash': int(fingerprint)}
+        for chunk, fingerprint in zip(chunks, fingerprints)
+    ]
+
+
+async def test_rebuild_reuses_stored_embeddings(tmp_path, db, user, embedder):
+    documents = [Document(user_id=user.id, title=f"doc {i}", content=content)
+                 for i, content in enumerate((FIRST, SECOND, LEGACY))]
+    db.add_all(documents)
+    db.flush()
+    # FIRST は全チャンクの埋め込みを保存済み、SECOND は埋め込みなし（埋め込みに失敗した）、LEGACY は行なし
+    first = _metadatas(documents[0])
+    texts = [metadata['content'] for metadata in first]
+    save_document_chunks(db, user.id, documents[0].id, first,
+                         embeddings_by_hash(texts, [embedder.vector(text) for text in texts]), MODEL)
+    second = _metadatas(documents[1])
+    save_document_chunks(db, user.id, documents[1].id, second, {}, MODEL)
+    db.commit()
+    legacy = [chunk.text for chunk in chunk_text(LEGACY, 60, 0)]
+    missing = len(second) + len(legacy)
+
+    storage_dir = tmp_path / "vectors"
+
+    def fresh_store():
+        shutil.rmtree(storage_dir, ignore_errors=True)
+        return VectorStore(user.id, dimension=embedder.dimension, storage_dir=str(storage_dir), embedding_model=MODEL)
+
+    def rebuild():
+        return rebuild_user_index(db, user.id, embedder, fresh_store, embedder.dimension, model=MODEL,
+                                  max_length=60, overlap=0)
+
+    summary = await rebuild()
+
+    assert summary == {
+        'documents': 3,
+        'documents_chunked': 1,
+        'chunks_total': len(first) + missing,
+        'chunks_reused': len(first),
+        'chunks_embedded': missing,
+        'chunks_deduplicated': 0,
+        'chunks_failed': 0,
+    }
+    # 埋め込んだのは埋め込みのない SECOND と、行を作った LEGACY だけ
+    assert embedder.calls == [[metadata['content'] for metadata in second] + legacy]
+    assert db.query(DocumentChunk).filter(DocumentChunk.embedding.is_(None)).count() == 0
+
+    store = VectorStore(user.id, dimension=embedder.dimension, storage_dir=str(storage_dir), embedding_model=MODEL)
+    try:
+        assert len(store.metadata) == len(first) + missing
+        results = store.search(embedder.vector(texts[1]), top_k=1)
+        assert results[0][0]['content'] == texts[1]
+        assert results[0][0]['document_id'] == documents[0].id
+    finally:
+        store.close()
+
+    # 2回目はすべて保存済みの埋め込みで作り直せる
+    embedder.calls.clear()
+    summary = await rebuild()
+    assert embedder.calls == [[]]
+    assert summary['chunks_reused'] == len(first) + missing
+    assert summary['chunks_embedded'] == 0
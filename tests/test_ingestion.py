@@ -0,0 +1,127 @@
+"""
+取り込みパイプラインの再試行
+"""
+import asyncio
+
+import pytest
+
+from app.models.document import Document
+from app.models.document_chunk import DocumentChunk
+from app.models.ingestion_job import IngestionJob
+from app.services.ingestion import STATUS_RETRYING, STATUS_SUCCEEDED, IngestionPipeline
+from app.services.vector_store import VectorStore
+
+TEXT = "Clean the intake filter every week.\n\nCheck the drain hose for kinks before each run."
+
+
+class _FlakyEmbedder:
+    """最初の succeed_first 回の後、failures 回は全チャンクを失敗にする"""
+
+    def __init__(self, embedder, failures: int, succeed_first: int = 0):
+        self.embedder = embedder
+        self.failures = failures
+        self.succeed_first = succeed_first
+
+    async def embed(self, texts):
+        if self.succeed_first > 0:
+            self.succeed_first -= 1
+        elif self.failures > 0:
+            self.failures -= 1
+            return await self.embedder.embed(["BAD"] * len(texts))
+        return await self.embedder.embed(texts)
+
+
+@pytest.fixture
+def make_pipeline(tmp_path, session_factory, embedder):
+    stores = {}
+
+    def vector_store(user_id):
+        if user_id not in stores:
+            stores[user_id] = VectorStore(user_id, dimension=embedder.dimension, storage_dir=str(tmp_path / "vectors"))
+        return stores[user_id]
+
+    def make(failures: int, retry_backoff: float, succeed_first: int = 0, chunk_group_size: int = 256):
+        flaky = _FlakyEmbedder(embedder, failures, succeed_first)
+        pipeline = IngestionPipeline(session_factory, lambda: flaky, vector_store, spool_dir=str(tmp_path / "spool"),
+                                     retry_backoff=retry_backoff, chunk_max_length=60, chunk_overlap=0,
+                                     chunk_group_size=chunk_group_size)
+        pipeline.stores = stores
+        return pipeline
+    yield make
+    for store in stores.values():
+        store.close()
+
+
+async def _submit(pipeline, db, user, text=TEXT):
+    document = Document(user_id=user.id, title="manual", content="")
+    db.add(document)
+    db.commit()
+    pipeline.spool_dir.mkdir(parents=True, exist_ok=True)
+    path = pipeline.spool_dir / "manual.txt"
+    path.write_text(text, encoding="utf-8")
+    return await pipeline.submit(db, document, "manual.txt", "text/plain", path)
+
+
+async def _wait_for_status(db, job_id, statuses):
+    for _ in range(200):
+        db.expire_all()
+        job = db.get(IngestionJob, job_id)
+        if job.status in statuses:
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job {job_id} stayed {job.status}")
+
+
+async def test_failed_job_is_retried_and_retry_task_released(db, user, make_pipeline):
+    pipeline = make_pipeline(failures=1, retry_backoff=0.01)
+    await pipeline.start()
+    try:
+        job = await _submit(pipeline, db, user)
+        job = await _wait_for_status(db, job.id, (STATUS_SUCCEEDED,))
+        assert job.attempts == 1
+        assert pipeline.retried == 1
+        assert not pipeline._retry_tasks
+    finally:
+        await pipeline.stop()
+
+
+async def test_stop_cancels_pending_retries(db, user, make_pipeline):
+    pipeline = make_pipeline(failures=1, retry_backoff=60)
+    await pipeline.start()
+    job = await _submit(pipeline, db, user)
+    await _wait_for_status(db, job.id, (STATUS_RETRYING,))
+    for _ in range(100):
+        if pipeline._retry_tasks:
+            break
+        await asyncio.sleep(0.01)
+    [retry] = pipeline._retry_tasks
+
+    await pipeline.stop()
+
+    assert retry.cancelled()
+    assert not pipeline._retry_tasks
+
+
+@pytest.mark.parametrize("succeed_first", [None, 2])
+async def test_chunks_are_indexed_in_groups(db, user, make_pipeline, succeed_first):
+    # 3グループ目の埋め込みで1回失敗させると、最初のグループからやり直す
+    pipeline = make_pipeline(failures=0 if succeed_first is None else 1, retry_backoff=0.01,
+                             succeed_first=succeed_first or 0, chunk_group_size=2)
+    text = "\n\n  " + "\n\n".join(f"Step {i}: rinse the filter basket number {i} and dry it." for i in range(7)) + "\n  "
+    await pipeline.start()
+    try:
+        job = await _submit(pipeline, db, user, text)
+        job = await _wait_for_status(db, job.id, (STATUS_SUCCEEDED,))
+    finally:
+        await pipeline.stop()
+
+    content = db.get(Document, job.document_id).content
+    assert content == text.strip()
+    rows = db.query(DocumentChunk).filter(DocumentChunk.document_id == job.document_id)\
+        .order_by(DocumentChunk.position).all()
+    assert [row.position for row in rows] == list(range(7))
+    assert all(content[row.start_offset:row.end_offset] == row.content for row in rows)
+    assert job.chunks_total == job.chunks_indexed == 7
+    assert job.attempts == (0 if succeed_first is None else 1)
+    store = pipeline.stores[user.id]
+    assert len(store.metadata.chunk_ids_for_document(job.document_id)) == 7
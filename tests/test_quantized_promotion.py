@@ -0,0 +1,38 @@
+"""
+量子化インデックスへの昇格後に非圧縮ベクトルがヒープに残らないことの確認
+"""
+import numpy as np
+import pytest
+
+from app.services.vector_index import ENGINE_FAISS, FAISS_AVAILABLE, INDEX_BINARY, INDEX_PQ, INDEX_SQ8
+from app.services.vector_store import VectorStore
+
+pytestmark = pytest.mark.skipif(not FAISS_AVAILABLE, reason="quantized indexes require faiss")
+
+DIMENSION = 64
+
+
+@pytest.mark.parametrize("kind", [INDEX_SQ8, INDEX_PQ, INDEX_BINARY])
+def test_promotion_keeps_full_precision_vectors_on_disk(tmp_path, kind):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, DIMENSION)).astype(np.float32)
+    store = VectorStore(1, dimension=DIMENSION, storage_dir=str(tmp_path), engine=ENGINE_FAISS)
+    try:
+        store.add_documents(vectors, [
+            {'document_id': 1, 'title': "doc", 'content': f"chunk {i}"} for i in range(len(vectors))
+        ])
+        store.checkpoint()
+        flat_bytes = store.index.ntotal * (DIMENSION * 4 + 8)
+
+        store.rebuild_index(kind)
+
+        full = store.index.full
+        assert store.index.kind == kind
+        assert len(full.tail_vectors) == 0
+        assert isinstance(full.base_vectors, np.memmap)
+        # ヒープに残るのは圧縮コード・IDマップ・メタデータの追記分だけ
+        assert store.index.memory_usage() == store.index.ntotal * (store.index.code_size + 8) + full.base_alive.nbytes
+        assert store.memory_usage() < flat_bytes / 2
+        assert store.search(vectors[7], top_k=1)[0][0]['content'] == "chunk 7"
+    finally:
+        store.close()
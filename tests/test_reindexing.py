@@ -0,0 +1,71 @@
+"""
+ドキュメント更新時のチャンクの突き合わせ（diff_chunks）
+"""
+from app.services.chunking import TextChunk
+from app.services.reindexing import diff_chunks
+
+
+def _stored(*items):
+    """(チャンクID, 本文, start) から保存済みチャンクの一覧を作る"""
+    return [
+        (chunk_id, {'title': "t", 'content': text, 'start': start, 'end': start + len(text)})
+        for chunk_id, text, start in items
+    ]
+
+
+def _chunks(*items):
+    return [TextChunk(text, start, start + len(text)) for text, start in items]
+
+
+def test_unchanged_chunks_are_reused_without_updates():
+    stored = _stored((0, "a", 0), (1, "b", 2))
+    diff = diff_chunks(stored, _chunks(("a", 0), ("b", 2)), "t")
+
+    assert diff.reused == 2
+    assert diff.added == []
+    assert diff.removed_ids == []
+    assert diff.updates == {}
+
+
+def test_reordered_chunks_are_reused_with_new_offsets():
+    stored = _stored((0, "a", 0), (1, "b", 2), (2, "c", 4))
+    diff = diff_chunks(stored, _chunks(("c", 0), ("a", 2), ("b", 4)), "t")
+
+    assert diff.reused == 3
+    assert diff.added == []
+    assert diff.removed_ids == []
+    assert diff.updates == {
+        0: {'start': 2, 'end': 3},
+        1: {'start': 4, 'end': 5},
+        2: {'start': 0, 'end': 1},
+    }
+
+
+def test_repeated_chunks_are_matched_in_order():
+    # 同じ本文が3回あった文書から2回に減らし、間に新しいチャンクを入れる
+    stored = _stored((0, "x", 0), (1, "y", 2), (2, "x", 4), (3, "x", 6))
+    chunks = _chunks(("x", 0), ("new", 2), ("x", 6), ("y", 8))
+    diff = diff_chunks(stored, chunks, "t")
+
+    assert diff.reused == 3
+    assert [chunk.text for chunk in diff.added] == ["new"]
+    # 出現順に対応させるので、残るのは先の2つの "x"（ID 0, 2）で、最後の "x" を削除する
+    assert diff.removed_ids == [3]
+    assert diff.updates == {2: {'start': 6, 'end': 7}, 1: {'start': 8, 'end': 9}}
+
+
+def test_repeated_chunk_added_again_is_embedded_once_more():
+    stored = _stored((0, "x", 0))
+    diff = diff_chunks(stored, _chunks(("x", 0), ("x", 2)), "t")
+
+    assert diff.reused == 1
+    assert [(chunk.text, chunk.start) for chunk in diff.added] == [("x", 2)]
+    assert diff.removed_ids == []
+
+
+def test_title_change_updates_every_reused_chunk():
+    stored = _stored((0, "a", 0), (1, "b", 2))
+    diff = diff_chunks(stored, _chunks(("a", 0), ("b", 2)), "renamed")
+
+    assert diff.updates == {0: {'title': "renamed"}, 1: {'title': "renamed"}}
+    assert diff.summary(2) == {'chunks_total': 2, 'chunks_embedded': 0, 'chunks_reused': 2, 'chunks_removed': 0}
@@ -0,0 +1,82 @@
+"""
+追記ログ（WAL）の再生と、末尾の書きかけレコードの切り捨て
+"""
+import numpy as np
+
+from app.services.vector_persistence import StorePersistence
+from app.services.vector_store import VectorStore
+
+DIMENSION = 8
+
+
+def _log_path(root):
+    [path] = sorted(root.glob("wal-*.log"))
+    return path
+
+
+def test_replay_stops_at_truncated_record_and_truncates_log(tmp_path):
+    persistence = StorePersistence(tmp_path, fsync=False)
+    persistence.replay_log()
+    for i in range(3):
+        persistence.append(('remove', [i]))
+    persistence.close()
+    path = _log_path(tmp_path)
+    # 最後のレコードの途中でクラッシュした状態にする
+    complete_size = path.stat().st_size
+    with open(path, "r+b") as f:
+        f.truncate(complete_size - 3)
+
+    persistence = StorePersistence(tmp_path, fsync=False)
+    assert list(persistence.replay_log()) == [('remove', [0]), ('remove', [1])]
+    # 書きかけの分は捨て、続きは有効なレコードの直後から書く
+    persistence.append(('remove', [3]))
+    persistence.close()
+
+    persistence = StorePersistence(tmp_path, fsync=False)
+    assert list(persistence.replay_log()) == [('remove', [0]), ('remove', [1]), ('remove', [3])]
+    persistence.close()
+
+
+def test_replay_stops_at_record_with_bad_checksum(tmp_path):
+    persistence = StorePersistence(tmp_path, fsync=False)
+    persistence.replay_log()
+    persistence.append(('remove', [0]))
+    persistence.append(('remove', [1]))
+    persistence.close()
+    path = _log_path(tmp_path)
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+    persistence = StorePersistence(tmp_path, fsync=False)
+    assert list(persistence.replay_log()) == [('remove', [0])]
+    persistence.close()
+
+
+def test_store_recovers_chunks_before_torn_write(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((3, DIMENSION)).astype(np.float32)
+    store = VectorStore(1, dimension=DIMENSION, storage_dir=str(tmp_path))
+    for document_id, vector in enumerate(vectors, start=1):
+        store.add_document(document_id, f"doc {document_id}", f"content {document_id}", vector.tolist())
+    store.close()
+
+    path = _log_path(tmp_path / "user_1")
+    with open(path, "r+b") as f:
+        f.truncate(path.stat().st_size - 10)
+
+    store = VectorStore(1, dimension=DIMENSION, storage_dir=str(tmp_path))
+    try:
+        assert len(store.metadata) == 2
+        assert store.search(vectors[1], top_k=1)[0][0]['document_id'] == 2
+        # 切り捨てた後のログに追記しても読み直せる
+        store.add_document(4, "doc 4", "content 4", vectors[2].tolist())
+    finally:
+        store.close()
+
+    store = VectorStore(1, dimension=DIMENSION, storage_dir=str(tmp_path))
+    try:
+        assert len(store.metadata) == 3
+        assert store.search(vectors[2], top_k=1)[0][0]['document_id'] == 4
+    finally:
+        store.close()
@@ -0,0 +1,86 @@
+"""
+チェックポイント後にスナップショットをmmapで開き直すことの確認
+"""
+import numpy as np
+import pytest
+
+from app.services.chunk_metadata import MappedChunkTable
+from app.services.vector_index import ENGINE_FAISS, ENGINE_NUMPY, FAISS_AVAILABLE
+from app.services.vector_store import VectorStore
+
+DIMENSION = 16
+
+ENGINES = [ENGINE_NUMPY] + ([ENGINE_FAISS] if FAISS_AVAILABLE else [])
+
+
+def _vectors(rng, n):
+    return rng.standard_normal((n, DIMENSION)).astype(np.float32)
+
+
+def _metadatas(document_id, n):
+    return [
+        {'document_id': document_id, 'title': f"doc {document_id}", 'content': f"chunk {i} of {document_id}"}
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def make_store(tmp_path):
+    stores = []
+
+    def make(engine):
+        store = VectorStore(1, dimension=DIMENSION, storage_dir=str(tmp_path), engine=engine)
+        stores.append(store)
+        return store
+    yield make
+    for store in stores:
+        store.close()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_checkpoint_reopens_snapshot_with_memory_mapping(make_store, engine):
+    rng = np.random.default_rng(0)
+    store = make_store(engine)
+    vectors = _vectors(rng, 500)
+    store.add_documents(vectors, _metadatas(1, 500))
+    heap_before = store.memory_usage()
+
+    store.checkpoint()
+
+    assert store.index.mapped
+    assert isinstance(store.metadata.segments[0], MappedChunkTable)
+    assert len(store.metadata.tail) == 0
+    assert store.memory_usage() < heap_before
+    # 開き直した後も同じ結果が返る
+    results = store.search(vectors[42], top_k=1)
+    assert results[0][0]['content'] == "chunk 42 of 1"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_changes_during_snapshot_write_survive_reopen(make_store, engine):
+    rng = np.random.default_rng(1)
+    store = make_store(engine)
+    store.add_documents(_vectors(rng, 50), _metadatas(1, 50))
+    late = _vectors(rng, 5)
+
+    write_snapshot = store._persistence.write_snapshot
+
+    def write_with_concurrent_changes(gen, writer):
+        # スナップショットを書いている間に別のリクエストが書き込んだ状態を再現する
+        store.add_documents(late, _metadatas(2, 5))
+        store.remove_document(1)
+        return write_snapshot(gen, writer)
+
+    store._persistence.write_snapshot = write_with_concurrent_changes
+    store.checkpoint()
+    store._persistence.write_snapshot = write_snapshot
+
+    assert len(store.metadata) == 5
+    assert len(store.metadata.chunk_ids_for_document(1)) == 0
+    assert store.search(late[3], top_k=1)[0][0]['content'] == "chunk 3 of 2"
+
+    # ログの再生で読み込み直しても同じ状態になる
+    store.close()
+    reloaded = make_store(engine)
+    assert len(reloaded.metadata) == 5
+    assert reloaded.search(late[3], top_k=1)[0][0]['content'] == "chunk 3 of 2"